@@ -0,0 +1,1281 @@
+# QE Zero - Motore di calcolo dei Quadri Economici
+# Modulo condiviso tra QE Zero e QE Zero Toolkit
+#
+# Copyright (C) 2025 Rodolfo Sabelli
+#
+# Questo programma è software libero: puoi ridistribuirlo e/o modificarlo
+# secondo i termini della GNU General Public License versione 3 o della
+# European Union Public License versione 1.2 (a tua scelta).
+#
+# Questo programma è distribuito nella speranza che sia utile,
+# ma SENZA ALCUNA GARANZIA; senza neppure la garanzia implicita di
+# COMMERCIABILITÀ o IDONEITÀ PER UN PARTICOLARE SCOPO.
+#
+# Vedi LICENSE.txt per il testo completo delle licenze.
+#
+# Contatti: rodolfo.sabelli@gmail.com
+# Repository: [URL GITHUB/GITLAB]
+
+from collections import deque
+from itertools import compress, repeat
+from operator import attrgetter, is_, itemgetter, truediv
+from decimal import Decimal, ROUND_HALF_UP, InvalidOperation
+from fractions import Fraction
+
+try:
+    import numpy as np
+except ImportError:  # NumPy è opzionale: senza, si usa il percorso Python puro
+    np = None
+
+# Oltre questa soglia di voci (se NumPy è disponibile) il calcolo è vettoriale
+SOGLIA_NUMPY = 5000
+
+# Campi di calcolo delle voci (attributi di Voce)
+CAMPI_VOCI = (
+    "valore_imponibile", "is_percentuale", "perc_oneri", "includi_oneri_in_iva",
+    "perc_iva", "flag_base_asta", "flag_calcolo_montante", "importo_cent"
+)
+
+# Campi delle basi di calcolo delle voci a percentuale
+CAMPI_BASI = ("codice_padre", "codice_completo", "macro_base_calcolo")
+
+# Campo del ribasso d'asta (scenari)
+CAMPO_RIBASSO = "flag_soggetto_ribasso"
+
+
+# =============================================================================
+# IMPORTI IN CENTESIMI
+# =============================================================================
+# Tutti gli importi sono interi in centesimi di euro: somme e confronti sono
+# esatti. Le aliquote (oneri, IVA, voci a percentuale) restano decimali e sono
+# applicate con 4 cifre decimali (SCALA_ALIQUOTE).
+#
+# Regola di arrotondamento: ogni quota (imponibile di una voce a percentuale,
+# oneri, IVA) è arrotondata al centesimo, metà lontano da zero
+# (ROUND_HALF_UP), voce per voce. I totali sono somme di importi già arrotondati.
+SCALA_ALIQUOTE = 10000
+_DIV_QUOTA = 100 * SCALA_ALIQUOTE
+_MEZZO_QUOTA = _DIV_QUOTA // 2
+_CENT = Decimal("0.01")
+
+
+def centesimi(x):
+    """Converte un importo in euro (float, int, str o Decimal) in centesimi interi"""
+    if not x:
+        return 0
+    if isinstance(x, int):
+        return x * 100
+    # str() di un float è la sua rappresentazione decimale più corta:
+    # 0.1 + 0.2 -> "0.30000000000000004" -> 30 centesimi
+    d = Decimal(x if isinstance(x, (str, Decimal)) else str(x))
+    return int(d.quantize(_CENT, rounding=ROUND_HALF_UP).scaleb(2))
+
+
+def euro(c):
+    """Centesimi -> euro (float), solo per visualizzazione ed export"""
+    return c / 100 if c else 0.0
+
+
+def aliquota(p):
+    """Aliquota percentuale -> intero scalato di SCALA_ALIQUOTE (22 -> 220000)"""
+    if not p:
+        return 0
+    a = int(abs(float(p)) * SCALA_ALIQUOTE + 0.5)
+    return -a if p < 0 else a
+
+
+def quota(c, p):
+    """p% dell'importo c (centesimi), arrotondata al centesimo (metà lontano da zero)"""
+    n = c * aliquota(p)
+    if n < 0:
+        return -((-n + _MEZZO_QUOTA) // _DIV_QUOTA)
+    return (n + _MEZZO_QUOTA) // _DIV_QUOTA
+
+
+# =============================================================================
+# FORMATTAZIONE E LETTURA DEGLI IMPORTI (FORMATO ITALIANO)
+# =============================================================================
+# Cache limitata delle stringhe già formattate (centesimi -> testo): i refresh
+# successivi dello stesso QE e gli importi ripetuti (zeri, subtotali, voci
+# copiate tra versioni) non vengono riformattati. Superato il limite si svuota.
+DIM_CACHE_FORMATO = 200000
+_cache_formato = {}
+# Ultime colonne formattate senza passare dalla cache: entrano in cache solo
+# se vengono richieste di nuovo (al primo refresh costa solo la formattazione)
+_colonne_recenti = deque(maxlen=8)
+
+
+_SEPARATORI_IT = str.maketrans("._", ",.")
+
+
+def _testo_it(valori):
+    """Formatta in blocco una lista di centesimi: un'unica conversione dei
+    separatori sul testo dell'intera lista"""
+    testo = "\n".join(map(format, map(truediv, valori, repeat(100)), repeat("_.2f")))
+    return testo.translate(_SEPARATORI_IT).split("\n")
+
+
+def formatta_euro(v):
+    """Euro (float) -> stringa italiana con due decimali (1234.5 -> '1.234,50')"""
+    return f"{v:_.2f}".replace(".", ",").replace("_", ".")
+
+
+def formatta_cent(c):
+    """Centesimi interi -> stringa italiana (123456 -> '1.234,56')"""
+    s = _cache_formato.get(c)
+    if s is None:
+        s = formatta_euro(c / 100)
+        if len(_cache_formato) >= DIM_CACHE_FORMATO:
+            _cache_formato.clear()
+        _cache_formato[c] = s
+    return s
+
+
+def formatta_colonna(valori):
+    """Formatta un'intera colonna (lista) di importi in centesimi.
+
+    I valori già in cache sono solo letti. Una colonna quasi tutta nuova è
+    formattata intera in un blocco e tenuta tra le colonne recenti: i suoi
+    valori entrano in cache solo quando la stessa colonna torna (refresh
+    successivo). Negli altri casi si formattano e memorizzano i soli
+    mancanti distinti.
+    """
+    testi = list(map(_cache_formato.get, valori))
+    n_mancanti = testi.count(None)
+    if not n_mancanti:
+        return testi
+
+    if 2 * n_mancanti <= len(testi):
+        mancanti = list(dict.fromkeys(compress(valori, map(is_, testi, repeat(None)))))
+        nuovi = dict(zip(mancanti, _testo_it(mancanti)))
+        _memorizza(nuovi.items(), len(nuovi))
+        return list(map(nuovi.get, valori, testi))
+
+    for k, (recenti, testi) in enumerate(_colonne_recenti):
+        if recenti == valori:
+            del _colonne_recenti[k]
+            _memorizza(zip(recenti, testi), len(recenti))
+            return list(testi)
+
+    testi = _testo_it(valori)
+    _colonne_recenti.append((list(valori), testi))
+    return list(testi)
+
+
+def _memorizza(coppie, n):
+    """Aggiunge n coppie (centesimi, testo) alla cache, svuotandola se piena"""
+    if n > DIM_CACHE_FORMATO:
+        return
+    if len(_cache_formato) + n > DIM_CACHE_FORMATO:
+        _cache_formato.clear()
+    _cache_formato.update(coppie)
+
+
+def _pulisci_importo(s):
+    return str(s).replace("€", "").strip().replace(".", "").replace(",", ".")
+
+
+def leggi_cent(s):
+    """Stringa italiana ('€ 1.234,56') -> centesimi interi; 0 se vuota o non valida"""
+    if not s:
+        return 0
+    try:
+        return centesimi(_pulisci_importo(s))
+    except (InvalidOperation, ValueError):
+        return 0
+
+
+def leggi_euro(s):
+    """Stringa italiana ('1.234,56') -> float; 0.0 se vuota o non valida"""
+    if not s:
+        return 0.0
+    try:
+        return float(_pulisci_importo(s))
+    except ValueError:
+        return 0.0
+
+
+def importo_valido(s):
+    """True se s è un numero italiano finito: leggi_cent e leggi_euro
+    restituiscono 0 anche per un testo non valido ('1O'), questa li distingue"""
+    try:
+        return Decimal(_pulisci_importo(s)).is_finite()
+    except InvalidOperation:
+        return False
+
+
+# =============================================================================
+# VOCI
+# =============================================================================
+class Voce:
+    """Voce di un QE come la restituisce DatabaseManager: un attributo per
+    colonna della tabella voci (senza __dict__ né tupla della riga)"""
+
+    __slots__ = CAMPI = (
+        "id", "qe_id", "codice_padre", "codice_completo", "descrizione", "tipo",
+        "valore_imponibile", "is_percentuale", "perc_oneri", "includi_oneri_in_iva",
+        "perc_iva", "flag_base_asta", "flag_soggetto_ribasso", "macro_base_calcolo",
+        "flag_calcolo_montante", "importo_cent"
+    )
+
+    def __init__(self, id, qe_id, codice_padre, codice_completo, descrizione, tipo,
+                 valore_imponibile, is_percentuale, perc_oneri, includi_oneri_in_iva,
+                 perc_iva, flag_base_asta, flag_soggetto_ribasso, macro_base_calcolo,
+                 flag_calcolo_montante, importo_cent):
+        self.id = id
+        self.qe_id = qe_id
+        self.codice_padre = codice_padre
+        self.codice_completo = codice_completo
+        self.descrizione = descrizione
+        self.tipo = tipo
+        self.valore_imponibile = valore_imponibile  # Euro, o aliquota se a percentuale
+        self.is_percentuale = is_percentuale
+        self.perc_oneri = perc_oneri
+        self.includi_oneri_in_iva = includi_oneri_in_iva
+        self.perc_iva = perc_iva
+        self.flag_base_asta = flag_base_asta
+        self.flag_soggetto_ribasso = flag_soggetto_ribasso
+        self.macro_base_calcolo = macro_base_calcolo
+        self.flag_calcolo_montante = flag_calcolo_montante
+        self.importo_cent = importo_cent  # None per le voci a percentuale
+
+    def __repr__(self):
+        return f"Voce({self.id}, {self.codice_completo!r})"
+
+
+# =============================================================================
+# RISULTATO DEL CALCOLO
+# =============================================================================
+class CalcoloQE:
+    """Importi derivati di un QE (in centesimi): colonne per voce e totali di sezione"""
+
+    __slots__ = (
+        "imp", "one", "iva", "iva_imp", "tot",
+        "montante", "tot_sec1", "tot_sec2_imp",
+        "tot_oneri", "tot_iva", "tot_tasse", "totale"
+    )
+
+    def __init__(self, imp, one, iva, iva_imp, tot, montante, tot_sec1,
+                 tot_sec2_imp, tot_oneri, tot_iva, tot_tasse):
+        # Colonne (una posizione per voce, stesso ordine dell'input)
+        self.imp = imp
+        self.one = one
+        self.iva = iva
+        self.iva_imp = iva_imp  # Quota IVA sul solo imponibile
+        self.tot = tot
+
+        # Totali
+        self.montante = montante
+        self.tot_sec1 = tot_sec1          # Imponibile voci base d'asta
+        self.tot_sec2_imp = tot_sec2_imp  # Imponibile somme a disposizione
+        self.tot_oneri = tot_oneri
+        self.tot_iva = tot_iva
+        self.tot_tasse = tot_tasse
+        self.totale = tot_sec1 + tot_sec2_imp + tot_tasse
+
+    def iva_oneri(self, i):
+        """Quota IVA calcolata sugli oneri della voce i"""
+        return self.iva[i] - self.iva_imp[i]
+
+
+# =============================================================================
+# CALCOLO A COLONNE
+# =============================================================================
+def _num(col, n):
+    """Normalizza una colonna numerica (None -> 0.0, colonna assente -> zeri)"""
+    if col is None:
+        return [0.0] * n
+    return [float(x) if x else 0.0 for x in col]
+
+
+def _flag(col, n):
+    """Normalizza una colonna di flag 0/1"""
+    if col is None:
+        return [0] * n
+    return [1 if x == 1 else 0 for x in col]
+
+
+def _importi(valore, is_perc, cent):
+    """Importo in centesimi delle voci fisse (0 per le voci a percentuale).
+
+    Se importo_cent manca (colonna assente o riga non migrata) si converte
+    valore_imponibile.
+    """
+    if cent is None:
+        cent = [None] * len(valore)
+    return [
+        0 if p else (c if c is not None else centesimi(v))
+        for v, p, c in zip(valore, is_perc, cent)
+    ]
+
+
+def calcola_colonne(valore, is_perc, perc_oneri, inc_iva, perc_iva,
+                    base_asta=None, f_mont=None, cent=None, backend=None):
+    """Calcola in un solo passaggio tutti gli importi derivati di un QE.
+
+    Ogni argomento è una colonna (lista) con un elemento per voce:
+    valore è l'aliquota per le voci a percentuale, cent l'importo in
+    centesimi delle voci fisse. Risultati in centesimi.
+    backend: None (automatico), "python" o "numpy".
+    """
+    n = len(valore)
+    valore = _num(valore, n)
+    is_perc = _flag(is_perc, n)
+    perc_oneri = _num(perc_oneri, n)
+    inc_iva = _flag(inc_iva, n)
+    perc_iva = _num(perc_iva, n)
+    base_asta = _flag(base_asta, n)
+    f_mont = _flag(f_mont, n)
+    cent = _importi(valore, is_perc, cent)
+
+    if backend is None:
+        backend = "numpy" if (np is not None and n >= SOGLIA_NUMPY) else "python"
+
+    if backend == "numpy":
+        if np is None:
+            raise RuntimeError("Backend NumPy richiesto ma NumPy non è installato")
+        calc = _calcola_numpy(valore, is_perc, perc_oneri, inc_iva, perc_iva,
+                              base_asta, f_mont, cent)
+        if calc is not None:
+            return calc
+    return _calcola_python(valore, is_perc, perc_oneri, inc_iva, perc_iva,
+                           base_asta, f_mont, cent)
+
+
+def _calcola_python(valore, is_perc, perc_oneri, inc_iva, perc_iva, base_asta,
+                    f_mont, cent, montante=None):
+    # Pre-passaggio: montante (solo importi fissi con flag_calcolo_montante=1),
+    # salvo montante imposto dagli scenari
+    if montante is None:
+        montante = 0
+        for c, p, m in zip(cent, is_perc, f_mont):
+            if not p and m:
+                montante += c
+
+    imp = [quota(montante, v) if p else c for v, p, c in zip(valore, is_perc, cent)]
+    one = [quota(i, po) for i, po in zip(imp, perc_oneri)]
+    iva = [quota((i + o) if inc else i, pi)
+           for i, o, inc, pi in zip(imp, one, inc_iva, perc_iva)]
+    iva_imp = [quota(i, pi) if inc else iv
+               for i, iv, inc, pi in zip(imp, iva, inc_iva, perc_iva)]
+    tot = [i + o + iv for i, o, iv in zip(imp, one, iva)]
+
+    tot_sec1 = 0
+    tot_sec2_imp = 0
+    for i, b in zip(imp, base_asta):
+        if b:
+            tot_sec1 += i
+        else:
+            tot_sec2_imp += i
+
+    tot_oneri = sum(one)
+    tot_iva = sum(iva)
+
+    return CalcoloQE(imp, one, iva, iva_imp, tot, montante, tot_sec1,
+                     tot_sec2_imp, tot_oneri, tot_iva, tot_oneri + tot_iva)
+
+
+def _quota_numpy(c, a):
+    """quota() vettoriale su array int64 (c centesimi, a aliquote scalate)"""
+    n = c * a
+    return np.sign(n) * ((np.abs(n) + _MEZZO_QUOTA) // _DIV_QUOTA)
+
+
+def _aliquote_numpy(col):
+    """aliquota() vettoriale (stesso arrotondamento del percorso Python)"""
+    x = np.asarray(col, dtype=np.float64)
+    return (np.floor(np.abs(x) * SCALA_ALIQUOTE + 0.5) * np.sign(x)).astype(np.int64)
+
+
+def _calcola_numpy(valore, is_perc, perc_oneri, inc_iva, perc_iva, base_asta,
+                   f_mont, cent):
+    p = np.asarray(is_perc, dtype=bool)
+    c = np.asarray(cent, dtype=np.int64)
+    inc = np.asarray(inc_iva, dtype=bool)
+    b = np.asarray(base_asta, dtype=bool)
+    m = np.asarray(f_mont, dtype=bool)
+
+    av = np.where(p, _aliquote_numpy(valore), 0)  # valore è un'aliquota solo per le voci a percentuale
+    ao = _aliquote_numpy(perc_oneri)
+    ai = _aliquote_numpy(perc_iva)
+
+    if not len(c):
+        return None
+
+    montante = int(c[~p & m].sum())
+
+    # Gli int64 non devono traboccare nei prodotti importo x aliquota:
+    # oltre il limite si ripiega sul calcolo Python (interi illimitati)
+    a_max = max(int(np.abs(x).max()) for x in (av, ao, ai)) + 1
+    fatt = a_max // _DIV_QUOTA + 1  # Massimo fattore di una quota sulla sua base
+    if max(int(np.abs(c).max()), abs(montante)) * fatt * (fatt + 1) * a_max >= 2 ** 62:
+        return None
+
+    imp = np.where(p, _quota_numpy(np.int64(montante), av), c)
+    one = _quota_numpy(imp, ao)
+    iva = _quota_numpy(np.where(inc, imp + one, imp), ai)
+    iva_imp = np.where(inc, _quota_numpy(imp, ai), iva)
+    tot = imp + one + iva
+
+    tot_oneri = int(one.sum())
+    tot_iva = int(iva.sum())
+    return CalcoloQE(
+        imp.tolist(), one.tolist(), iva.tolist(), iva_imp.tolist(), tot.tolist(),
+        montante,
+        int(imp[b].sum()), int(imp[~b].sum()),
+        tot_oneri, tot_iva, tot_oneri + tot_iva
+    )
+
+
+def calcola_voce(valore, is_perc, perc_oneri, inc_iva, perc_iva, montante, cent=None):
+    """Calcola una sola voce dato il montante (centesimi) già noto.
+
+    Per le voci con base propria montante è la loro base (GrafoBasi.base).
+
+    Restituisce (imponibile, oneri, iva, totale) in centesimi con le stesse
+    regole di calcola_colonne.
+    """
+    if is_perc == 1:
+        imp = quota(montante, valore)
+    else:
+        imp = cent if cent is not None else centesimi(valore)
+    imp, one, iva, _ = _importi_voce(imp, perc_oneri, inc_iva, perc_iva)
+    return imp, one, iva, imp + one + iva
+
+
+def _importi_voce(imp, perc_oneri, inc_iva, perc_iva):
+    """(imponibile, oneri, iva, iva sul solo imponibile) di una voce"""
+    one = quota(imp, perc_oneri)
+    iva = quota((imp + one) if inc_iva == 1 else imp, perc_iva)
+    iva_imp = quota(imp, perc_iva) if inc_iva == 1 else iva
+    return imp, one, iva, iva_imp
+
+
+def calcola_voci(rows, indici=CAMPI_VOCI, backend=None, indici_basi=CAMPI_BASI):
+    """Calcola un QE partendo dalle righe lette dal database.
+
+    indici: campi di Voce (o posizioni, per righe tuple) di (valore,
+    is_percentuale, perc_oneri, includi_oneri_in_iva, perc_iva, flag_base_asta,
+    flag_calcolo_montante, importo_cent); None se la colonna non è presente
+    nella proiezione.
+    indici_basi: campi (o posizioni) di (codice_padre, codice_completo,
+    macro_base_calcolo) per le voci a percentuale con base propria;
+    None se la proiezione non le contiene (tutte sul montante).
+    """
+    colonne = [_colonna(rows, k) for k in indici]
+    calc = calcola_colonne(*colonne, backend=backend)
+
+    if indici_basi is not None:
+        basi = _colonna(rows, indici_basi[2])
+        if basi is not None and any(basi):
+            grafo = GrafoBasi.da_colonne(
+                _colonna(rows, indici_basi[0]), _colonna(rows, indici_basi[1]),
+                colonne[5], colonne[1], basi
+            )
+            applica_basi(calc, grafo, *colonne[:6])
+    return calc
+
+
+def _colonna(rows, k):
+    """Colonna k delle righe: nome di attributo (Voce) o posizione (tuple)"""
+    if k is None:
+        return None
+    if isinstance(k, str):
+        return list(map(attrgetter(k), rows))
+    return list(map(itemgetter(k), rows))
+
+
+# =============================================================================
+# BASI DI CALCOLO DELLE VOCI A PERCENTUALE (macro_base_calcolo)
+# =============================================================================
+# Una voce a percentuale si calcola sul montante oppure, se macro_base_calcolo
+# non è vuoto, sulla somma degli imponibili di altre voci. La base è un elenco
+# di riferimenti separati da ";":
+#   SEZ:1, SEZ:2    voci della sezione (1 base d'asta, 2 somme a disposizione)
+#   CAT:<codice>    voci della categoria (codice_padre)
+#   VOCE:<codice>   singola voce (codice_completo)
+# La voce non fa mai parte della propria base. Le voci con base propria
+# formano un grafo di dipendenze valutato in ordine topologico.
+TIPI_BASE = ("SEZ", "CAT", "VOCE")
+
+
+def leggi_base(spec):
+    """macro_base_calcolo -> tupla di riferimenti (tipo, codice); () = montante.
+
+    Solleva ValueError se un riferimento non è valido.
+    """
+    if not spec:
+        return ()
+    rif = []
+    for parte in str(spec).split(";"):
+        parte = parte.strip()
+        if not parte:
+            continue
+        tipo, sep, codice = parte.partition(":")
+        tipo = tipo.strip().upper()
+        codice = codice.strip()
+        if not sep or tipo not in TIPI_BASE or not codice:
+            raise ValueError(f"Riferimento non valido nella base di calcolo: '{parte}'")
+        if tipo == "SEZ" and codice not in ("1", "2"):
+            raise ValueError(f"Sezione non valida nella base di calcolo: '{codice}' (1 o 2)")
+        if (tipo, codice) not in rif:
+            rif.append((tipo, codice))
+    return tuple(rif)
+
+
+def formatta_base(rif):
+    """Riferimenti -> testo normalizzato di macro_base_calcolo"""
+    return ";".join(f"{t}:{c}" for t, c in rif)
+
+
+def ha_base_propria(spec):
+    """True se macro_base_calcolo indica una base diversa dal montante"""
+    return bool(spec) and bool(str(spec).strip())
+
+
+class CicloDipendenze(ValueError):
+    """Le basi di calcolo di alcune voci a percentuale si richiamano a vicenda"""
+
+    def __init__(self, codici):
+        self.codici = codici
+        super().__init__(
+            "Dipendenza circolare tra le basi di calcolo delle voci: " + ", ".join(codici)
+        )
+
+
+class GrafoBasi:
+    """Dipendenze tra le voci a percentuale con base propria.
+
+    Le chiavi identificano le voci (id del DB o posizione nella lista).
+    Il grafo è mantenuto tra un calcolo e l'altro: aggiorna() e rimuovi()
+    restituiscono solo le voci da ricalcolare, in ordine topologico.
+    """
+
+    def __init__(self):
+        self.nodi = {}    # chiave -> (codice_padre, codice_completo, sezione)
+        self.rif = {}     # chiave -> riferimenti (solo voci con base propria)
+        self.dip = {}     # chiave -> voci che compongono la base
+        self.inv = {}     # chiave -> voci con base propria che la usano
+        self.ordine = []  # voci con base propria in ordine topologico
+        self.bloccate = ()  # voci in un ciclo (o a valle di un ciclo): base 0
+        self._cat = {}
+        self._sez = {1: set(), 2: set()}
+        self._cod = {}
+
+    @classmethod
+    def da_colonne(cls, codici_padre, codici, base_asta, is_perc, basi, chiavi=None):
+        """Costruisce il grafo dalle colonne di un QE"""
+        g = cls()
+        n = len(basi)
+        codici_padre = codici_padre or [None] * n
+        codici = codici or [None] * n
+        base_asta = base_asta or [0] * n
+        is_perc = is_perc or [0] * n
+        chiavi = range(n) if chiavi is None else chiavi
+
+        for k, cp, cod, b, p, spec in zip(chiavi, codici_padre, codici, base_asta, is_perc, basi):
+            g._aggiungi(k, cp, cod, b, p, spec)
+        for k in g.rif:
+            g._risolvi(k)
+        g._ordina()
+        return g
+
+    def _aggiungi(self, k, cp, cod, base_asta, is_perc, spec):
+        sez = 1 if base_asta == 1 else 2
+        self.nodi[k] = (cp, cod, sez)
+        self._cat.setdefault(cp, set()).add(k)
+        self._sez[sez].add(k)
+        if cod:
+            self._cod[cod] = k
+        if is_perc == 1 and ha_base_propria(spec):
+            try:
+                self.rif[k] = leggi_base(spec)
+            except ValueError:
+                # Base illeggibile (dati esterni): la voce resta sul montante
+                pass
+
+    def _togli(self, k):
+        cp, cod, sez = self.nodi.pop(k)
+        self._cat[cp].discard(k)
+        if not self._cat[cp]:
+            del self._cat[cp]
+        self._sez[sez].discard(k)
+        if cod and self._cod.get(cod) == k:
+            del self._cod[cod]
+        self.rif.pop(k, None)
+        for j in self.dip.pop(k, ()):
+            self.inv[j].discard(k)
+            if not self.inv[j]:
+                del self.inv[j]
+
+    def voci_base(self, rif, escludi=None):
+        """Voci che compongono una base (riferimenti di leggi_base)"""
+        base = set()
+        for tipo, codice in rif:
+            if tipo == "SEZ":
+                base |= self._sez[int(codice)]
+            elif tipo == "CAT":
+                base |= self._cat.get(codice, set())
+            elif codice in self._cod:
+                base.add(self._cod[codice])
+        base.discard(escludi)
+        return base
+
+    def _risolvi(self, k):
+        """Aggiorna l'insieme delle voci che compongono la base di k"""
+        base = self.voci_base(self.rif[k], k)
+
+        prima = self.dip.get(k, set())
+        for j in prima - base:
+            self.inv[j].discard(k)
+            if not self.inv[j]:
+                del self.inv[j]
+        for j in base - prima:
+            self.inv.setdefault(j, set()).add(k)
+        self.dip[k] = base
+
+    def _ordina(self):
+        """Ordinamento topologico (Kahn) delle voci con base propria"""
+        entranti = {k: sum(1 for j in self.dip[k] if j in self.rif) for k in self.rif}
+        coda = deque(k for k, n in entranti.items() if n == 0)
+        ordine = []
+        while coda:
+            k = coda.popleft()
+            ordine.append(k)
+            for d in self.inv.get(k, ()):
+                if d in entranti:
+                    entranti[d] -= 1
+                    if entranti[d] == 0:
+                        coda.append(d)
+        self.ordine = ordine
+        self.bloccate = tuple(k for k, n in entranti.items() if n > 0)
+
+    def codici(self, chiavi):
+        return [self.nodi[k][1] or str(k) for k in chiavi]
+
+    def _da_rivalutare(self, nodo):
+        """Voci con base propria i cui riferimenti toccano categoria, sezione
+        o codice del nodo (cp, codice, sezione)"""
+        cp, cod, sez = nodo
+        chiavi = {("CAT", cp), ("SEZ", str(sez))}
+        if cod:
+            chiavi.add(("VOCE", cod))
+        return [k for k, rif in self.rif.items() if chiavi.intersection(rif)]
+
+    def aggiorna(self, k, cp, cod, base_asta, is_perc, spec, consenti_cicli=False):
+        """Inserisce o modifica una voce.
+
+        Restituisce le voci con base propria da ricalcolare (ordine
+        topologico). Se la modifica crea un ciclo la annulla e solleva
+        CicloDipendenze (a meno di consenti_cicli).
+        """
+        if is_perc == 1 and ha_base_propria(spec):
+            leggi_base(spec)  # ValueError se non valida
+
+        vecchio = None
+        if k in self.nodi:
+            vecchio = self.nodi[k] + (formatta_base(self.rif[k]) if k in self.rif else "",)
+            toccate = set(self._da_rivalutare(self.nodi[k]))
+            self._togli(k)
+        else:
+            toccate = set()
+
+        self._aggiungi(k, cp, cod, base_asta, is_perc, spec)
+        toccate.update(self._da_rivalutare(self.nodi[k]))
+        if k in self.rif:
+            toccate.add(k)
+        toccate.intersection_update(self.rif)
+        for j in toccate:
+            self._risolvi(j)
+
+        bloccate_prima = set(self.bloccate)
+        self._ordina()
+        nuove = [j for j in self.bloccate if j not in bloccate_prima]
+        if nuove and not consenti_cicli:
+            codici = self.codici(nuove)
+            if vecchio is None:
+                self.rimuovi(k)
+            else:
+                cp0, cod0, sez0, spec0 = vecchio
+                self.aggiorna(k, cp0, cod0, 1 if sez0 == 1 else 0, 1 if spec0 else 0,
+                              spec0, consenti_cicli=True)
+            raise CicloDipendenze(codici)
+
+        return self.a_valle(toccate | {k})
+
+    def rimuovi(self, k):
+        """Elimina una voce; restituisce le voci con base propria da ricalcolare"""
+        if k not in self.nodi:
+            return []
+        toccate = set(self._da_rivalutare(self.nodi[k]))
+        toccate.update(self.inv.get(k, ()))
+        self._togli(k)
+        toccate.intersection_update(self.rif)
+        for j in toccate:
+            self._risolvi(j)
+        self._ordina()
+        return self.a_valle(toccate)
+
+    def a_valle(self, chiavi):
+        """Voci con base propria che dipendono (anche indirettamente) da chiavi,
+        comprese quelle di chiavi stesse, in ordine di valutazione"""
+        visti = set()
+        pila = list(chiavi)
+        while pila:
+            k = pila.pop()
+            for d in self.inv.get(k, ()):
+                if d not in visti:
+                    visti.add(d)
+                    pila.append(d)
+        visti.update(k for k in chiavi if k in self.rif)
+        return [k for k in self.ordine if k in visti] + [k for k in self.bloccate if k in visti]
+
+    def base(self, k, importo):
+        """Base di calcolo (centesimi) della voce k; importo(j) = imponibile di j"""
+        if k in self.bloccate:
+            return 0
+        return sum(importo(j) for j in self.dip[k])
+
+
+def applica_basi(calc, grafo, valore, is_perc, perc_oneri, inc_iva, perc_iva, base_asta):
+    """Ricalcola in ordine topologico le voci con base propria di un
+    CalcoloQE (chiavi del grafo = posizioni) e ne aggiorna i totali"""
+    n = len(calc.imp)
+    valore = _num(valore, n)
+    perc_oneri = _num(perc_oneri, n)
+    inc_iva = _flag(inc_iva, n)
+    perc_iva = _num(perc_iva, n)
+    base_asta = _flag(base_asta, n)
+
+    for k in grafo.ordine + list(grafo.bloccate):
+        b = grafo.base(k, calc.imp.__getitem__)
+        imp, one, iva, iva_imp = _importi_voce(quota(b, valore[k]), perc_oneri[k],
+                                               inc_iva[k], perc_iva[k])
+        d_imp = imp - calc.imp[k]
+        if base_asta[k]:
+            calc.tot_sec1 += d_imp
+        else:
+            calc.tot_sec2_imp += d_imp
+        calc.tot_oneri += one - calc.one[k]
+        calc.tot_iva += iva - calc.iva[k]
+
+        calc.imp[k] = imp
+        calc.one[k] = one
+        calc.iva[k] = iva
+        calc.iva_imp[k] = iva_imp
+        calc.tot[k] = imp + one + iva
+
+    calc.tot_tasse = calc.tot_oneri + calc.tot_iva
+    calc.totale = calc.tot_sec1 + calc.tot_sec2_imp + calc.tot_tasse
+
+
+# =============================================================================
+# RICERCA OBIETTIVO (ALLINEAMENTO ALLO STANZIAMENTO)
+# =============================================================================
+# Le voci fisse scelte come regolabili sono scalate tutte dello stesso fattore
+# (in proporzione agli importi attuali) finché il totale del QE coincide con
+# l'obiettivo. A meno degli arrotondamenti al centesimo il totale è lineare
+# negli importi fissi, anche tenendo conto del montante e delle basi proprie:
+# due valutazioni danno il fattore esatto, poi si corregge l'ultimo centesimo.
+
+# Importo di prova (centesimi) quando le voci regolabili sono tutte a zero
+_PESO_OBIETTIVO = 1000000
+
+# Scostamento massimo (centesimi) provato sulle due voci maggiori per
+# assorbire gli arrotondamenti
+_RAGGIO_OBIETTIVO = 4
+
+# Voci regolabili (le maggiori) usate al più per la correzione finale
+_VOCI_CORREZIONE = 20
+
+
+class ObiettivoQE:
+    """Colonne e grafo di un QE pronti per risolvere più volte l'obiettivo
+    (es. a ogni cambio delle voci regolabili) senza rileggere le righe"""
+
+    __slots__ = ("valore", "is_perc", "perc_oneri", "inc_iva", "perc_iva",
+                 "base_asta", "f_mont", "cent", "grafo")
+
+    def __init__(self, rows, indici=CAMPI_VOCI, indici_basi=CAMPI_BASI):
+        n = len(rows)
+        col = [_colonna(rows, k) for k in indici]
+        self.valore = _num(col[0], n)
+        self.is_perc = _flag(col[1], n)
+        self.perc_oneri = _num(col[2], n)
+        self.inc_iva = _flag(col[3], n)
+        self.perc_iva = _num(col[4], n)
+        self.base_asta = _flag(col[5], n)
+        self.f_mont = _flag(col[6], n)
+        self.cent = _importi(self.valore, self.is_perc, col[7])
+
+        self.grafo = None
+        basi = _colonna(rows, indici_basi[2]) if indici_basi is not None else None
+        if basi is not None and any(basi):
+            self.grafo = GrafoBasi.da_colonne(
+                _colonna(rows, indici_basi[0]), _colonna(rows, indici_basi[1]),
+                self.base_asta, self.is_perc, basi
+            )
+
+    def totale(self, importi=None):
+        """Totale del QE (centesimi) con gli importi fissi {posizione: centesimi}"""
+        cent = self.cent
+        if importi:
+            cent = cent[:]
+            for k, c in importi.items():
+                cent[k] = c
+        calc = _calcola_python(self.valore, self.is_perc, self.perc_oneri, self.inc_iva,
+                               self.perc_iva, self.base_asta, self.f_mont, cent)
+        if self.grafo is not None:
+            applica_basi(calc, self.grafo, self.valore, self.is_perc, self.perc_oneri,
+                         self.inc_iva, self.perc_iva, self.base_asta)
+        return calc.totale
+
+    def risolvi(self, obiettivo, regolabili):
+        """Importi delle voci regolabili per cui il totale vale obiettivo.
+
+        regolabili: posizioni delle voci fisse da scalare (le voci a
+        percentuale sono ignorate). Restituisce (importi, totale, fattore):
+        importi {posizione: centesimi}, totale raggiunto (diverso
+        dall'obiettivo solo se nessuna combinazione di centesimi lo centra),
+        fattore applicato agli importi attuali (None se erano tutti a zero).
+        Solleva ValueError se l'obiettivo non è raggiungibile.
+        """
+        regolabili = [k for k in dict.fromkeys(regolabili) if not self.is_perc[k]]
+        if not regolabili:
+            raise ValueError("Nessuna voce fissa regolabile selezionata")
+
+        pesi = [self.cent[k] for k in regolabili]
+        fattore_noto = any(pesi)
+        if not fattore_noto:
+            pesi = [_PESO_OBIETTIVO] * len(pesi)
+
+        t0 = self.totale(dict.fromkeys(regolabili, 0))
+        g = self.totale(dict(zip(regolabili, pesi))) - t0
+        if g == 0:
+            raise ValueError("Le voci regolabili non incidono sul totale")
+        fattore = Fraction(obiettivo - t0, g)
+        if fattore < 0:
+            raise ValueError(
+                "Le voci non regolabili superano già l'obiettivo "
+                f"(€ {formatta_cent(t0)})"
+            )
+
+        importi = {k: _arrotonda(fattore * w) for k, w in zip(regolabili, pesi)}
+        totale = self.totale(importi)
+
+        if totale != obiettivo:
+            importi, totale = self._correggi(obiettivo, importi, totale, regolabili)
+
+        return importi, totale, (float(fattore) if fattore_noto else None)
+
+    def _correggi(self, obiettivo, importi, totale, regolabili):
+        """Assorbe lo scarto dovuto agli arrotondamenti: pendenza misurata e
+        ricerca locale sulle due voci regolabili maggiori, poi singoli
+        centesimi sulle successive"""
+        # Prima le voci fuori dal montante: un centesimo in più non sposta
+        # gli arrotondamenti delle voci a percentuale
+        ordine = sorted(regolabili, key=lambda k: (self.f_mont[k], -abs(importi[k])))
+        k1 = ordine[0]
+
+        # Pendenza del totale rispetto alla voce maggiore, misurata su 100 €
+        prova = dict(importi)
+        prova[k1] += 10000
+        pendenza = Fraction(self.totale(prova) - totale, 10000)
+        if pendenza > 0:
+            for _ in range(3):
+                passo = _arrotonda(Fraction(obiettivo - totale, 1) / pendenza)
+                if not passo or importi[k1] + passo < 0:
+                    break
+                prova = dict(importi)
+                prova[k1] += passo
+                t = self.totale(prova)
+                if abs(obiettivo - t) >= abs(obiettivo - totale):
+                    break
+                importi, totale = prova, t
+                if totale == obiettivo:
+                    return importi, totale
+
+        # Ricerca locale sulle due voci maggiori (prima gli scostamenti minori)
+        r = _RAGGIO_OBIETTIVO
+        k2 = ordine[1] if len(ordine) > 1 else None
+        passi = [(d1, d2) for d1 in range(-r, r + 1)
+                 for d2 in (range(-r, r + 1) if k2 is not None else (0,))]
+        passi.sort(key=lambda p: abs(p[0]) + abs(p[1]))
+
+        migliore = (importi, totale)
+        for d1, d2 in passi[1:]:
+            prova = dict(importi)
+            prova[k1] += d1
+            if k2 is not None:
+                prova[k2] += d2
+            if prova[k1] < 0 or (k2 is not None and prova[k2] < 0):
+                continue
+            t = self.totale(prova)
+            if t == obiettivo:
+                return prova, t
+            if abs(obiettivo - t) < abs(obiettivo - migliore[1]):
+                migliore = (prova, t)
+
+        # Ultimi centesimi: un centesimo alla volta sulle altre voci regolabili
+        importi, totale = migliore
+        for k in ordine[2:_VOCI_CORREZIONE]:
+            for d in range(-r, r + 1):
+                if not d or importi[k] + d < 0:
+                    continue
+                prova = dict(importi)
+                prova[k] += d
+                t = self.totale(prova)
+                if abs(obiettivo - t) < abs(obiettivo - totale):
+                    importi, totale = prova, t
+                    break
+            if totale == obiettivo:
+                break
+        return importi, totale
+
+
+def _arrotonda(x):
+    """Fraction -> intero, metà lontano da zero (come quota)"""
+    n, d = x.numerator, x.denominator
+    q = (2 * abs(n) + d) // (2 * d)
+    return q if n >= 0 else -q
+
+
+# =============================================================================
+# SCENARI WHAT-IF
+# =============================================================================
+# Uno scenario è un dict di variazioni rispetto al QE salvato (tutte opzionali):
+#   ribasso   ribasso d'asta (%) sulle voci fisse soggette a ribasso
+#   iva       nuova aliquota IVA (%) per tutte le voci con IVA, oppure
+#             dict {aliquota attuale: nuova aliquota}
+#   montante  montante imposto (centesimi) al posto di quello delle voci
+#   nome      etichetta (se assente è costruita dai parametri)
+# Gli scenari sono valutati in memoria: le voci non vengono modificate.
+
+# Elementi (scenari x voci) per blocco nel calcolo vettoriale
+BLOCCO_SCENARI = 2000000
+
+
+class CalcoloScenari:
+    """Totali (in centesimi) di un elenco di scenari: una posizione per scenario"""
+
+    __slots__ = (
+        "scenari", "montante", "tot_sec1", "tot_sec2_imp",
+        "tot_oneri", "tot_iva", "tot_tasse", "totale"
+    )
+
+    def __init__(self, scenari):
+        self.scenari = scenari
+        self.montante = []
+        self.tot_sec1 = []
+        self.tot_sec2_imp = []
+        self.tot_oneri = []
+        self.tot_iva = []
+        self.tot_tasse = []
+        self.totale = []
+
+    def aggiungi(self, montante, tot_sec1, tot_sec2_imp, tot_oneri, tot_iva):
+        self.montante.append(montante)
+        self.tot_sec1.append(tot_sec1)
+        self.tot_sec2_imp.append(tot_sec2_imp)
+        self.tot_oneri.append(tot_oneri)
+        self.tot_iva.append(tot_iva)
+        self.tot_tasse.append(tot_oneri + tot_iva)
+        self.totale.append(tot_sec1 + tot_sec2_imp + tot_oneri + tot_iva)
+
+    def tabella(self, riferimento=0, budget=None):
+        """Tabella di confronto: una riga per scenario.
+
+        Righe (nome, montante, imponibile, imposte, totale, differenza,
+        economie) in centesimi; differenza rispetto a riferimento (di norma
+        il totale del QE salvato), economie None se budget non è noto.
+        """
+        righe = []
+        for k, sc in enumerate(self.scenari):
+            tot = self.totale[k]
+            righe.append((
+                nome_scenario(sc),
+                self.montante[k],
+                self.tot_sec1[k] + self.tot_sec2_imp[k],
+                self.tot_tasse[k],
+                tot,
+                tot - riferimento,
+                None if budget is None else budget - tot
+            ))
+        return righe
+
+
+def _perc_it(p):
+    return f"{float(p):g}".replace(".", ",") + "%"
+
+
+def nome_scenario(sc):
+    """Etichetta leggibile di uno scenario"""
+    if sc.get("nome"):
+        return sc["nome"]
+    parti = []
+    if sc.get("ribasso") is not None:
+        parti.append(f"Ribasso {_perc_it(sc['ribasso'])}")
+    iva = sc.get("iva")
+    if isinstance(iva, dict):
+        parti.append("IVA " + ", ".join(f"{_perc_it(a)} → {_perc_it(b)}" for a, b in iva.items()))
+    elif iva is not None:
+        parti.append(f"IVA {_perc_it(iva)}")
+    if sc.get("montante") is not None:
+        parti.append(f"Montante € {formatta_cent(sc['montante'])}")
+    return " · ".join(parti) if parti else "QE attuale"
+
+
+def _iva_scenario(perc_iva, iva):
+    """Aliquote IVA di uno scenario (lista, percorso Python)"""
+    if iva is None:
+        return perc_iva
+    if isinstance(iva, dict):
+        nuove = {aliquota(a): float(b) for a, b in iva.items()}
+        return [nuove.get(aliquota(p), p) for p in perc_iva]
+    return [float(iva) if p else 0.0 for p in perc_iva]
+
+
+def calcola_scenari(rows, scenari, backend=None):
+    """Valuta in un solo passaggio una serie di scenari what-if su un QE.
+
+    rows: voci del QE (Voce, come get_voci_by_qe); scenari: lista di dict (vedi
+    sopra). Le voci non vengono modificate. Restituisce CalcoloScenari.
+    backend: None (automatico), "python" o "numpy".
+    """
+    scenari = [dict(sc) for sc in scenari]
+    n = len(rows)
+    col = [_colonna(rows, k) for k in CAMPI_VOCI]
+    valore = _num(col[0], n)
+    is_perc = _flag(col[1], n)
+    perc_oneri = _num(col[2], n)
+    inc_iva = _flag(col[3], n)
+    perc_iva = _num(col[4], n)
+    base_asta = _flag(col[5], n)
+    f_mont = _flag(col[6], n)
+    cent = _importi(valore, is_perc, col[7])
+    ribasso = _flag(_colonna(rows, CAMPO_RIBASSO), n)
+
+    grafo = None
+    basi = _colonna(rows, CAMPI_BASI[2])
+    if basi is not None and any(basi):
+        grafo = GrafoBasi.da_colonne(_colonna(rows, CAMPI_BASI[0]), _colonna(rows, CAMPI_BASI[1]),
+                                     base_asta, is_perc, basi)
+
+    args = (valore, is_perc, perc_oneri, inc_iva, perc_iva, base_asta, f_mont, cent,
+            ribasso, grafo, scenari)
+
+    if backend is None:
+        backend = "numpy" if (np is not None and n * len(scenari) >= SOGLIA_NUMPY) else "python"
+
+    if backend == "numpy":
+        if np is None:
+            raise RuntimeError("Backend NumPy richiesto ma NumPy non è installato")
+        ris = _scenari_numpy(*args)
+        if ris is not None:
+            return ris
+    return _scenari_python(*args)
+
+
+def _scenari_python(valore, is_perc, perc_oneri, inc_iva, perc_iva, base_asta, f_mont,
+                    cent, ribasso, grafo, scenari):
+    ris = CalcoloScenari(scenari)
+    for sc in scenari:
+        rib = sc.get("ribasso")
+        c = cent
+        if rib:
+            c = [x - quota(x, rib) if r and not p else x
+                 for x, r, p in zip(cent, ribasso, is_perc)]
+        pi = _iva_scenario(perc_iva, sc.get("iva"))
+
+        calc = _calcola_python(valore, is_perc, perc_oneri, inc_iva, pi, base_asta,
+                               f_mont, c, sc.get("montante"))
+        if grafo is not None:
+            applica_basi(calc, grafo, valore, is_perc, perc_oneri, inc_iva, pi, base_asta)
+        ris.aggiungi(calc.montante, calc.tot_sec1, calc.tot_sec2_imp, calc.tot_oneri, calc.tot_iva)
+    return ris
+
+
+def _entro_int64(x, fattore):
+    """True se i prodotti/somme di x per fattore restano negli int64"""
+    return not x.size or int(np.abs(x).max()) * max(fattore, 1) < 2 ** 62
+
+
+def _iva_scenario_numpy(ai, iva):
+    """Aliquote IVA scalate di uno scenario (riga di int64)"""
+    if iva is None:
+        return ai
+    if isinstance(iva, dict):
+        nuove = ai.copy()
+        for a, b in iva.items():
+            nuove[ai == aliquota(a)] = aliquota(b)
+        return nuove
+    return np.where(ai != 0, aliquota(iva), 0)
+
+
+def _scenari_numpy(valore, is_perc, perc_oneri, inc_iva, perc_iva, base_asta, f_mont,
+                   cent, ribasso, grafo, scenari):
+    """Scenari x voci in matrici int64 (a blocchi di BLOCCO_SCENARI elementi);
+    None se un prodotto potrebbe traboccare (si ripiega sul percorso Python)"""
+    n = len(cent)
+    p = np.asarray(is_perc, dtype=bool)
+    c0 = np.asarray(cent, dtype=np.int64)
+    inc = np.asarray(inc_iva, dtype=bool)
+    b = np.asarray(base_asta, dtype=bool)
+    m = np.asarray(f_mont, dtype=bool) & ~p
+    rb = np.asarray(ribasso, dtype=bool) & ~p
+    av = np.where(p, _aliquote_numpy(valore), 0)  # valore è un'aliquota solo per le voci a percentuale
+    ao = _aliquote_numpy(perc_oneri)
+    ai0 = _aliquote_numpy(perc_iva)
+    lim = max(n, 1)
+
+    ris = CalcoloScenari(scenari)
+    passo = max(1, BLOCCO_SCENARI // lim)
+    for inizio in range(0, len(scenari), passo):
+        blocco = scenari[inizio:inizio + passo]
+
+        rr = np.array([aliquota(sc.get("ribasso")) for sc in blocco], dtype=np.int64)[:, None]
+        ai = np.vstack([_iva_scenario_numpy(ai0, sc.get("iva")) for sc in blocco])
+        if not _entro_int64(c0, int(np.abs(rr).max()) + lim):
+            return None
+        c = np.where(rb, c0 - _quota_numpy(c0, rr), c0)
+
+        mont = c[:, m].sum(axis=1)
+        for k, sc in enumerate(blocco):
+            if sc.get("montante") is not None:
+                mont[k] = sc["montante"]
+        if not _entro_int64(mont, int(np.abs(av).max(initial=0)) + lim):
+            return None
+        imp = np.where(p, _quota_numpy(mont[:, None], av), c)
+
+        if grafo is not None:
+            for k in grafo.ordine:
+                base = imp[:, list(grafo.dip[k])].sum(axis=1)
+                if not _entro_int64(base, abs(int(av[k])) + lim):
+                    return None
+                imp[:, k] = _quota_numpy(base, av[k])
+            for k in grafo.bloccate:
+                imp[:, k] = 0
+
+        a_max = max(int(np.abs(ao).max(initial=0)), int(np.abs(ai).max(initial=0)))
+        if not _entro_int64(imp, (a_max // _DIV_QUOTA + 2) * (a_max + lim)):
+            return None
+        one = _quota_numpy(imp, ao)
+        iva = _quota_numpy(np.where(inc, imp + one, imp), ai)
+
+        for k in range(len(blocco)):
+            ris.aggiungi(int(mont[k]), int(imp[k, b].sum()), int(imp[k, ~b].sum()),
+                         int(one[k].sum()), int(iva[k].sum()))
+    return ris
+
+
+# =============================================================================
+# MICRO-BENCHMARK (python qe_calcolo.py [numero_voci])
+# =============================================================================
+def _fmt_legacy(v):
+    # Formattazione precedente: f-string + tre replace a ogni cella
+    return f"{v:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
+
+
+def benchmark(n=50000, ripetizioni=3):
+    """Confronta calcolo e formattazione su un QE sintetico di n voci"""
+    import random
+    import time
+    import tracemalloc
+
+    rnd = random.Random(1)
+    tuple_voci = []
+    for i in range(n):
+        perc = rnd.random() < 0.1
+        valore = rnd.choice((2.0, 2.5, 5.0, 10.0)) if perc else rnd.randint(0, 5000000) / 100
+        tuple_voci.append((i, 1, "A", f"A.{i:05d}", f"Voce {i}", "fisso", valore, int(perc),
+                           rnd.choice((0, 4)), rnd.choice((0, 1)), rnd.choice((0, 10, 22)),
+                           rnd.choice((0, 1)), 0, "", rnd.choice((0, 1)),
+                           None if perc else centesimi(valore)))
+
+    def memoria(f):
+        tracemalloc.start()
+        x = f()
+        byte = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del x
+        return byte / n
+
+    # Memoria per voce delle righe lette da SQLite (ogni riga ha i propri
+    # oggetti float e str, come in get_voci_by_qe)
+    import sqlite3
+    from qe_database import DatabaseManager
+
+    conn = sqlite3.connect(":memory:")
+    DatabaseManager.su_connessione(conn).crea_tabelle()  # tipi delle colonne reali
+    conn.executemany(
+        f"INSERT INTO voci ({', '.join(Voce.CAMPI)}) "
+        f"VALUES ({', '.join('?' * len(Voce.CAMPI))})", tuple_voci
+    )
+    sql = f"SELECT {', '.join(Voce.CAMPI)} FROM voci"
+
+    def leggi():
+        return conn.execute(sql).fetchall()
+
+    m_tuple = memoria(leggi)
+    m_voce = memoria(lambda: [Voce(*r) for r in leggi()])
+    m_condivisi = memoria(lambda: DatabaseManager._crea_voci(DatabaseManager, leggi()))
+    conn.close()
+    rows = [Voce(*r) for r in tuple_voci]
+
+    def misura(f):
+        migliore = None
+        for _ in range(ripetizioni):
+            t0 = time.perf_counter()
+            f()
+            dt = time.perf_counter() - t0
+            migliore = dt if migliore is None else min(migliore, dt)
+        return migliore
+
+    t_calc = misura(lambda: calcola_voci(rows))
+    calc = calcola_voci(rows)
+    colonne = (calc.imp, calc.one, calc.iva, calc.tot)
+    colonne_euro = [[euro(c) for c in col] for col in colonne]
+
+    t_legacy = misura(lambda: [[_fmt_legacy(v) for v in col] for col in colonne_euro])
+
+    def refresh():
+        return [formatta_colonna(col) for col in colonne]
+
+    def svuota():
+        _cache_formato.clear()
+        _colonne_recenti.clear()
+
+    def primo_refresh():
+        svuota()
+        return refresh()
+
+    def secondo_refresh():
+        svuota()
+        refresh()
+        t0 = time.perf_counter()
+        refresh()
+        return time.perf_counter() - t0
+
+    t_freddo = misura(primo_refresh)
+    t_secondo = min(secondo_refresh() for _ in range(ripetizioni))
+    t_caldo = misura(refresh)
+
+    scenari = [{"ribasso": r / 2, "iva": (None, 10, 22)[r % 3]} for r in range(300)]
+    t_scen = misura(lambda: calcola_scenari(rows[:500], scenari))
+
+    celle = n * len(colonne)
+    print(f"QE sintetico: {n} voci, {celle} celle importo (NumPy: {'sì' if np else 'no'})")
+    print(f"  calcolo QE (centesimi)               {t_calc * 1000:8.1f} ms")
+    print(f"  fmt() precedente, cella per cella    {t_legacy * 1000:8.1f} ms")
+    print(f"  formatta_colonna, primo refresh      {t_freddo * 1000:8.1f} ms  x{t_legacy / t_freddo:.1f}")
+    print(f"  formatta_colonna, secondo refresh    {t_secondo * 1000:8.1f} ms  x{t_legacy / t_secondo:.1f}")
+    print(f"  formatta_colonna, refresh successivi {t_caldo * 1000:8.1f} ms  x{t_legacy / t_caldo:.1f}")
+    print(f"  300 scenari what-if su {min(n, 500)} voci     {t_scen * 1000:8.1f} ms")
+    print(f"  memoria per voce: tuple {m_tuple:.0f} byte, Voce {m_voce:.0f} byte, "
+          f"Voce con valori condivisi (_crea_voci) {m_condivisi:.0f} byte")
+    return t_legacy, t_freddo, t_caldo
+
+
+if __name__ == "__main__":
+    import sys
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 50000)
@@ -0,0 +1,2451 @@
+# QE Zero - Database dei Quadri Economici
+# Modulo condiviso tra interfaccia grafica e riga di comando (senza tkinter)
+#
+# Copyright (C) 2025 Rodolfo Sabelli
+#
+# Questo programma è software libero: puoi ridistribuirlo e/o modificarlo
+# secondo i termini della GNU General Public License versione 3 o della
+# European Union Public License versione 1.2 (a tua scelta).
+#
+# Questo programma è distribuito nella speranza che sia utile,
+# ma SENZA ALCUNA GARANZIA; senza neppure la garanzia implicita di
+# COMMERCIABILITÀ o IDONEITÀ PER UN PARTICOLARE SCOPO.
+#
+# Vedi LICENSE.txt per il testo completo delle licenze.
+#
+# Contatti: rodolfo.sabelli@gmail.com
+# Repository: [URL GITHUB/GITLAB]
+
+import sqlite3
+import contextlib
+import datetime
+import hashlib
+import lzma
+import mmap
+import os
+import re
+import sys
+import tempfile
+import time
+import zlib
+
+from qe_calcolo import calcola_voci, centesimi, euro, SCALA_ALIQUOTE, ha_base_propria, Voce
+
+
+# =============================================================================
+# CONNESSIONI (CONDIVISE CON IL TOOLKIT)
+# =============================================================================
+# QE Zero e il Toolkit possono lavorare sullo stesso database nello stesso
+# momento: in modalità WAL i lettori non bloccano lo scrittore, e un
+# eventuale lock breve viene atteso (busy_timeout) invece di fallire subito
+# con "database is locked".
+ATTESA_LOCK_MS = 5000
+CACHE_PAGINE_KIB = 16384  # Cache delle pagine per connessione (16 MiB)
+
+
+def connetti(db_path):
+    """Apre una connessione al database con le impostazioni comuni:
+    WAL, synchronous=NORMAL (sicuro in WAL), attesa dei lock, cache ampliata
+    e chiavi esterne attive"""
+    conn = sqlite3.connect(db_path, timeout=ATTESA_LOCK_MS / 1000)
+    try:
+        # Persistente nel file: basta che riesca una volta. Fallisce se un
+        # programma di versione precedente tiene aperto il DB in modalità rollback
+        conn.execute("PRAGMA journal_mode = WAL")
+    except sqlite3.OperationalError as e:
+        print(f"Modalità WAL non attivata: {e}")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(f"PRAGMA busy_timeout = {ATTESA_LOCK_MS}")
+    conn.execute(f"PRAGMA cache_size = -{CACHE_PAGINE_KIB}")
+    conn.execute("PRAGMA foreign_keys = 1")
+    return conn
+
+
+# Gli allegati (BLOB dei PDF) stanno in un file separato collegato con ATTACH:
+# il database principale resta piccolo e veloce da copiare e compattare
+SCHEMA_ALLEGATI = "allegati"
+
+
+def percorso_allegati(db_path):
+    """File degli allegati di un database: qe_allegati.db accanto a
+    qe_zero.db, <nome>_allegati.db accanto agli altri (backup, copie)"""
+    cartella, nome = os.path.split(db_path)
+    if nome == "qe_zero.db":
+        return os.path.join(cartella, "qe_allegati.db")
+    radice, estensione = os.path.splitext(nome)
+    return os.path.join(cartella, f"{radice}_allegati{estensione or '.db'}")
+
+
+def cartella_archivio(db_path):
+    """Cartella dell'archivio allegati su file di un database, legata al suo
+    file degli allegati: QE_DATI/allegati per qe_zero.db, <nome>_allegati
+    accanto agli altri (un backup aperto non vede i file del principale)"""
+    file_allegati = percorso_allegati(db_path)
+    cartella, nome = os.path.split(file_allegati)
+    if nome == "qe_allegati.db":
+        return os.path.join(cartella, "allegati")
+    return os.path.splitext(file_allegati)[0]
+
+
+# Compressione facoltativa degli allegati (configurazione "allegati_compressione"):
+# codec -> (compressore, decompressore), oggetti a blocchi della libreria standard
+COMPRESSORI = {
+    "zlib": (zlib.compressobj, zlib.decompressobj),
+    "lzma": (lzma.LZMACompressor, lzma.LZMADecompressor),
+}
+
+
+def decomprimi(codec, blocchi, dimensione, blocco=1 << 20):
+    """Genera il contenuto decompresso dei blocchi, al più blocco byte per
+    volta: un dato danneggiato o malevolo non può espandersi oltre la
+    dimensione registrata (ValueError se la supera o non la raggiunge)"""
+    d = COMPRESSORI[codec][1]()
+    fatti = 0
+    for dati in blocchi:
+        while True:
+            uscita = d.decompress(dati, blocco)
+            fatti += len(uscita)
+            if fatti > dimensione:
+                raise ValueError(f"contenuto {codec} oltre la dimensione registrata ({dimensione} byte)")
+            if uscita:
+                yield uscita
+            if codec == "zlib":
+                # Ingresso non ancora consumato perché l'uscita era piena
+                dati = d.unconsumed_tail
+                if not dati:
+                    break
+            else:
+                # needs_input falso: il decompressore ha altra uscita pronta
+                if d.eof or d.needs_input:
+                    break
+                dati = b""
+    if codec == "zlib":
+        uscita = d.flush(blocco)
+        fatti += len(uscita)
+        if uscita and fatti <= dimensione:
+            yield uscita
+    if fatti != dimensione:
+        raise ValueError(f"contenuto {codec} di {fatti} byte invece di {dimensione}")
+
+
+# Oggetti pagina di un PDF e inizio dei flussi (stream) in cui possono
+# stare, compressi, dal PDF 1.5 in poi (object stream)
+PDF_PAGINA = re.compile(rb"/Type\s*/Page(?![A-Za-z])")
+PDF_FLUSSO = re.compile(rb"stream\r?\n")
+
+
+def conta_pagine_pdf(dati, blocco=1 << 20):
+    """Pagine di un PDF (bytes o mmap) contando gli oggetti /Type /Page, anche
+    negli object stream compressi con FlateDecode; 0 se non è un PDF o se le
+    pagine non si trovano"""
+    if dati[:5] != b"%PDF-":
+        return 0
+    pagine = sum(1 for _ in PDF_PAGINA.finditer(dati))
+    for m in PDF_FLUSSO.finditer(dati):
+        # Dizionario del flusso: dall'ultimo "obj" prima di "stream"
+        testa = dati[max(0, m.start() - 512):m.start()]
+        testa = testa[testa.rfind(b"obj"):]
+        if b"/ObjStm" not in testa or b"/FlateDecode" not in testa:
+            continue
+        d = zlib.decompressobj()
+        inizio = m.end()
+        try:
+            while not d.eof and inizio < len(dati):
+                pagine += sum(1 for _ in PDF_PAGINA.finditer(
+                    d.decompress(dati[inizio:inizio + blocco])))
+                inizio += blocco
+        except zlib.error:
+            continue
+    return pagine
+
+
+def analizza_file(percorso, blocco=1 << 20):
+    """(SHA-256 esadecimale, pagine con conta_pagine_pdf) di un file, letto a
+    blocchi per l'impronta e attraverso mmap per le pagine"""
+    h = hashlib.sha256()
+    with open(percorso, "rb") as f:
+        for dati in iter(lambda: f.read(blocco), b""):
+            h.update(dati)
+        if os.fstat(f.fileno()).st_size == 0:
+            return h.hexdigest(), 0  # mmap non accetta file vuoti
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return h.hexdigest(), conta_pagine_pdf(mm, blocco)
+
+
+def chiudi(conn):
+    """Chiude una connessione aperta con connetti(): aggiorna le statistiche
+    del planner e riporta nel file principale il WAL (senza attendere gli
+    altri programmi eventualmente collegati)"""
+    try:
+        conn.commit()
+        conn.execute("PRAGMA optimize")
+        conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+    except sqlite3.Error as e:
+        print(f"Checkpoint alla chiusura non riuscito: {e}")
+    finally:
+        conn.close()
+
+
+class CaricamentoAnnullato(Exception):
+    """Caricamento di più allegati interrotto: nessun file è stato aggiunto"""
+
+
+class BackupAnnullato(Exception):
+    """Backup interrotto: i file incompleti sono stati rimossi"""
+
+
+# =============================================================================
+# DATABASE MANAGER
+# =============================================================================
+class DatabaseManager:
+    def __init__(self, db_name="qe_zero.db"):
+        """Inizializza il database manager con percorsi ottimizzati"""
+        # PATH LOGIC OTTIMIZZATA
+        program_dir = os.path.dirname(os.path.abspath(__file__))
+        local_path = os.path.join(program_dir, "QE_DATI")
+
+        # Modalità Portable: cartella locale ha priorità
+        if os.path.exists(local_path):
+            self.documents_path = local_path
+            # NUOVO: Se siamo in portable, la cartella stampe sta nella directory del programma
+            # Risultato: .../QE_ZERO/QE_STAMPE
+            self.stampe_path = os.path.join(program_dir, "QE_STAMPE")
+        else:
+            # Modalità Standard: cartella in Documenti utente
+            base_docs = os.path.expanduser("~/Documents")
+            self.documents_path = os.path.join(base_docs, "QE_DATI")
+            
+            # NUOVO: Se siamo in standard, la cartella stampe sta in Documenti
+            # Risultato: ~/Documents/QE_STAMPE (accanto a QE_DATI)
+            self.stampe_path = os.path.join(base_docs, "QE_STAMPE")
+            
+            # Creazione cartella DATI: l'eventuale OSError risale al chiamante
+            # (la GUI lo mostra in una finestra, la riga di comando lo stampa)
+            if not os.path.exists(self.documents_path):
+                os.makedirs(self.documents_path)
+
+        # --- NUOVO CODICE AGGIUNTO: CREAZIONE CARTELLA STAMPE ---
+        # Questo blocco viene eseguito a prescindere dalla modalità (Portable o Standard)
+        # Verifica se QE_STAMPE esiste, altrimenti la crea
+        if not os.path.exists(self.stampe_path):
+            try:
+                os.makedirs(self.stampe_path)
+            except OSError as e:
+                # Gestione errore non bloccante (puoi cambiare in messagebox se preferisci)
+                print(f"Errore nella creazione della cartella stampe: {e}")
+        # --------------------------------------------------------
+
+        self.db_path = os.path.join(self.documents_path, db_name)   
+        self.conn = connetti(self.db_path)
+        self.aggiorna_schema()
+
+    @classmethod
+    def su_file(cls, db_path):
+        """DatabaseManager su una nuova connessione a db_path, per il lavoro in
+        un altro thread: va creato, usato e chiuso in quel thread"""
+        return cls.su_connessione(connetti(db_path))
+
+    @classmethod
+    def su_connessione(cls, conn):
+        """DatabaseManager su una connessione già aperta, senza percorsi né
+        cartelle (usato dal Toolkit per aggiornare lo schema)"""
+        db = cls.__new__(cls)
+        db.conn = conn
+        return db
+
+    # Passi di migrazione in ordine di applicazione: PRAGMA user_version
+    # conta quelli già eseguiti. I passi nuovi si aggiungono solo in coda.
+    # I DB precedenti al registro (user_version 0) possono avere già applicato
+    # una parte dei primi passi: per questo quei passi verificano lo schema.
+    MIGRAZIONI = (
+        "crea_tabelle",
+        "check_aggiornamento_db_allegati",
+        "migra_db_1_3",
+        "migra_importi_cent",
+        "migra_qe_totali",
+        "migra_fpv",
+        "migra_indici",
+        "popola_dati_base",
+        "popola_demo_se_vuoto",
+        "migra_indice_voci_percentuale",
+        "migra_allegati_file",
+        "migra_allegati_contenuti",
+        "migra_trigger_centesimi",
+        "migra_trigger_solo_sql",
+    )
+
+    def aggiorna_schema(self):
+        """Applica i passi di MIGRAZIONI non ancora eseguiti, ciascuno una sola
+        volta nella propria transazione insieme all'aggiornamento di user_version.
+
+        Su un DB già aggiornato costa una sola lettura di PRAGMA user_version.
+        """
+        versione = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        if versione >= len(self.MIGRAZIONI):
+            return
+
+        self.conn.commit()
+        while True:
+            # BEGIN IMMEDIATE: se QE Zero e Toolkit aprono insieme un DB da
+            # migrare, il secondo attende il primo e rilegge la versione
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                versione = self.conn.execute("PRAGMA user_version").fetchone()[0]
+                if versione >= len(self.MIGRAZIONI):
+                    self.conn.commit()
+                    break
+                getattr(self, self.MIGRAZIONI[versione])()
+                self.conn.execute(f"PRAGMA user_version = {versione + 1}")
+                self.conn.commit()
+            except BaseException:
+                self.conn.rollback()
+                raise
+
+        for schema in self._da_compattare:
+            # Fuori transazione: restituisce al disco lo spazio liberato (in WAL
+            # il file si riduce solo dopo il checkpoint)
+            self.conn.execute(f"VACUUM {schema}")
+            self.conn.execute(f"PRAGMA {schema}.wal_checkpoint(TRUNCATE)")
+        self._da_compattare = ()
+
+    # Schemi (main, allegati) in cui i passi hanno liberato molto spazio
+    _da_compattare = ()
+
+    def crea_tabelle(self):
+        """Crea tutte le tabelle del database con schema ottimizzato"""
+        c = self.conn.cursor()
+        
+        # Tabella normative
+        c.execute('''CREATE TABLE IF NOT EXISTS normative (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, 
+            nome TEXT UNIQUE, 
+            descrizione TEXT
+        )''')
+        
+        # Tabella progetti
+        c.execute('''CREATE TABLE IF NOT EXISTS progetti (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, 
+            normativa_id INTEGER, 
+            cup TEXT, 
+            anno INTEGER, 
+            titolo TEXT, 
+            importo REAL, 
+            importo_cent INTEGER, 
+            FOREIGN KEY (normativa_id) REFERENCES normative (id)
+        )''')
+        
+        # Tabella quadri economici
+        c.execute('''CREATE TABLE IF NOT EXISTS quadri_economici (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, 
+            progetto_id INTEGER, 
+            nome_versione TEXT, 
+            data_creazione TEXT, 
+            note TEXT, 
+            FOREIGN KEY (progetto_id) REFERENCES progetti (id) ON DELETE CASCADE
+        )''')
+        
+        # Tabella voci (include flag_calcolo_montante)
+        c.execute('''CREATE TABLE IF NOT EXISTS voci (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, 
+            qe_id INTEGER, 
+            codice_padre TEXT, 
+            codice_completo TEXT, 
+            descrizione TEXT, 
+            tipo TEXT, 
+            valore_imponibile REAL, 
+            is_percentuale INTEGER, 
+            perc_oneri REAL, 
+            includi_oneri_in_iva INTEGER, 
+            perc_iva REAL, 
+            flag_base_asta INTEGER, 
+            flag_soggetto_ribasso INTEGER, 
+            macro_base_calcolo TEXT, 
+            flag_calcolo_montante INTEGER DEFAULT 0, 
+            importo_cent INTEGER, 
+            FOREIGN KEY (qe_id) REFERENCES quadri_economici (id) ON DELETE CASCADE
+        )''')
+        
+        # Tabella catalogo voci
+        c.execute('''CREATE TABLE IF NOT EXISTS catalogo_voci (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, 
+            normativa_id INTEGER, 
+            codice TEXT, 
+            macro_gruppo INTEGER, 
+            descrizione TEXT, 
+            UNIQUE(normativa_id, codice), 
+            FOREIGN KEY (normativa_id) REFERENCES normative (id) ON DELETE CASCADE
+        )''')
+        
+        # Tabella configurazione
+        c.execute('''CREATE TABLE IF NOT EXISTS configurazione (
+            chiave TEXT PRIMARY KEY, 
+            valore TEXT
+        )''')
+        
+        # Tabella allegati (include descrizione)
+        c.execute('''CREATE TABLE IF NOT EXISTS allegati_qe (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, 
+            qe_id INTEGER, 
+            nome_file TEXT, 
+            tipo_file TEXT, 
+            dati BLOB, 
+            data_caricamento TEXT,
+            descrizione TEXT DEFAULT '',
+            FOREIGN KEY (qe_id) REFERENCES quadri_economici (id) ON DELETE CASCADE
+        )''')
+        
+
+    def check_aggiornamento_db_allegati(self):
+        """Migrazione: aggiunge colonna descrizione a tabella allegati se mancante"""
+        try:
+            self.conn.execute("SELECT descrizione FROM allegati_qe LIMIT 1")
+        except sqlite3.OperationalError:
+            try:
+                self.conn.execute("ALTER TABLE allegati_qe ADD COLUMN descrizione TEXT DEFAULT ''")
+                print("✓ Migrazione allegati: colonna 'descrizione' aggiunta")
+            except sqlite3.OperationalError:
+                pass  # Colonna già esistente
+    
+    def migra_db_1_3(self):
+        """Migrazione v1.3: aggiunge flag_calcolo_montante per DB legacy"""
+        try:
+            self.conn.execute("SELECT flag_calcolo_montante FROM voci LIMIT 1")
+        except sqlite3.OperationalError:
+            try:
+                self.conn.execute("ALTER TABLE voci ADD COLUMN flag_calcolo_montante INTEGER DEFAULT 0")
+                print("✓ Migrazione v1.3: colonna 'flag_calcolo_montante' aggiunta")
+            except sqlite3.OperationalError:
+                pass  # Colonna già esistente
+
+    def migra_importi_cent(self):
+        """Migrazione: importi in centesimi interi (colonne INTEGER importo_cent).
+
+        Le colonne REAL (valore_imponibile, importo) restano per compatibilità
+        con le versioni precedenti; i calcoli usano solo le colonne in centesimi.
+        """
+        self.conn.create_function("centesimi", 1, centesimi, deterministic=True)
+
+        for tabella, colonna, filtro in (
+            ("voci", "valore_imponibile", "is_percentuale IS NOT 1"),
+            ("progetti", "importo", "1"),
+        ):
+            try:
+                self.conn.execute(f"SELECT importo_cent FROM {tabella} LIMIT 1")
+            except sqlite3.OperationalError:
+                self.conn.execute(f"ALTER TABLE {tabella} ADD COLUMN importo_cent INTEGER")
+                self.conn.execute(
+                    f"UPDATE {tabella} SET importo_cent = centesimi({colonna}) WHERE {filtro}"
+                )
+                print(f"✓ Migrazione: colonna '{tabella}.importo_cent' aggiunta e popolata")
+
+    @staticmethod
+    def _sql_quota(base, perc):
+        """Espressione SQL equivalente a qe_calcolo.quota(): perc% di base
+        (centesimi) arrotondata al centesimo, metà lontano da zero"""
+        n = f"(({base}) * CAST(ROUND(COALESCE({perc}, 0) * {SCALA_ALIQUOTE}) AS INTEGER))"
+        d = 100 * SCALA_ALIQUOTE
+        return f"(CASE WHEN {n} < 0 THEN ({n} - {d // 2}) / {d} ELSE ({n} + {d // 2}) / {d} END)"
+
+    @staticmethod
+    def _sql_centesimi(valore):
+        """Espressione SQL equivalente a qe_calcolo.centesimi() per un importo
+        REAL: ROUND a 2 decimali (decimale, metà lontano da zero) prima di
+        scalare, così 1.005 dà 101 centesimi e non 100 come ROUND(x * 100).
+        Solo SQL: i trigger devono funzionare da qualunque connessione"""
+        return f"CAST(ROUND(ROUND(COALESCE({valore}, 0), 2) * 100) AS INTEGER)"
+
+    def _sql_contributo(self, x):
+        """Contributi della voce fissa x ('NEW', 'OLD' o alias) agli accumulatori"""
+        c = f"COALESCE({x}.importo_cent, {self._sql_centesimi(f'{x}.valore_imponibile')})"
+        one = self._sql_quota(c, f"{x}.perc_oneri")
+        iva = self._sql_quota(
+            f"CASE WHEN {x}.includi_oneri_in_iva = 1 THEN {c} + {one} ELSE {c} END",
+            f"{x}.perc_iva"
+        )
+        fissa = f"{x}.is_percentuale IS NOT 1"
+        return {
+            "montante": f"CASE WHEN {fissa} AND {x}.flag_calcolo_montante = 1 THEN {c} ELSE 0 END",
+            "f_sec1": f"CASE WHEN {fissa} AND {x}.flag_base_asta = 1 THEN {c} ELSE 0 END",
+            "f_sec2": f"CASE WHEN {fissa} AND {x}.flag_base_asta IS NOT 1 THEN {c} ELSE 0 END",
+            "f_one": f"CASE WHEN {fissa} THEN {one} ELSE 0 END",
+            "f_iva": f"CASE WHEN {fissa} THEN {iva} ELSE 0 END",
+        }
+
+    def _sql_percentuali(self, qe_id, montante):
+        """SELECT dei totali (p_sec1, p_sec2, p_one, p_iva) delle voci a percentuale
+        calcolate sul montante.
+
+        Ogni voce è arrotondata al centesimo, quindi questi totali non sono
+        lineari nel montante: si risommano quando il montante cambia. Le voci
+        con base propria (macro_base_calcolo) sono escluse: vedi aggiorna_totali_basi.
+        """
+        imp = self._sql_quota(montante, "v.valore_imponibile")
+        one = self._sql_quota("imp", "po")
+        iva = self._sql_quota("CASE WHEN inc = 1 THEN imp + one ELSE imp END", "pi")
+        return f"""SELECT
+            COALESCE(SUM(CASE WHEN fb = 1 THEN imp ELSE 0 END), 0),
+            COALESCE(SUM(CASE WHEN fb = 1 THEN 0 ELSE imp END), 0),
+            COALESCE(SUM(one), 0),
+            COALESCE(SUM({iva}), 0)
+            FROM (SELECT imp, {one} AS one, inc, pi, fb FROM (
+                SELECT {imp} AS imp, v.perc_oneri AS po, v.includi_oneri_in_iva AS inc,
+                v.perc_iva AS pi, v.flag_base_asta AS fb
+                FROM voci v WHERE v.qe_id = {qe_id} AND v.is_percentuale = 1
+                AND TRIM(COALESCE(v.macro_base_calcolo, '')) = ''))"""
+
+    # Colonne derivate di qe_totali
+    SQL_DERIVA_TOTALI = """
+        tot_sec1 = f_sec1 + p_sec1 + d_sec1,
+        oneri = f_one + p_one + d_one,
+        iva = f_iva + p_iva + d_iva,
+        tot_sec2 = f_sec2 + p_sec2 + d_sec2 + f_one + p_one + d_one + f_iva + p_iva + d_iva,
+        totale = f_sec1 + p_sec1 + d_sec1 + f_sec2 + p_sec2 + d_sec2
+            + f_one + p_one + d_one + f_iva + p_iva + d_iva"""
+
+    def migra_qe_totali(self):
+        """Tabella qe_totali mantenuta dai trigger su voci (totali in centesimi)"""
+        c = self.conn.cursor()
+
+        colonne = {r[1]: r[2] for r in c.execute("PRAGMA table_info(qe_totali)")}
+        if colonne.get("totale") == "REAL":
+            # Layout precedente con importi REAL: si ricostruisce in centesimi
+            for trg in ("qe_ins", "voci_ins", "voci_del", "voci_upd"):
+                c.execute(f"DROP TRIGGER IF EXISTS trg_qe_totali_{trg}")
+            c.execute("DROP TABLE qe_totali")
+            colonne = {}
+        nuova = not colonne
+
+        basi = not nuova and "d_sec1" not in colonne
+        if basi:
+            # Totali delle voci con base propria (d_*): cambiano anche i trigger
+            for trg in ("voci_ins", "voci_del", "voci_upd"):
+                c.execute(f"DROP TRIGGER IF EXISTS trg_qe_totali_{trg}")
+            for col in ("d_sec1", "d_sec2", "d_one", "d_iva"):
+                c.execute(f"ALTER TABLE qe_totali ADD COLUMN {col} INTEGER DEFAULT 0")
+
+        # Accumulatori (f_* voci fisse, aggiornati in O(1); p_* voci a percentuale,
+        # risommati solo quando cambia il montante; d_* voci con base propria,
+        # ricalcolati da aggiorna_totali_basi) e colonne derivate per le liste
+        c.execute('''CREATE TABLE IF NOT EXISTS qe_totali (
+            qe_id INTEGER PRIMARY KEY,
+            montante INTEGER DEFAULT 0,
+            f_sec1 INTEGER DEFAULT 0,
+            f_sec2 INTEGER DEFAULT 0,
+            f_one INTEGER DEFAULT 0,
+            f_iva INTEGER DEFAULT 0,
+            p_sec1 INTEGER DEFAULT 0,
+            p_sec2 INTEGER DEFAULT 0,
+            p_one INTEGER DEFAULT 0,
+            p_iva INTEGER DEFAULT 0,
+            d_sec1 INTEGER DEFAULT 0,
+            d_sec2 INTEGER DEFAULT 0,
+            d_one INTEGER DEFAULT 0,
+            d_iva INTEGER DEFAULT 0,
+            tot_sec1 INTEGER DEFAULT 0,
+            tot_sec2 INTEGER DEFAULT 0,
+            oneri INTEGER DEFAULT 0,
+            iva INTEGER DEFAULT 0,
+            totale INTEGER DEFAULT 0,
+            FOREIGN KEY (qe_id) REFERENCES quadri_economici (id) ON DELETE CASCADE
+        )''')
+
+        def aggiorna(x, segno):
+            contr = self._sql_contributo(x)
+            sets = ", ".join(f"{col} = {col} {segno} ({expr})" for col, expr in contr.items())
+
+            # Voci a percentuale risommate solo se x lo è o se ha spostato il montante
+            perc = self._sql_percentuali(
+                f"{x}.qe_id", f"(SELECT montante FROM qe_totali WHERE qe_id = {x}.qe_id)"
+            )
+            cond = f"{x}.is_percentuale = 1 OR ({contr['montante']}) <> 0"
+
+            return f"""UPDATE qe_totali SET {sets} WHERE qe_id = {x}.qe_id;
+                UPDATE qe_totali SET (p_sec1, p_sec2, p_one, p_iva) = ({perc})
+                WHERE qe_id = {x}.qe_id AND ({cond});
+                UPDATE qe_totali SET {self.SQL_DERIVA_TOTALI} WHERE qe_id = {x}.qe_id;"""
+
+        c.execute("""CREATE TRIGGER IF NOT EXISTS trg_qe_totali_qe_ins
+            AFTER INSERT ON quadri_economici BEGIN
+            INSERT OR IGNORE INTO qe_totali (qe_id) VALUES (NEW.id);
+            END""")
+
+        c.execute(f"""CREATE TRIGGER IF NOT EXISTS trg_qe_totali_voci_ins
+            AFTER INSERT ON voci BEGIN
+            INSERT OR IGNORE INTO qe_totali (qe_id) VALUES (NEW.qe_id);
+            {aggiorna("NEW", "+")}
+            END""")
+
+        c.execute(f"""CREATE TRIGGER IF NOT EXISTS trg_qe_totali_voci_del
+            AFTER DELETE ON voci BEGIN
+            {aggiorna("OLD", "-")}
+            END""")
+
+        c.execute(f"""CREATE TRIGGER IF NOT EXISTS trg_qe_totali_voci_upd
+            AFTER UPDATE ON voci BEGIN
+            {aggiorna("OLD", "-")}
+            INSERT OR IGNORE INTO qe_totali (qe_id) VALUES (NEW.qe_id);
+            {aggiorna("NEW", "+")}
+            END""")
+
+        if nuova:
+            self.ricalcola_qe_totali()
+            print("✓ Migrazione: tabella 'qe_totali' creata e popolata")
+        elif basi:
+            self.ricalcola_qe_totali()
+            print("✓ Migrazione: totali delle voci con base di calcolo propria in 'qe_totali'")
+
+    def _sql_trigger_voci(self):
+        """SQL salvato del trigger di inserimento di qe_totali ('' se manca)"""
+        sql = self.conn.execute(
+            "SELECT sql FROM sqlite_master WHERE name = 'trg_qe_totali_voci_ins'"
+        ).fetchone()
+        return sql[0] if sql else ""
+
+    def _ricrea_trigger_voci(self):
+        """Ricrea i trigger di qe_totali su voci e ricalcola i totali"""
+        for trg in ("voci_ins", "voci_del", "voci_upd"):
+            self.conn.execute(f"DROP TRIGGER IF EXISTS trg_qe_totali_{trg}")
+        self.migra_qe_totali()
+        self.ricalcola_qe_totali()
+        print("✓ Migrazione: trigger di 'qe_totali' aggiornati")
+
+    def migra_trigger_centesimi(self):
+        """Migrazione: i trigger di qe_totali convertono gli importi non ancora
+        in centesimi come centesimi() (_sql_centesimi) invece di ROUND(x * 100)
+        in virgola mobile; i totali sono ricalcolati"""
+        if self._sql_centesimi("NEW.valore_imponibile") in self._sql_trigger_voci():
+            return  # Trigger creati da migra_qe_totali di questa versione
+        self._ricrea_trigger_voci()
+
+    def migra_trigger_solo_sql(self):
+        """Migrazione: toglie dai trigger di qe_totali la funzione centesimi()
+        registrata dall'applicazione (la usava una versione precedente di
+        migra_trigger_centesimi): senza, ogni scrittura su voci da un'altra
+        connessione (shell sqlite3, Toolkit precedente) falliva"""
+        if "centesimi(" in self._sql_trigger_voci():
+            self._ricrea_trigger_voci()
+
+    def ricalcola_qe_totali(self):
+        """Ricostruisce da zero i totali materializzati di tutti i QE (senza commit)"""
+        contr = self._sql_contributo("v")
+        cols = list(contr.keys())
+        somme = ", ".join(f"COALESCE(SUM({contr[c]}), 0)" for c in cols)
+
+        self.conn.execute("DELETE FROM qe_totali")
+        self.conn.execute(
+            f"""INSERT INTO qe_totali (qe_id, {", ".join(cols)})
+            SELECT q.id, {somme}
+            FROM quadri_economici q LEFT JOIN voci v ON v.qe_id = q.id
+            GROUP BY q.id"""
+        )
+        perc = self._sql_percentuali("qe_totali.qe_id", "qe_totali.montante")
+        self.conn.execute(f"UPDATE qe_totali SET (p_sec1, p_sec2, p_one, p_iva) = ({perc})")
+        self.conn.execute(f"UPDATE qe_totali SET {self.SQL_DERIVA_TOTALI}")
+
+        qe_basi = self.conn.execute(
+            f"SELECT DISTINCT qe_id FROM voci WHERE {self.SQL_BASE_PROPRIA}"
+        ).fetchall()
+        for (qid,) in qe_basi:
+            self.aggiorna_totali_basi(qid)
+
+    # Voci a percentuale con base di calcolo propria (escluse da p_*)
+    SQL_BASE_PROPRIA = "is_percentuale = 1 AND TRIM(COALESCE(macro_base_calcolo, '')) <> ''"
+
+    def aggiorna_totali_basi(self, qe_id):
+        """Aggiorna in qe_totali i totali (d_*) delle voci con base propria.
+
+        Le basi possono dipendere da qualsiasi voce del QE, quindi non sono
+        mantenute dai trigger: dopo ogni modifica alle voci si ricalcolano
+        con il grafo delle dipendenze (solo se il QE contiene voci di questo tipo).
+        Non esegue commit.
+        """
+        d = [0, 0, 0, 0]
+        esiste = self.conn.execute(
+            f"SELECT EXISTS(SELECT 1 FROM voci WHERE qe_id = ? AND {self.SQL_BASE_PROPRIA})",
+            (qe_id,)
+        ).fetchone()[0]
+
+        if esiste:
+            voci = self.get_voci_by_qe(qe_id)
+            calc = calcola_voci(voci)
+            for k, r in enumerate(voci):
+                if r.is_percentuale == 1 and ha_base_propria(r.macro_base_calcolo):
+                    d[0 if r.flag_base_asta == 1 else 1] += calc.imp[k]
+                    d[2] += calc.one[k]
+                    d[3] += calc.iva[k]
+
+        cur = self.conn.execute(
+            """UPDATE qe_totali SET d_sec1 = ?, d_sec2 = ?, d_one = ?, d_iva = ? 
+            WHERE qe_id = ? AND (d_sec1, d_sec2, d_one, d_iva) IS NOT (?, ?, ?, ?)""",
+            (*d, qe_id, *d)
+        )
+        if cur.rowcount:
+            self.conn.execute(
+                f"UPDATE qe_totali SET {self.SQL_DERIVA_TOTALI} WHERE qe_id = ?", (qe_id,)
+            )
+
+    def migra_fpv(self):
+        """Tabelle del cronoprogramma FPV usate dal Toolkit, con le annualità
+        in centesimi interi (le colonne REAL restano per compatibilità)"""
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS fpv_testata (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            qe_id INTEGER,
+            descrizione TEXT,
+            data_creazione TEXT,
+            FOREIGN KEY (qe_id) REFERENCES quadri_economici (id) ON DELETE CASCADE
+        )''')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS fpv_dettaglio (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            versione_id INTEGER,
+            voce_id INTEGER,
+            fornitore TEXT,
+            anno_1 REAL,
+            anno_2 REAL,
+            anno_3 REAL,
+            anno_1_cent INTEGER,
+            anno_2_cent INTEGER,
+            anno_3_cent INTEGER,
+            FOREIGN KEY (versione_id) REFERENCES fpv_testata (id) ON DELETE CASCADE,
+            FOREIGN KEY (voce_id) REFERENCES voci (id) ON DELETE CASCADE
+        )''')
+
+        cols = [r[1] for r in self.conn.execute("PRAGMA table_info(fpv_dettaglio)")]
+        if "anno_1_cent" not in cols:
+            self.conn.create_function("centesimi", 1, centesimi, deterministic=True)
+            for i in (1, 2, 3):
+                self.conn.execute(f"ALTER TABLE fpv_dettaglio ADD COLUMN anno_{i}_cent INTEGER")
+            self.conn.execute("""UPDATE fpv_dettaglio SET anno_1_cent = centesimi(anno_1),
+                            anno_2_cent = centesimi(anno_2),
+                            anno_3_cent = CASE WHEN anno_3 IS NULL THEN NULL ELSE centesimi(anno_3) END""")
+            print("✓ Migrazione FPV: annualità convertite in centesimi")
+
+    # Tabella degli allegati nel file collegato. Niente chiave esterna (non
+    # possono attraversare i file): la cascata dai QE è un trigger TEMP.
+    SQL_TABELLA_ALLEGATI = f"""CREATE TABLE IF NOT EXISTS {SCHEMA_ALLEGATI}.allegati_qe (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, 
+            qe_id INTEGER, 
+            nome_file TEXT, 
+            tipo_file TEXT, 
+            dati BLOB, 
+            data_caricamento TEXT,
+            descrizione TEXT DEFAULT '',
+            contenuto_id INTEGER REFERENCES contenuti (id)
+        )"""
+    COLONNE_ALLEGATI = "id, qe_id, nome_file, tipo_file, dati, data_caricamento, descrizione"
+
+    # Contenuti degli allegati, uno per impronta SHA-256: le righe di
+    # allegati_qe li richiamano con contenuto_id (dati resta vuoto, serve solo
+    # alle migrazioni) e i trigger ne contano i riferimenti, cancellando il
+    # contenuto quando non è più richiamato. Il BLOB sta in contenuti_dati
+    # (stesso id): un UPDATE riscrive tutta la riga, BLOB compreso. I
+    # contenuti con esterno = 1 sono invece file dell'archivio su cartella
+    # (_percorso_contenuto), senza riga in contenuti_dati. num_pagine è
+    # calcolato al caricamento (0 se non è un PDF leggibile, NULL se ancora
+    # da calcolare per i contenuti precedenti)
+    SQL_TABELLE_CONTENUTI = (
+        f"""CREATE TABLE IF NOT EXISTS {SCHEMA_ALLEGATI}.contenuti (
+            id INTEGER PRIMARY KEY, 
+            sha256 TEXT NOT NULL UNIQUE, 
+            riferimenti INTEGER NOT NULL DEFAULT 0, 
+            codec TEXT NOT NULL DEFAULT '', 
+            dimensione INTEGER, 
+            dimensione_salvata INTEGER, 
+            esterno INTEGER NOT NULL DEFAULT 0, 
+            num_pagine INTEGER
+        )""",
+        f"""CREATE TABLE IF NOT EXISTS {SCHEMA_ALLEGATI}.contenuti_dati (
+            id INTEGER PRIMARY KEY, 
+            dati BLOB
+        )""",
+    )
+    SQL_TRIGGER_CONTENUTI = (
+        f"""CREATE TRIGGER IF NOT EXISTS {SCHEMA_ALLEGATI}.contenuti_rif_ins 
+        AFTER INSERT ON allegati_qe WHEN new.contenuto_id IS NOT NULL 
+        BEGIN 
+            UPDATE contenuti SET riferimenti = riferimenti + 1 WHERE id = new.contenuto_id; 
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {SCHEMA_ALLEGATI}.contenuti_rif_upd 
+        AFTER UPDATE OF contenuto_id ON allegati_qe 
+        WHEN old.contenuto_id IS NOT new.contenuto_id 
+        BEGIN 
+            UPDATE contenuti SET riferimenti = riferimenti + 1 WHERE id = new.contenuto_id; 
+            UPDATE contenuti SET riferimenti = riferimenti - 1 WHERE id = old.contenuto_id; 
+            DELETE FROM contenuti_dati WHERE id = old.contenuto_id 
+                AND (SELECT riferimenti FROM contenuti WHERE id = old.contenuto_id) <= 0; 
+            DELETE FROM contenuti WHERE id = old.contenuto_id AND riferimenti <= 0; 
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {SCHEMA_ALLEGATI}.contenuti_rif_del 
+        AFTER DELETE ON allegati_qe WHEN old.contenuto_id IS NOT NULL 
+        BEGIN 
+            UPDATE contenuti SET riferimenti = riferimenti - 1 WHERE id = old.contenuto_id; 
+            DELETE FROM contenuti_dati WHERE id = old.contenuto_id 
+                AND (SELECT riferimenti FROM contenuti WHERE id = old.contenuto_id) <= 0; 
+            DELETE FROM contenuti WHERE id = old.contenuto_id AND riferimenti <= 0; 
+        END""",
+    )
+
+    # Colonne aggiunte dopo la prima versione del file degli allegati:
+    # (tabella, colonna, tipo, SQL che le riempie o None). I BLOB di
+    # allegati_qe.dati li sposta in contenuti migra_allegati_contenuti
+    COLONNE_AGGIUNTE_ALLEGATI = (
+        ("allegati_qe", "contenuto_id", "INTEGER REFERENCES contenuti (id)", None),
+        ("contenuti", "codec", "TEXT NOT NULL DEFAULT ''", None),
+        ("contenuti", "dimensione", "INTEGER",
+         f"""UPDATE {SCHEMA_ALLEGATI}.contenuti SET dimensione = 
+         (SELECT length(dati) FROM {SCHEMA_ALLEGATI}.contenuti_dati d WHERE d.id = contenuti.id)"""),
+        ("contenuti", "dimensione_salvata", "INTEGER",
+         f"""UPDATE {SCHEMA_ALLEGATI}.contenuti SET dimensione_salvata = 
+         (SELECT length(dati) FROM {SCHEMA_ALLEGATI}.contenuti_dati d WHERE d.id = contenuti.id)"""),
+        ("contenuti", "esterno", "INTEGER NOT NULL DEFAULT 0", None),
+        # Calcolate poi da completa_metadati_allegati
+        ("contenuti", "num_pagine", "INTEGER", None),
+    )
+
+    _allegati_collegati = False
+
+    def _percorso_allegati(self):
+        """File degli allegati del database aperto (anche da su_connessione)"""
+        principale = self.conn.execute("PRAGMA database_list").fetchone()[2]
+        return percorso_allegati(principale)
+
+    def _collega_allegati(self):
+        """Collega con ATTACH il file degli allegati, alla prima operazione che
+        ne ha bisogno (anche dentro una transazione).
+
+        Crea tabella e indice se mancano, il trigger TEMP che cancella gli
+        allegati insieme al QE (anche in cascata dal progetto) ed elimina gli
+        allegati di QE cancellati mentre il file non era collegato (es. dal Toolkit).
+        """
+        if self._allegati_collegati:
+            return
+        in_transazione = self.conn.in_transaction
+        collegati = {r[1] for r in self.conn.execute("PRAGMA database_list")}
+        if SCHEMA_ALLEGATI not in collegati:
+            self.conn.execute(
+                f"ATTACH DATABASE ? AS {SCHEMA_ALLEGATI}", (self._percorso_allegati(),)
+            )
+        if not in_transazione:
+            # Persistente nel file: basta che riesca una volta
+            self.conn.execute(f"PRAGMA {SCHEMA_ALLEGATI}.journal_mode = WAL")
+        for sql in self.SQL_TABELLE_CONTENUTI:
+            self.conn.execute(sql)
+        self.conn.execute(self.SQL_TABELLA_ALLEGATI)
+        # File creato da una versione precedente: colonne mancanti
+        for tabella, colonna, tipo, riempimento in self.COLONNE_AGGIUNTE_ALLEGATI:
+            colonne = {r[1] for r in self.conn.execute(
+                f"PRAGMA {SCHEMA_ALLEGATI}.table_info({tabella})")}
+            if colonna not in colonne:
+                self.conn.execute(
+                    f"ALTER TABLE {SCHEMA_ALLEGATI}.{tabella} ADD COLUMN {colonna} {tipo}"
+                )
+                if riempimento:
+                    self.conn.execute(riempimento)
+        for sql in self.SQL_TRIGGER_CONTENUTI:
+            self.conn.execute(sql)
+        self.conn.execute(
+            f"""CREATE INDEX IF NOT EXISTS {SCHEMA_ALLEGATI}.idx_allegati_qe 
+            ON allegati_qe (qe_id, id, nome_file, data_caricamento, descrizione)"""
+        )
+        # I trigger non ammettono nomi qualificati: allegati_qe si risolve nel
+        # file collegato perché nel principale la tabella non c'è più
+        self.conn.execute(
+            """CREATE TEMP TRIGGER IF NOT EXISTS allegati_cascata_qe 
+            AFTER DELETE ON main.quadri_economici 
+            BEGIN DELETE FROM allegati_qe WHERE qe_id = old.id; END"""
+        )
+        self.conn.execute(
+            f"""DELETE FROM {SCHEMA_ALLEGATI}.allegati_qe 
+            WHERE qe_id NOT IN (SELECT id FROM main.quadri_economici)"""
+        )
+        if not in_transazione:
+            # Dentro una transazione un rollback annullerebbe tabella e trigger:
+            # la preparazione si ripete alla prima chiamata fuori transazione
+            self.conn.commit()
+            self._allegati_collegati = True
+
+    def migra_allegati_file(self):
+        """Migrazione: sposta gli allegati nel file separato (stessi id) e
+        toglie la tabella dal database principale, poi compattato"""
+        tabella = self.conn.execute(
+            "SELECT 1 FROM main.sqlite_master WHERE type = 'table' AND name = 'allegati_qe'"
+        ).fetchone()
+        if not tabella:
+            return
+        self._collega_allegati()
+        # INSERT OR REPLACE: ripetibile se il passo si è interrotto a metà
+        cur = self.conn.execute(
+            f"""INSERT OR REPLACE INTO {SCHEMA_ALLEGATI}.allegati_qe ({self.COLONNE_ALLEGATI}) 
+            SELECT {self.COLONNE_ALLEGATI} FROM main.allegati_qe"""
+        )
+        self.conn.execute("DROP TABLE main.allegati_qe")
+        if cur.rowcount > 0:
+            self._da_compattare += ("main",)
+            print(f"✓ Migrazione: {cur.rowcount} allegati spostati in "
+                  f"{os.path.basename(self._percorso_allegati())}")
+
+    def migra_allegati_contenuti(self):
+        """Migrazione: sposta i BLOB di allegati_qe in contenuti, una sola copia
+        per impronta SHA-256, poi compatta il file degli allegati"""
+        self._collega_allegati()
+        righe = self.conn.execute(
+            f"""SELECT id, length(dati) FROM {SCHEMA_ALLEGATI}.allegati_qe 
+            WHERE contenuto_id IS NULL AND dati IS NOT NULL"""
+        ).fetchall()
+        if not righe:
+            return
+        for aid, totale in righe:
+            h = hashlib.sha256()
+            for blocco in self._leggi_blob(aid, totale, "allegati_qe"):
+                h.update(blocco)
+            impronta = h.hexdigest()
+            cur = self.conn.execute(
+                f"""INSERT OR IGNORE INTO {SCHEMA_ALLEGATI}.contenuti 
+                (sha256, dimensione, dimensione_salvata) VALUES (?, ?, ?)""",
+                (impronta, totale, totale)
+            )
+            if cur.rowcount > 0:
+                # Copia del BLOB interna a SQLite, senza passare da Python
+                self.conn.execute(
+                    f"""INSERT INTO {SCHEMA_ALLEGATI}.contenuti_dati (id, dati) 
+                    SELECT ?, dati FROM {SCHEMA_ALLEGATI}.allegati_qe WHERE id = ?""",
+                    (cur.lastrowid, aid)
+                )
+            self.conn.execute(
+                f"""UPDATE {SCHEMA_ALLEGATI}.allegati_qe SET dati = NULL, 
+                contenuto_id = (SELECT id FROM {SCHEMA_ALLEGATI}.contenuti WHERE sha256 = ?) 
+                WHERE id = ?""",
+                (impronta, aid)
+            )
+        distinti = self.conn.execute(
+            f"SELECT count(*) FROM {SCHEMA_ALLEGATI}.contenuti"
+        ).fetchone()[0]
+        self._da_compattare += (SCHEMA_ALLEGATI,)
+        print(f"✓ Migrazione: {len(righe)} allegati su {distinti} contenuti distinti")
+
+    # Indici secondari degli accessi frequenti: (nome, tabella, colonne).
+    INDICI = (
+        # get_voci_by_qe (filtro e ordinamento), cascata da quadri_economici
+        ("idx_voci_qe_codice", "voci", "qe_id, codice_completo"),
+        # get_prossimo_codice (coprente)
+        ("idx_voci_qe_padre", "voci", "qe_id, codice_padre, codice_completo"),
+        # get_qe_by_progetto, elenchi QE del Toolkit (coprente), cascata da progetti
+        ("idx_qe_progetto", "quadri_economici", "progetto_id, id, nome_versione"),
+        # Intestazioni allegati senza leggere il BLOB (coprente), cascata da QE
+        ("idx_allegati_qe", "allegati_qe", "qe_id, id, nome_file, data_caricamento, descrizione"),
+        # Controllo della chiave esterna su eliminazione di una normativa
+        ("idx_progetti_normativa", "progetti", "normativa_id"),
+        # LEFT JOIN voci/fpv_dettaglio del Toolkit, cascata da fpv_testata
+        ("idx_fpv_dettaglio_versione", "fpv_dettaglio", "versione_id, voce_id"),
+        # Cascata da voci
+        ("idx_fpv_dettaglio_voce", "fpv_dettaglio", "voce_id"),
+        # Versioni FPV di un QE (coprente), cascata da quadri_economici
+        ("idx_fpv_testata_qe", "fpv_testata", "qe_id, id, descrizione, data_creazione"),
+    )
+
+    def migra_indici(self):
+        """Migrazione: indici secondari per le ricerche per QE, progetto e voce"""
+        tabelle = {r[0] for r in self.conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'"
+        )}
+        esistenti = {r[0] for r in self.conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'"
+        )}
+        nuovi = [i for i in self.INDICI if i[1] in tabelle and i[0] not in esistenti]
+        for nome, tabella, colonne in nuovi:
+            self.conn.execute(f"CREATE INDEX IF NOT EXISTS {nome} ON {tabella} ({colonne})")
+        if nuovi:
+            self.conn.execute("ANALYZE")
+            print(f"✓ Migrazione: {len(nuovi)} indici aggiunti")
+
+    def migra_indice_voci_percentuale(self):
+        """Migrazione: indice delle voci a percentuale di un QE, risommate dai
+        trigger di qe_totali (senza l'indice ogni inserimento scorre tutto il
+        QE: quadratico negli import)"""
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_voci_qe_percentuale ON voci (qe_id, is_percentuale)"
+        )
+        self.conn.execute("ANALYZE voci")
+        print("✓ Migrazione: indice delle voci a percentuale aggiunto")
+
+    # Query che devono usare un indice: (descrizione, sql, indici ammessi).
+    # Le cascate ON DELETE sono verificate con la ricerca equivalente sulla figlia.
+    PIANI_ATTESI = (
+        ("get_voci_by_qe", "SQL_VOCI_QE", ("idx_voci_qe_codice",)),
+        ("get_prossimo_codice", "SQL_CODICI_CATEGORIA", ("idx_voci_qe_padre",)),
+        ("get_qe_by_progetto", "SQL_QE_PROGETTO", ("idx_qe_progetto",)),
+        ("get_allegati_headers_by_qe", "SQL_ALLEGATI_QE", ("idx_allegati_qe",)),
+        ("get_spazio_allegati", "SQL_SPAZIO_ALLEGATI", ("idx_allegati_qe",)),
+        ("trigger qe_totali: voci a percentuale",
+         "SELECT id FROM voci WHERE qe_id = ? AND is_percentuale = 1",
+         ("idx_voci_qe_percentuale",)),
+        ("cascata QE -> voci", "SELECT id FROM voci WHERE qe_id = ?",
+         ("idx_voci_qe_codice", "idx_voci_qe_padre", "idx_voci_qe_percentuale")),
+        ("cascata progetto -> QE", "SELECT id FROM quadri_economici WHERE progetto_id = ?",
+         ("idx_qe_progetto",)),
+        ("cascata QE -> allegati (trigger TEMP)", "SELECT id FROM allegati_qe WHERE qe_id = ?",
+         ("idx_allegati_qe",)),
+        ("normativa -> progetti", "SELECT id FROM progetti WHERE normativa_id = ?",
+         ("idx_progetti_normativa",)),
+        ("Toolkit: voci e dettaglio FPV",
+         """SELECT v.id, d.fornitore, d.anno_1_cent FROM voci v
+         LEFT JOIN fpv_dettaglio d ON v.id = d.voce_id AND d.versione_id = ?
+         WHERE v.qe_id = ? ORDER BY v.codice_completo""",
+         ("idx_fpv_dettaglio_versione",)),
+        ("cascata voce -> FPV", "SELECT id FROM fpv_dettaglio WHERE voce_id = ?",
+         ("idx_fpv_dettaglio_voce",)),
+        ("cascata versione FPV -> dettaglio", "SELECT id FROM fpv_dettaglio WHERE versione_id = ?",
+         ("idx_fpv_dettaglio_versione",)),
+        ("Toolkit: versioni FPV del QE",
+         "SELECT id, descrizione, data_creazione FROM fpv_testata WHERE qe_id = ? ORDER BY id DESC",
+         ("idx_fpv_testata_qe",)),
+    )
+
+    def verifica_piani_query(self):
+        """Controlla con EXPLAIN QUERY PLAN che le query di PIANI_ATTESI usino
+        i loro indici (nessuna scansione completa né ordinamento temporaneo).
+
+        Restituisce righe (descrizione, esito, piano); le query su tabelle
+        assenti sono saltate con esito None.
+        """
+        self._collega_allegati()
+        risultati = []
+        for descr, sql, indici in self.PIANI_ATTESI:
+            sql = getattr(self, sql, sql)
+            try:
+                piano = [r[3] for r in self.conn.execute(
+                    f"EXPLAIN QUERY PLAN {sql}", (None,) * sql.count("?")
+                )]
+            except sqlite3.OperationalError:
+                risultati.append((descr, None, "tabella assente"))
+                continue
+            testo = " | ".join(piano)
+            ok = (
+                any(i in testo for i in indici)
+                and not any(p.startswith("SCAN") and "INDEX" not in p for p in piano)
+                and "TEMP B-TREE" not in testo
+            )
+            risultati.append((descr, ok, testo))
+        return risultati
+
+    def popola_dati_base(self):
+        """Popola dati iniziali: configurazione e normative standard"""
+        # Configurazione base
+        self.conn.execute(
+            "INSERT OR IGNORE INTO configurazione (chiave, valore) VALUES (?, ?)", 
+            ("admin_password", "admin")
+        )
+        
+        # Normative standard
+        normative = [
+            ("D.Lgs. 36/2023 - Opere", "Realizzazione di opere pubbliche"),
+            ("D.Lgs. 36/2023 - Beni e Servizi", "Acquisizione di beni e servizi"),
+            ("DPR 207/2010", "Ex Regolamento"),
+            ("FESR 2021-2027", "Realizzazione di opere pubbliche")
+        ]
+        
+        for n, d in normative: 
+            self.conn.execute(
+                "INSERT OR IGNORE INTO normative (nome, descrizione) VALUES (?, ?)", 
+                (n, d)
+            )
+
+        # Popolamento catalogo D.Lgs. 36/2023 - Opere
+        try:
+            id_36_opere = self.conn.execute("SELECT id FROM normative WHERE nome='D.Lgs. 36/2023 - Opere'").fetchone()[0]
+            if self.conn.execute("SELECT count(*) FROM catalogo_voci WHERE normativa_id=?", (id_36_opere,)).fetchone()[0] == 0:
+                dati = [(id_36_opere, "A", 1, "IMPORTO DEI LAVORI"), (id_36_opere, "B", 1, "IMPORTO DEI COSTI DELLA SICUREZZA"), (id_36_opere, "C", 1, "IMPORTO PER IL CONTRASTO ALLA CRIMINALITÀ"), (id_36_opere, "D", 1, "OPERE DI MITIGAZIONE E COSTI AMBIENTALI"),
+                        (id_36_opere, "E.01", 2, "Lavori in amministrazione diretta"), (id_36_opere, "E.02", 2, "Rilievi e indagini (a cura della S.A.)"), (id_36_opere, "E.03", 2, "Rilievi e indagini (a cura del Progettista)"), (id_36_opere, "E.04", 2, "Allacciamenti pubblici servizi"), (id_36_opere, "E.05", 2, "Imprevisti"), (id_36_opere, "E.06", 2, "Accantonamenti"), (id_36_opere, "E.07", 2, "Acquisizione aree/espropri"), (id_36_opere, "E.08", 2, "Spese tecniche"), (id_36_opere, "E.09", 2, "Spese attività tecnico-amministrative"), (id_36_opere, "E.10", 2, "Spese Art. 45"), (id_36_opere, "E.11", 2, "Commissioni"), (id_36_opere, "E.12", 2, "Pubblicità"), (id_36_opere, "E.13", 2, "Prove laboratorio"), (id_36_opere, "E.14", 2, "Collaudi"), (id_36_opere, "E.15", 2, "Verifica archeologica"), (id_36_opere, "E.16", 2, "Tutela giurisdizionale"), (id_36_opere, "E.17", 2, "Opere artistiche")]
+                self.conn.executemany("INSERT OR IGNORE INTO catalogo_voci (normativa_id, codice, macro_gruppo, descrizione) VALUES (?, ?, ?, ?)", dati)
+        except: pass
+        try:
+            id_36_serv = self.conn.execute("SELECT id FROM normative WHERE nome='D.Lgs. 36/2023 - Beni e Servizi'").fetchone()[0]
+            if self.conn.execute("SELECT count(*) FROM catalogo_voci WHERE normativa_id=?", (id_36_serv,)).fetchone()[0] == 0:
+                dati = [(id_36_serv, "1.01", 1, "Importo servizi/forniture"), (id_36_serv, "1.02", 1, "Oneri sicurezza interferenziali"), (id_36_serv, "2.01", 2, "Lavori in economia"), (id_36_serv, "2.02", 2, "Imprevisti"), (id_36_serv, "2.03", 2, "Spese tecniche"), (id_36_serv, "2.04", 2, "Pubblicità/Gara"), (id_36_serv, "2.05", 2, "Revisione prezzi")]
+                self.conn.executemany("INSERT OR IGNORE INTO catalogo_voci (normativa_id, codice, macro_gruppo, descrizione) VALUES (?, ?, ?, ?)", dati)
+        except: pass
+        try:
+            id_207 = self.conn.execute("SELECT id FROM normative WHERE nome='DPR 207/2010'").fetchone()[0]
+            if self.conn.execute("SELECT count(*) FROM catalogo_voci WHERE normativa_id=?", (id_207,)).fetchone()[0] == 0:
+                dati = [(id_207, "1.01", 1, "Lavori"), (id_207, "1.02", 1, "Sicurezza"), (id_207, "2.01", 2, "Lavori in economia"), (id_207, "2.02", 2, "Rilievi, accertamenti e indagini"), (id_207, "2.03", 2, "Allacciamenti"), (id_207, "2.04", 2, "Imprevisti"), (id_207, "2.05", 2, "Acquisizione aree"), (id_207, "2.06", 2, "Revisione prezzi"), (id_207, "2.07", 2, "Spese tecniche"), (id_207, "2.08", 2, "Spese per attività amministrative"), (id_207, "2.09", 2, "Commissioni di gara"), (id_207, "2.10", 2, "Pubblicità"), (id_207, "2.11", 2, "Collaudi")]
+                self.conn.executemany("INSERT OR IGNORE INTO catalogo_voci (normativa_id, codice, macro_gruppo, descrizione) VALUES (?, ?, ?, ?)", dati)
+        except: pass
+        try:
+            id_fesr = self.conn.execute("SELECT id FROM normative WHERE nome='FESR 2021-2027'").fetchone()[0]
+            if self.conn.execute("SELECT count(*) FROM catalogo_voci WHERE normativa_id=?", (id_fesr,)).fetchone()[0] == 0:
+                dati = [(id_fesr, "A.01", 1, "Lavori"), (id_fesr, "A.02", 1, "Sicurezza"), (id_fesr, "B.01", 2, "Economia"), (id_fesr, "B.02", 2, "Rilievi"), (id_fesr, "B.03", 2, "Allacciamenti"), (id_fesr, "B.04", 2, "Imprevisti"), (id_fesr, "B.05", 2, "Aree"), (id_fesr, "B.06", 2, "Accantonamenti"), (id_fesr, "B.07", 2, "Spese tecniche"), (id_fesr, "B.08", 2, "Consulenza"), (id_fesr, "B.09", 2, "Commissioni"), (id_fesr, "B.10", 2, "Pubblicità"), (id_fesr, "B.11", 2, "Collaudi"), (id_fesr, "B.12", 2, "Forniture")]
+                self.conn.executemany("INSERT OR IGNORE INTO catalogo_voci (normativa_id, codice, macro_gruppo, descrizione) VALUES (?, ?, ?, ?)", dati)
+        except: pass
+        
+    def popola_demo_se_vuoto(self):
+        """Crea progetto demo solo se il database è completamente vuoto"""
+        count = self.conn.execute("SELECT count(*) FROM progetti").fetchone()[0]
+        
+        if count == 0:
+            try:
+                id_36 = self.conn.execute(
+                    "SELECT id FROM normative WHERE nome='D.Lgs. 36/2023 - Opere'"
+                ).fetchone()
+                
+                if not id_36:
+                    return
+                
+                id_36 = id_36[0]
+                
+                # Inserisci progetto demo
+                self.conn.execute(
+                    """INSERT INTO progetti 
+                    (normativa_id, cup, anno, titolo, importo, importo_cent) 
+                    VALUES (?,?,?,?,?,?)""", 
+                    (id_36, "H61I24000130006", 2025, "Rete di attracchi via mare", 5623000.0, 562300000)
+                )
+                
+                pid = self.conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+                
+                # Inserisci QE demo
+                self.conn.execute(
+                    """INSERT INTO quadri_economici 
+                    (progetto_id, nome_versione, data_creazione, note) 
+                    VALUES (?,?,?,?)""", 
+                    (pid, "1. PFTE", datetime.date.today().strftime("%d/%m/%Y"), "Versione 1.0")
+                )
+                
+                qid1 = self.conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+                
+                # Inserisci voce demo
+                self.conn.execute(
+                    """INSERT INTO voci 
+                    (qe_id, codice_padre, codice_completo, descrizione, tipo, 
+                    valore_imponibile, is_percentuale, perc_oneri, includi_oneri_in_iva, 
+                    perc_iva, flag_base_asta, flag_soggetto_ribasso, macro_base_calcolo, 
+                    flag_calcolo_montante, importo_cent) 
+                    VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)""", 
+                    (qid1, "A", "A.01", "Lavori Edili", "fisso", 100000.0, 
+                     0, 0, 0, 10.0, 1, 1, "", 1, 10000000)
+                )
+                
+                print("✓ Progetto demo creato con successo")
+                
+            except Exception as e:
+                print(f"Errore creazione progetto demo: {e}")
+
+    # --- TRANSAZIONI ---
+
+    # Blocchi transazione() aperti e QE da passare ad aggiorna_totali_basi
+    # alla chiusura del più esterno
+    _transazione = 0
+    _qe_basi_pendenti = None
+
+    @contextlib.contextmanager
+    def transazione(self):
+        """Unità di lavoro: i metodi CRUD chiamati nel blocco non fanno commit,
+        il blocco termina con un solo commit oppure, se solleva un'eccezione,
+        con il rollback di tutto. I blocchi annidati confluiscono nel più esterno.
+
+        I totali delle voci con base propria si ricalcolano una volta per QE
+        alla chiusura: all'interno del blocco get_totali_qe può non includerli.
+        """
+        if self._transazione:
+            self._transazione += 1
+            try:
+                yield self
+            finally:
+                self._transazione -= 1
+            return
+
+        self.conn.commit()
+        self.conn.execute("BEGIN IMMEDIATE")
+        self._transazione = 1
+        self._qe_basi_pendenti = set()
+        try:
+            yield self
+            for qe_id in self._qe_basi_pendenti:
+                self.aggiorna_totali_basi(qe_id)
+            self.conn.commit()
+        except BaseException:
+            self.conn.rollback()
+            raise
+        finally:
+            self._transazione = 0
+            self._qe_basi_pendenti = None
+
+    def _conferma(self):
+        """Commit di un'operazione singola, rinviato se è aperta una transazione()"""
+        if not self._transazione:
+            self.conn.commit()
+
+    def _basi_da_aggiornare(self, qe_id):
+        """aggiorna_totali_basi subito, o alla chiusura della transazione() aperta"""
+        if self._transazione:
+            self._qe_basi_pendenti.add(qe_id)
+        else:
+            self.aggiorna_totali_basi(qe_id)
+
+    # --- CRUD OPERATIONS: CONFIGURAZIONE E NORMATIVE ---
+
+    def get_normative(self):
+        """Recupera tutte le normative ordinate per ID"""
+        return self.conn.execute(
+            "SELECT id, nome, descrizione FROM normative ORDER BY id"
+        ).fetchall()
+    
+    def get_config(self, k):
+        """Recupera valore di configurazione per chiave"""
+        r = self.conn.execute(
+            "SELECT valore FROM configurazione WHERE chiave=?", (k,)
+        ).fetchone()
+        return r[0] if r else ""
+    
+    def set_config(self, k, v):
+        """Salva valore di configurazione"""
+        self.conn.execute(
+            "INSERT OR REPLACE INTO configurazione (chiave, valore) VALUES (?, ?)", 
+            (k, v)
+        )
+        self._conferma()
+
+    def set_config_many(self, valori):
+        """Salva più valori di configurazione {chiave: valore} con un solo commit"""
+        with self.transazione():
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO configurazione (chiave, valore) VALUES (?, ?)",
+                valori.items()
+            )
+
+    def inserisci_normativa(self, n, d):
+        """Inserisce nuova normativa"""
+        try:
+            self.conn.execute(
+                "INSERT INTO normative (nome, descrizione) VALUES (?, ?)", 
+                (n, d)
+            )
+            self._conferma()
+            return True
+        except sqlite3.IntegrityError:
+            return False
+    
+    def aggiorna_normativa(self, nid, n, d):
+        """Aggiorna normativa esistente"""
+        try:
+            self.conn.execute(
+                "UPDATE normative SET nome=?, descrizione=? WHERE id=?", 
+                (n, d, nid)
+            )
+            self._conferma()
+            return True
+        except sqlite3.IntegrityError:
+            return False
+    
+    def elimina_normativa(self, nid):
+        """Elimina normativa (e progetti collegati in cascade)"""
+        self.conn.execute("DELETE FROM normative WHERE id=?", (nid,))
+        self._conferma()
+    
+    def duplica_normativa(self, old_id, new_name, new_desc):
+        """Duplica normativa e il suo catalogo voci"""
+        try:
+            # Normativa e catalogo insieme: un errore non lascia la normativa vuota
+            with self.transazione():
+                self.conn.execute(
+                    "INSERT INTO normative (nome, descrizione) VALUES (?, ?)",
+                    (new_name, new_desc)
+                )
+                new_id = self.conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+
+                self.conn.execute(
+                    """INSERT INTO catalogo_voci
+                    (normativa_id, codice, macro_gruppo, descrizione)
+                    SELECT ?, codice, macro_gruppo, descrizione
+                    FROM catalogo_voci WHERE normativa_id = ?""",
+                    (new_id, old_id)
+                )
+            return True
+        except Exception as e:
+            print(f"Errore duplicazione normativa: {e}")
+            return False
+
+    # --- CRUD OPERATIONS: CATALOGO VOCI ---
+    
+    def get_catalogo(self, normativa_id, mid=None):
+        """Recupera catalogo voci per normativa (opzionalmente filtrato per macro)"""
+        sql = """SELECT id, codice, macro_gruppo, descrizione 
+                 FROM catalogo_voci WHERE normativa_id=?"""
+        params = [normativa_id]
+        
+        if mid is not None:
+            sql += " AND macro_gruppo=?"
+            params.append(mid)
+        
+        sql += " ORDER BY codice"
+        
+        return self.conn.execute(sql, params).fetchall()
+    
+    def aggiorna_catalogo(self, nid, c, m, d):
+        """Aggiorna o inserisce voce di catalogo"""
+        r = self.conn.execute(
+            "SELECT id FROM catalogo_voci WHERE normativa_id=? AND codice=?", 
+            (nid, c)
+        ).fetchone()
+        
+        if not r:
+            self.conn.execute(
+                """INSERT INTO catalogo_voci 
+                (normativa_id, codice, macro_gruppo, descrizione) 
+                VALUES (?,?,?,?)""", 
+                (nid, c, m, d)
+            )
+        else:
+            self.conn.execute(
+                """UPDATE catalogo_voci 
+                SET macro_gruppo=?, descrizione=? WHERE id=?""", 
+                (m, d, r[0])
+            )
+        
+        self._conferma()
+    
+    def aggiorna_voce_catalogo_id(self, cat_id, nid, c, m, d):
+        """Aggiorna voce catalogo per ID (o inserisce se None)"""
+        if cat_id:
+            self.conn.execute(
+                """UPDATE catalogo_voci 
+                SET codice=?, macro_gruppo=?, descrizione=? WHERE id=?""", 
+                (c, m, d, cat_id)
+            )
+        else:
+            self.conn.execute(
+                """INSERT INTO catalogo_voci 
+                (normativa_id, codice, macro_gruppo, descrizione) 
+                VALUES (?,?,?,?)""", 
+                (nid, c, m, d)
+            )
+        self._conferma()
+    
+    def elimina_voce_catalogo(self, cat_id):
+        """Elimina voce dal catalogo"""
+        self.conn.execute("DELETE FROM catalogo_voci WHERE id=?", (cat_id,))
+        self._conferma()
+
+    # --- CRUD OPERATIONS: PROGETTI ---
+    
+    def get_prossimo_codice(self, qe_id, codice_padre):
+        """Calcola il prossimo codice disponibile per una categoria"""
+        rows = self.conn.execute(
+            self.SQL_CODICI_CATEGORIA, (qe_id, codice_padre)
+        ).fetchall()
+        
+        numeri = [
+            int(r[0].split('.')[-1]) 
+            for r in rows 
+            if r[0].split('.')[-1].isdigit()
+        ]
+        
+        prossimo = max(numeri) + 1 if numeri else 1
+        return f"{codice_padre}.{prossimo:02d}"
+    
+    def inserisci_progetto(self, nid, c, a, t, i):
+        """Inserisce nuovo progetto"""
+        self.conn.execute(
+            """INSERT INTO progetti 
+            (normativa_id, cup, anno, titolo, importo, importo_cent) 
+            VALUES (?,?,?,?,?,?)""", 
+            (nid, c, a, t, i, centesimi(i))
+        )
+        self._conferma()
+    
+    def aggiorna_progetto_dati(self, pid, c, a, t, i):
+        """Aggiorna dati progetto esistente"""
+        self.conn.execute(
+            """UPDATE progetti 
+            SET cup=?, anno=?, titolo=?, importo=?, importo_cent=? 
+            WHERE id=?""", 
+            (c, a, t, i, centesimi(i), pid)
+        )
+        self._conferma()
+    
+    def elimina_progetto(self, pid):
+        """Elimina progetto (QE e allegati in cascade)"""
+        self._collega_allegati()
+        self.conn.execute("DELETE FROM progetti WHERE id=?", (pid,))
+        self._conferma()
+    
+    def duplica_progetto(self, pid, titolo, allegati=False, fpv=False):
+        """Duplica un progetto con tutti i suoi QE (e, a richiesta, allegati e
+        versioni FPV) in un'unica transazione. Restituisce l'ID del nuovo
+        progetto, None se pid non esiste."""
+        with self.transazione():
+            cur = self.conn.execute(
+                """INSERT INTO progetti 
+                (normativa_id, cup, anno, titolo, importo, importo_cent) 
+                SELECT normativa_id, cup, anno, ?, importo, importo_cent 
+                FROM progetti WHERE id=?""", 
+                (titolo, pid)
+            )
+            if not cur.rowcount:
+                return None
+            new_pid = cur.lastrowid
+
+            qe_ids = self.conn.execute(
+                "SELECT id FROM quadri_economici WHERE progetto_id=? ORDER BY id", (pid,)
+            ).fetchall()
+            for (qid,) in qe_ids:
+                nuovo = self.conn.execute(
+                    """INSERT INTO quadri_economici 
+                    (progetto_id, nome_versione, data_creazione, note) 
+                    SELECT ?, nome_versione, data_creazione, note 
+                    FROM quadri_economici WHERE id=?""", 
+                    (new_pid, qid)
+                ).lastrowid
+                self._copia_contenuto_qe(qid, nuovo, allegati, fpv)
+        return new_pid
+
+    def get_tutti_progetti(self):
+        """Recupera tutti i progetti con info normativa"""
+        return self.conn.execute(
+            """SELECT p.id, p.cup, p.anno, p.titolo, p.importo_cent, n.nome 
+            FROM progetti p 
+            JOIN normative n ON p.normativa_id = n.id 
+            ORDER BY p.id DESC"""
+        ).fetchall()
+    
+    # Pagina dell'archivio progetti: paginazione a chiave (id decrescente) e
+    # totale dell'ultimo QE di ciascuno; costo indipendente dalla dimensione.
+    # Non è in PIANI_ATTESI: con poche righe SQLite preferisce (giustamente) una
+    # scansione, su archivi grandi legge per chiave primaria (rowid<?).
+    SQL_PROGETTI_PAGINA = """SELECT p.id, p.cup, p.anno, p.titolo, p.importo_cent, n.nome, 
+            (SELECT COALESCE((SELECT t.totale FROM qe_totali t WHERE t.qe_id = q.id), 0) 
+             FROM quadri_economici q 
+             WHERE q.progetto_id = p.id ORDER BY q.id DESC LIMIT 1) 
+            FROM progetti p 
+            JOIN normative n ON p.normativa_id = n.id 
+            WHERE p.id < ? 
+            ORDER BY p.id DESC LIMIT ?"""
+
+    def get_progetti_pagina(self, dopo_id=None, limite=200):
+        """Progetti con id minore di dopo_id (dal più recente se None), al più limite.
+
+        Righe come get_tutti_progetti più il totale dell'ultimo QE (None se il
+        progetto non ha QE); la pagina successiva parte dall'id dell'ultima riga.
+        """
+        if dopo_id is None:
+            dopo_id = 2 ** 63 - 1
+        return self.conn.execute(self.SQL_PROGETTI_PAGINA, (dopo_id, limite)).fetchall()
+
+    def get_progetto_by_id(self, pid):
+        """Recupera singolo progetto per ID"""
+        return self.conn.execute(
+            "SELECT * FROM progetti WHERE id=?", (pid,)
+        ).fetchone()
+
+    # --- CRUD OPERATIONS: QUADRI ECONOMICI ---
+    
+    def inserisci_qe(self, pid, n, nt):
+        """Inserisce nuovo QE"""
+        self.conn.execute(
+            """INSERT INTO quadri_economici 
+            (progetto_id, nome_versione, data_creazione, note) 
+            VALUES (?,?,?,?)""", 
+            (pid, n, datetime.date.today().strftime("%d/%m/%Y"), nt)
+        )
+        self._conferma()
+    
+    def aggiorna_qe(self, qid, n, nt):
+        """Aggiorna QE esistente"""
+        self.conn.execute(
+            """UPDATE quadri_economici 
+            SET nome_versione=?, note=? 
+            WHERE id=?""", 
+            (n, nt, qid)
+        )
+        self._conferma()
+    
+    def elimina_qe(self, qid):
+        """Elimina QE (voci e allegati in cascade)"""
+        self._collega_allegati()
+        self.conn.execute("DELETE FROM quadri_economici WHERE id=?", (qid,))
+        self._conferma()
+    
+    def duplica_qe(self, qid, n, allegati=False, fpv=False):
+        """Duplica un QE con tutte le sue voci (e, a richiesta, allegati e
+        versioni FPV) in un'unica transazione. Restituisce l'ID del nuovo QE,
+        None se qid non esiste."""
+        with self.transazione():
+            cur = self.conn.execute(
+                """INSERT INTO quadri_economici 
+                (progetto_id, nome_versione, data_creazione, note) 
+                SELECT progetto_id, ?, ?, 'Copia di ' || nome_versione 
+                FROM quadri_economici WHERE id=?""", 
+                (n, datetime.date.today().strftime("%d/%m/%Y"), qid)
+            )
+            if not cur.rowcount:
+                return None
+            self._copia_contenuto_qe(qid, cur.lastrowid, allegati, fpv)
+        return cur.lastrowid
+
+    def _mappa_copia(self, tabella, da, a):
+        """Riempie la tabella temporanea mappa_<tabella> (vecchio id -> nuovo id)
+        tra le righe del QE da e quelle della sua copia nel QE a: le copie sono
+        inserite in ordine di id, quindi si corrispondono per posizione"""
+        mappa = f"mappa_{tabella}"
+        self.conn.execute(
+            f"CREATE TEMP TABLE IF NOT EXISTS {mappa} (vecchio INTEGER PRIMARY KEY, nuovo INTEGER)"
+        )
+        self.conn.execute(f"DELETE FROM {mappa}")
+        sql = f"SELECT id FROM {tabella} WHERE qe_id=? ORDER BY id"
+        self.conn.executemany(
+            f"INSERT INTO {mappa} (vecchio, nuovo) VALUES (?, ?)",
+            zip((r[0] for r in self.conn.execute(sql, (da,)).fetchall()),
+                (r[0] for r in self.conn.execute(sql, (a,)).fetchall()))
+        )
+        return mappa
+
+    def _copia_contenuto_qe(self, da, a, allegati, fpv):
+        """Copia voci (ed eventualmente allegati e versioni FPV) del QE da nel
+        QE a con INSERT ... SELECT. Da chiamare dentro transazione()."""
+        ids = {"da": da, "a": a}
+        self.conn.execute(
+            """INSERT INTO voci 
+            (qe_id, codice_padre, codice_completo, descrizione, tipo, 
+            valore_imponibile, is_percentuale, perc_oneri, includi_oneri_in_iva, 
+            perc_iva, flag_base_asta, flag_soggetto_ribasso, macro_base_calcolo, 
+            flag_calcolo_montante, importo_cent) 
+            SELECT :a, codice_padre, codice_completo, descrizione, tipo, 
+            valore_imponibile, is_percentuale, perc_oneri, includi_oneri_in_iva, 
+            perc_iva, flag_base_asta, flag_soggetto_ribasso, macro_base_calcolo, 
+            flag_calcolo_montante, importo_cent 
+            FROM voci WHERE qe_id = :da ORDER BY id""",
+            ids
+        )
+        # Voci identiche: i totali delle voci con base propria sono gli stessi
+        # (i trigger hanno già aggiornato gli altri accumulatori)
+        self.conn.execute(
+            """UPDATE qe_totali SET (d_sec1, d_sec2, d_one, d_iva) = 
+            (SELECT d_sec1, d_sec2, d_one, d_iva FROM qe_totali WHERE qe_id = :da) 
+            WHERE qe_id = :a""",
+            ids
+        )
+        self.conn.execute(f"UPDATE qe_totali SET {self.SQL_DERIVA_TOTALI} WHERE qe_id = :a", ids)
+
+        if allegati:
+            # Solo i riferimenti: i contenuti restano condivisi tra i due QE
+            self._collega_allegati()
+            self.conn.execute(
+                """INSERT INTO allegati_qe 
+                (qe_id, nome_file, tipo_file, contenuto_id, data_caricamento, descrizione) 
+                SELECT :a, nome_file, tipo_file, contenuto_id, data_caricamento, descrizione 
+                FROM allegati_qe WHERE qe_id = :da ORDER BY id""",
+                ids
+            )
+
+        if fpv:
+            self.conn.execute(
+                """INSERT INTO fpv_testata (qe_id, descrizione, data_creazione) 
+                SELECT :a, descrizione, data_creazione 
+                FROM fpv_testata WHERE qe_id = :da ORDER BY id""",
+                ids
+            )
+            mv = self._mappa_copia("voci", da, a)
+            mt = self._mappa_copia("fpv_testata", da, a)
+            self.conn.execute(
+                f"""INSERT INTO fpv_dettaglio 
+                (versione_id, voce_id, fornitore, anno_1, anno_2, anno_3, 
+                anno_1_cent, anno_2_cent, anno_3_cent) 
+                SELECT mt.nuovo, mv.nuovo, d.fornitore, d.anno_1, d.anno_2, d.anno_3, 
+                d.anno_1_cent, d.anno_2_cent, d.anno_3_cent 
+                FROM fpv_dettaglio d 
+                JOIN {mt} mt ON mt.vecchio = d.versione_id 
+                JOIN {mv} mv ON mv.vecchio = d.voce_id 
+                ORDER BY d.id"""
+            )
+
+    def get_qe_by_progetto(self, pid):
+        """Recupera tutti i QE di un progetto"""
+        return self.conn.execute(self.SQL_QE_PROGETTO, (pid,)).fetchall()
+    
+    def get_qe_by_id(self, qid):
+        """Recupera singolo QE per ID"""
+        return self.conn.execute(
+            "SELECT * FROM quadri_economici WHERE id=?", (qid,)
+        ).fetchone()
+    
+    def get_totali_qe(self, pid=None):
+        """Totali di tutti i QE di un progetto (o dell'intero DB) da qe_totali.
+        
+        Righe: (qe_id, progetto_id, montante, imponibile, imponibile_base_asta,
+                oneri, iva, totale), importi in centesimi
+        """
+        sql = """SELECT q.id, q.progetto_id, 
+                 COALESCE(t.montante, 0), 
+                 COALESCE(t.totale - t.oneri - t.iva, 0), 
+                 COALESCE(t.tot_sec1, 0), 
+                 COALESCE(t.oneri, 0), 
+                 COALESCE(t.iva, 0), 
+                 COALESCE(t.totale, 0) 
+                 FROM quadri_economici q 
+                 LEFT JOIN qe_totali t ON t.qe_id = q.id"""
+        params = []
+        
+        if pid is not None:
+            sql += " WHERE q.progetto_id = ?"
+            params.append(pid)
+        
+        sql += " ORDER BY q.id DESC"
+        
+        return self.conn.execute(sql, params).fetchall()
+    
+    # --- CRUD OPERATIONS: VOCI ---
+    
+    # Proiezione delle voci: le colonne di Voce, nell'ordine del costruttore
+    COLONNE_VOCE = ", ".join(Voce.CAMPI)
+
+    # Query con piano verificato da verifica_piani_query
+    SQL_VOCI_QE = f"SELECT {COLONNE_VOCE} FROM voci WHERE qe_id=? ORDER BY codice_completo ASC"
+    SQL_CODICI_CATEGORIA = "SELECT codice_completo FROM voci WHERE qe_id=? AND codice_padre=?"
+    SQL_QE_PROGETTO = "SELECT * FROM quadri_economici WHERE progetto_id=? ORDER BY id DESC"
+    SQL_ALLEGATI_QE = """SELECT a.id, a.nome_file, a.data_caricamento, a.descrizione, 
+            c.dimensione, c.num_pagine, c.sha256 
+            FROM allegati_qe a LEFT JOIN contenuti c ON c.id = a.contenuto_id 
+            WHERE a.qe_id=? ORDER BY a.id DESC"""
+    SQL_SPAZIO_ALLEGATI = """SELECT q.id, q.nome_versione, count(a.id), 
+            COALESCE(sum(c.dimensione), 0), COALESCE(sum(c.num_pagine), 0) 
+            FROM quadri_economici q 
+            LEFT JOIN allegati_qe a ON a.qe_id = q.id 
+            LEFT JOIN contenuti c ON c.id = a.contenuto_id 
+            WHERE q.progetto_id=? GROUP BY q.id ORDER BY q.id DESC"""
+
+    # Posizioni nella proiezione delle colonne con pochi valori distinti
+    # (qe_id, codice_padre, tipo, perc_oneri, perc_iva, macro_base_calcolo)
+    COLONNE_CONDIVISE = (1, 2, 5, 8, 10, 13)
+
+    def _crea_voci(self, righe):
+        """Converte le righe della proiezione in Voce; i valori ripetuti delle
+        colonne condivise sono un solo oggetto per tutte le voci"""
+        condivisi = [(k, {}) for k in self.COLONNE_CONDIVISE]
+        voci = []
+        for r in righe:
+            r = list(r)
+            for k, valori in condivisi:
+                r[k] = valori.setdefault(r[k], r[k])
+            voci.append(Voce(*r))
+        return voci
+
+    def get_voci_by_qe(self, qid):
+        """Recupera tutte le voci di un QE (lista di Voce)"""
+        return self._crea_voci(self.conn.execute(self.SQL_VOCI_QE, (qid,)))
+    
+    SQL_INSERISCI_VOCE = """INSERT INTO voci 
+            (qe_id, codice_padre, codice_completo, descrizione, tipo, 
+            valore_imponibile, is_percentuale, perc_oneri, includi_oneri_in_iva, 
+            perc_iva, flag_base_asta, flag_soggetto_ribasso, macro_base_calcolo, 
+            flag_calcolo_montante, importo_cent) 
+            VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)"""
+
+    def inserisci_voce(self, qe_id, cp, cf, desc, tipo, val, isp, po, inc, pi, 
+                       f_base, f_rib, m_base, f_mont):
+        """Inserisce nuova voce e ne restituisce l'ID"""
+        cur = self.conn.execute(
+            self.SQL_INSERISCI_VOCE, 
+            (qe_id, cp, cf, desc, tipo, val, isp, po, inc, pi, f_base, f_rib, m_base, f_mont, 
+             None if isp == 1 else centesimi(val))
+        )
+        self._basi_da_aggiornare(qe_id)
+        self._conferma()
+        return cur.lastrowid
+
+    def inserisci_voci_bulk(self, qe_id, voci):
+        """Inserisce più voci in un QE con un solo executemany e un solo commit.
+
+        Ogni voce è una tupla con gli argomenti di inserisci_voce dopo qe_id:
+        (cp, cf, desc, tipo, val, isp, po, inc, pi, f_base, f_rib, m_base, f_mont).
+        Restituisce il numero di voci inserite.
+        """
+        with self.transazione():
+            cur = self.conn.executemany(
+                self.SQL_INSERISCI_VOCE,
+                ((qe_id, *v, None if v[5] == 1 else centesimi(v[4])) for v in voci)
+            )
+            self._basi_da_aggiornare(qe_id)
+        return cur.rowcount
+    
+    def aggiorna_voce(self, vid, desc, val, isp, po, inc, pi, f_base, f_rib, 
+                      m_base, tipo_str, f_mont):
+        """Aggiorna voce esistente"""
+        self.conn.execute(
+            """UPDATE voci SET 
+            descrizione=?, valore_imponibile=?, is_percentuale=?, perc_oneri=?, 
+            includi_oneri_in_iva=?, perc_iva=?, flag_base_asta=?, 
+            flag_soggetto_ribasso=?, macro_base_calcolo=?, tipo=?, 
+            flag_calcolo_montante=?, importo_cent=? 
+            WHERE id=?""", 
+            (desc, val, isp, po, inc, pi, f_base, f_rib, m_base, tipo_str, f_mont, 
+             None if isp == 1 else centesimi(val), vid)
+        )
+        qe = self.conn.execute("SELECT qe_id FROM voci WHERE id=?", (vid,)).fetchone()
+        if qe:
+            self._basi_da_aggiornare(qe[0])
+        self._conferma()
+    
+    def aggiorna_importi_voci(self, qe_id, importi):
+        """Aggiorna gli importi fissi {id voce: centesimi} di un QE in
+        un'unica transazione (allineamento allo stanziamento)"""
+        with self.transazione():
+            self.conn.executemany(
+                "UPDATE voci SET valore_imponibile=?, importo_cent=? WHERE id=? AND qe_id=?",
+                [(euro(c), c, vid, qe_id) for vid, c in importi.items()]
+            )
+            self._basi_da_aggiornare(qe_id)
+
+    def get_voce_by_id(self, vid):
+        """Recupera singola voce per ID (Voce o None)"""
+        r = self.conn.execute(
+            f"SELECT {self.COLONNE_VOCE} FROM voci WHERE id=?", (vid,)
+        ).fetchone()
+        return Voce(*r) if r else None
+    
+    def elimina_voce(self, vid):
+        """Elimina voce"""
+        qe = self.conn.execute("SELECT qe_id FROM voci WHERE id=?", (vid,)).fetchone()
+        self.conn.execute("DELETE FROM voci WHERE id=?", (vid,))
+        if qe:
+            self._basi_da_aggiornare(qe[0])
+        self._conferma()
+
+    # --- CRUD OPERATIONS: ALLEGATI ---
+    
+    # Gli allegati stanno nel file collegato da _collega_allegati; il
+    # contenuto di ogni file è salvato una volta sola in contenuti
+
+    def _id_contenuto(self, impronta):
+        """id del contenuto con l'impronta SHA-256 data, o None"""
+        r = self.conn.execute(
+            "SELECT id FROM contenuti WHERE sha256 = ?", (impronta,)
+        ).fetchone()
+        return r[0] if r else None
+
+    def _nuovo_contenuto(self, impronta, dimensione, dati, codec="", pagine=None):
+        """Inserisce un contenuto di dimensione byte originali e pagine date,
+        salvato come dati (compressi con codec) in contenuti_dati o, con
+        l'archivio su cartella, in un file. Nessun riferimento finché una riga
+        di allegati_qe non lo richiama; restituisce l'id"""
+        esterno = self._archivio_esterno()
+        if esterno:
+            with self._file_temporaneo(impronta) as f:
+                f.write(dati)
+                self._pubblica_file(f, impronta)
+        cid = self.conn.execute(
+            """INSERT INTO contenuti 
+            (sha256, codec, dimensione, dimensione_salvata, esterno, num_pagine) 
+            VALUES (?, ?, ?, ?, ?, ?)""",
+            (impronta, codec, dimensione, len(dati), int(esterno), pagine)
+        ).lastrowid
+        if not esterno:
+            self.conn.execute(
+                "INSERT INTO contenuti_dati (id, dati) VALUES (?, ?)", (cid, dati)
+            )
+        return cid
+
+    def _inserisci_riferimento(self, qe_id, nome, tipo, contenuto_id, descrizione="", data=None):
+        """Inserisce la riga di allegati_qe che richiama un contenuto; restituisce l'id"""
+        return self.conn.execute(
+            """INSERT INTO allegati_qe 
+            (qe_id, nome_file, tipo_file, contenuto_id, data_caricamento, descrizione) 
+            VALUES (?, ?, ?, ?, ?, ?)""", 
+            (qe_id, nome, tipo, contenuto_id, 
+             data or datetime.datetime.now().strftime("%d/%m/%Y %H:%M"), descrizione or "")
+        ).lastrowid
+
+    # Sotto questa dimensione gli allegati non si comprimono
+    SOGLIA_COMPRESSIONE = 64 << 10
+
+    def _codec_per(self, dimensione):
+        """Codec configurato per un contenuto di dimensione byte ('' = nessuno)"""
+        codec = self.get_config("allegati_compressione")
+        if codec in COMPRESSORI and dimensione >= self.SOGLIA_COMPRESSIONE:
+            return codec
+        return ""
+
+    def inserisci_allegato(self, qe_id, nome, tipo, blob_data, descrizione="", data=None):
+        """Inserisce nuovo allegato (data di caricamento predefinita: adesso);
+        un contenuto già presente non viene salvato una seconda volta"""
+        self._collega_allegati()
+        blob_data = blob_data or b""
+        impronta = hashlib.sha256(blob_data).hexdigest()
+        with self.transazione():
+            cid = self._id_contenuto(impronta)
+            if cid is None:
+                codec = self._codec_per(len(blob_data))
+                salvati = blob_data
+                if codec:
+                    compressore = COMPRESSORI[codec][0]()
+                    salvati = compressore.compress(blob_data) + compressore.flush()
+                    if len(salvati) >= len(blob_data):
+                        codec, salvati = "", blob_data
+                cid = self._nuovo_contenuto(
+                    impronta, len(blob_data), salvati, codec, conta_pagine_pdf(blob_data)
+                )
+            self._inserisci_riferimento(qe_id, nome, tipo, cid, descrizione, data)
+
+    def copia_allegati_da(self, sorgente, da, a):
+        """Copia nel QE a gli allegati del QE da di un altro database (es. un
+        backup aperto nella connessione sorgente, con allegati_qe raggiungibile).
+
+        I contenuti già presenti (stessa impronta) diventano solo un
+        riferimento, senza leggerne il BLOB dal backup; gli altri sono copiati
+        così come sono salvati (eventualmente compressi), dall'archivio su
+        cartella della sorgente se vi stanno (OSError se il file manca). Da
+        chiamare dentro transazione().
+        """
+        self._collega_allegati()
+        colonne = {r[1] for r in sorgente.execute("PRAGMA table_info(contenuti)")}
+        if not colonne:
+            # Backup di versioni precedenti: BLOB dentro allegati_qe
+            for nome, tipo, dati, data in sorgente.execute(
+                """SELECT nome_file, tipo_file, dati, data_caricamento 
+                FROM allegati_qe WHERE qe_id = ? ORDER BY id""",
+                (da,)
+            ):
+                self.inserisci_allegato(a, nome, tipo, dati, data=data)
+            return
+        # Backup precedenti: contenuti senza codec, dimensione o pagine
+        # (le pagine mancanti le calcola poi completa_metadati_allegati)
+        codec = "c.codec" if "codec" in colonne else "''"
+        dimensione = "c.dimensione" if "dimensione" in colonne else "NULL"
+        pagine = "c.num_pagine" if "num_pagine" in colonne else "NULL"
+        esterno = "c.esterno" if "esterno" in colonne else "0"
+        righe = sorgente.execute(
+            f"""SELECT a.nome_file, a.tipo_file, a.data_caricamento, a.descrizione, 
+            c.sha256, c.id, {codec}, {dimensione}, {pagine}, {esterno} 
+            FROM allegati_qe a LEFT JOIN contenuti c ON c.id = a.contenuto_id 
+            WHERE a.qe_id = ? ORDER BY a.id""",
+            (da,)
+        ).fetchall()
+        archivio = cartella_archivio(sorgente.execute("PRAGMA database_list").fetchone()[2])
+        for (nome, tipo, data, descrizione, impronta, cid_sorgente, codec,
+             dimensione, pagine, esterno) in righe:
+            if impronta is None:
+                impronta, codec = hashlib.sha256(b"").hexdigest(), ""
+            cid = self._id_contenuto(impronta)
+            if cid is None:
+                dati = b""
+                if esterno:
+                    percorso = os.path.join(archivio, impronta[:2], impronta)
+                    try:
+                        with open(percorso, "rb") as f:
+                            dati = f.read()
+                    except FileNotFoundError:
+                        raise OSError(
+                            f"Allegato {nome}: file dell'archivio mancante ({percorso})"
+                        ) from None
+                elif cid_sorgente is not None:
+                    dati = sorgente.execute(
+                        "SELECT dati FROM contenuti_dati WHERE id = ?", (cid_sorgente,)
+                    ).fetchone()[0] or b""
+                if dimensione is None:
+                    dimensione = len(dati)
+                cid = self._nuovo_contenuto(impronta, dimensione, dati, codec, pagine)
+            self._inserisci_riferimento(a, nome, tipo, cid, descrizione, data)
+
+    # Blocco di lettura/scrittura dei file allegati: memoria limitata a un blocco
+    BLOCCO_ALLEGATI = 1 << 20
+    # I/O incrementale dei BLOB (Python 3.11+); altrimenti SQL a blocchi
+    BLOB_INCREMENTALE = hasattr(sqlite3.Connection, "blobopen")
+
+    def carica_allegato_da_file(self, qe_id, percorso, tipo, descrizione="", progresso=None):
+        """Inserisce come allegato il file percorso leggendolo a blocchi.
+
+        Se un contenuto con la stessa impronta SHA-256 c'è già, l'allegato lo
+        richiama senza copiarlo; altrimenti lo salva _carica_contenuto.
+        progresso(fatti, totale), se dato, è chiamato dopo ogni blocco (prima
+        sulla compressione, poi sulla scrittura).
+        Restituisce l'id dell'allegato.
+        """
+        self._collega_allegati()
+        totale = os.path.getsize(percorso)
+        impronta, pagine = analizza_file(percorso, self.BLOCCO_ALLEGATI)
+        with self.transazione():
+            cid = self._id_contenuto(impronta)
+            if cid is not None:
+                if progresso:
+                    progresso(totale, totale)
+            else:
+                cid = self._carica_contenuto(percorso, impronta, totale, pagine, progresso)
+            return self._inserisci_riferimento(
+                qe_id, os.path.basename(percorso), tipo, cid, descrizione
+            )
+
+    def carica_allegati_da_file(self, qe_id, percorsi, tipo, descrizione="",
+                                progresso=None, interrompi=None):
+        """Carica più file come allegati di qe_id in una sola transazione.
+
+        Un file che non si riesce a leggere o a comprimere (anche per memoria
+        esaurita) non ferma gli altri: quanto già scritto per lui è annullato
+        con un SAVEPOINT e l'errore è restituito.
+        progresso(fatti, totale, nome) è chiamato dopo ogni blocco con i byte
+        di tutti i file. Se interrompi (threading.Event) viene impostato solleva
+        CaricamentoAnnullato e non aggiunge nessun file.
+        Restituisce (id degli allegati, [(percorso, errore)]).
+        """
+        self._collega_allegati()
+        dimensioni = {}
+        errori = []
+        for percorso in percorsi:
+            try:
+                dimensioni[percorso] = os.path.getsize(percorso)
+            except OSError as e:
+                errori.append((percorso, e))
+        totale = sum(dimensioni.values())
+        fatti = 0
+        ids = []
+        
+        def controlla():
+            if interrompi and interrompi.is_set():
+                raise CaricamentoAnnullato()
+        
+        with self.transazione():
+            for percorso, dimensione in dimensioni.items():
+                controlla()
+                nome = os.path.basename(percorso)
+                
+                def avanza(n, _, base=fatti, nome=nome):
+                    controlla()
+                    if progresso:
+                        progresso(base + n, totale, nome)
+                
+                self.conn.execute("SAVEPOINT carica_allegato")
+                try:
+                    ids.append(self.carica_allegato_da_file(
+                        qe_id, percorso, tipo, descrizione, progresso=avanza
+                    ))
+                except (OSError, MemoryError, zlib.error, lzma.LZMAError) as e:
+                    self.conn.execute("ROLLBACK TO carica_allegato")
+                    errori.append((percorso, e))
+                self.conn.execute("RELEASE carica_allegato")
+                fatti += dimensione
+        return ids, errori
+
+    def _carica_contenuto(self, percorso, impronta, totale, pagine, progresso=None):
+        """Salva il file percorso (impronta, dimensione e pagine già calcolate)
+        come nuovo contenuto e ne restituisce l'id.
+
+        Con la compressione configurata il file è compresso in un file
+        temporaneo, tenuto solo se più piccolo. Il contenuto va poi in un BLOB
+        creato con zeroblob(dimensione) e scritto con Connection.blobopen (in
+        mancanza accodando un blocco per volta) o, con l'archivio su cartella,
+        in un file temporaneo pubblicato con _pubblica_file. OSError se il file
+        cambia durante il caricamento.
+        """
+        esterno = self._archivio_esterno()
+        codec = self._codec_per(totale)
+        letti = hashlib.sha256()
+        with open(percorso, "rb") as f, \
+                self._file_temporaneo(impronta if esterno else None) as tmp:
+            if codec:
+                self._comprimi(f, codec, tmp, letti, progresso, totale)
+                if tmp.tell() >= totale:
+                    # Non riduce lo spazio: si salva il file così com'è
+                    codec, letti = "", hashlib.sha256()
+                    f.seek(0)
+                    tmp.seek(0)
+                    tmp.truncate()
+            salvati = tmp.tell() if codec else totale
+            cid = self.conn.execute(
+                """INSERT INTO contenuti 
+                (sha256, codec, dimensione, dimensione_salvata, esterno, num_pagine) 
+                VALUES (?, ?, ?, ?, ?, ?)""",
+                (impronta, codec, totale, salvati, int(esterno), pagine)
+            ).lastrowid
+            if esterno:
+                # Compresso è già tutto nel file temporaneo
+                blocchi = self._scrivi_file(
+                    tmp, () if codec else iter(lambda: f.read(self.BLOCCO_ALLEGATI), b""))
+            else:
+                self.conn.execute(
+                    "INSERT INTO contenuti_dati (id, dati) VALUES (?, zeroblob(?))",
+                    (cid, salvati if self.BLOB_INCREMENTALE else 0)
+                )
+                sorgente = tmp if codec else f
+                sorgente.seek(0)
+                blocchi = self._scrivi_blob(
+                    cid, iter(lambda: sorgente.read(self.BLOCCO_ALLEGATI), b""))
+            fatti = 0
+            # closing: se progresso interrompe il caricamento il BLOB aperto da
+            # _scrivi_blob va chiuso subito, non quando il generatore è raccolto
+            with contextlib.closing(blocchi):
+                for blocco in blocchi:
+                    if not codec:
+                        letti.update(blocco)
+                    fatti += len(blocco)
+                    if progresso:
+                        progresso(fatti, salvati)
+            if letti.hexdigest() != impronta:
+                raise OSError(f"{percorso} è cambiato durante il caricamento")
+            if esterno:
+                self._pubblica_file(tmp, impronta)
+        return cid
+
+    def _comprimi(self, f, codec, destinazione, impronta, progresso=None, totale=0):
+        """Comprime con codec il file f in destinazione un blocco per volta,
+        aggiornando l'oggetto hashlib impronta con i dati letti"""
+        compressore = COMPRESSORI[codec][0]()
+        fatti = 0
+        for blocco in iter(lambda: f.read(self.BLOCCO_ALLEGATI), b""):
+            impronta.update(blocco)
+            destinazione.write(compressore.compress(blocco))
+            fatti += len(blocco)
+            if progresso:
+                progresso(fatti, totale)
+        destinazione.write(compressore.flush())
+
+    def salva_allegato_su_file(self, all_id, percorso, progresso=None):
+        """Scrive l'allegato nel file percorso un blocco per volta, decompresso
+        se serve (progresso come in carica_allegato_da_file, sui byte del file).
+        Un file dell'archivio non compresso è copiato con _copia_file.
+        False se l'allegato non esiste."""
+        r = self.get_allegato_intestazione(all_id)
+        if not r:
+            return False
+        _, totale, cid, codec, salvati, impronta, esterno = r
+        fatti = 0
+        with open(percorso, "wb") as f:
+            if cid is not None:
+                if esterno and not codec:
+                    passi = self._copia_file(self._percorso_contenuto(impronta), f)
+                else:
+                    if esterno:
+                        blocchi = self._leggi_file(self._percorso_contenuto(impronta))
+                    else:
+                        blocchi = self._leggi_blob(cid, salvati or 0)
+                    if codec:
+                        blocchi = decomprimi(codec, blocchi, totale or 0, self.BLOCCO_ALLEGATI)
+                    passi = map(f.write, blocchi)
+                for n in passi:
+                    fatti += n
+                    if progresso:
+                        progresso(fatti, totale or 0)
+        return True
+
+    def _scrivi_blob(self, cid, blocchi):
+        """Scrive in coda i blocchi nel BLOB del contenuto cid (creato con
+        zeroblob della dimensione finale se BLOB_INCREMENTALE, vuoto altrimenti);
+        genera ogni blocco dopo averlo scritto"""
+        if self.BLOB_INCREMENTALE:
+            with self.conn.blobopen("contenuti_dati", "dati", cid, name=SCHEMA_ALLEGATI) as blob:
+                for blocco in blocchi:
+                    blob.write(blocco)
+                    yield blocco
+            return
+        for blocco in blocchi:
+            # || tratta i BLOB come testo: CAST per restare BLOB
+            self.conn.execute(
+                "UPDATE contenuti_dati SET dati = CAST(dati || ? AS BLOB) WHERE id = ?",
+                (blocco, cid)
+            )
+            yield blocco
+
+    def _leggi_blob(self, rowid, totale, tabella="contenuti_dati"):
+        """Genera i blocchi del BLOB dati (di totale byte) della riga rowid di
+        tabella (allegati_qe solo per le migrazioni)"""
+        if self.BLOB_INCREMENTALE:
+            with self.conn.blobopen(tabella, "dati", rowid, readonly=True,
+                                    name=SCHEMA_ALLEGATI) as blob:
+                yield from iter(lambda: blob.read(self.BLOCCO_ALLEGATI), b"")
+            return
+        for inizio in range(1, totale + 1, self.BLOCCO_ALLEGATI):
+            yield self.conn.execute(
+                f"SELECT substr(dati, ?, ?) FROM {SCHEMA_ALLEGATI}.{tabella} WHERE id = ?",
+                (inizio, self.BLOCCO_ALLEGATI, rowid)
+            ).fetchone()[0]
+
+    # --- ARCHIVIO DEGLI ALLEGATI SU CARTELLA ---
+
+    # In alternativa ai BLOB (configurazione "allegati_archivio" = "cartella")
+    # i nuovi contenuti sono file QE_DATI/allegati/<2 cifre>/<sha256>, scritti
+    # una volta sola e mai modificati: in contenuti restano solo i metadati
+
+    def _archivio_esterno(self):
+        """True se i nuovi contenuti vanno nell'archivio su cartella"""
+        return self.get_config("allegati_archivio") == "cartella"
+
+    def _cartella_archivio(self):
+        """Cartella dell'archivio del database aperto (cartella_archivio)"""
+        principale = self.conn.execute("PRAGMA database_list").fetchone()[2]
+        return cartella_archivio(principale)
+
+    def _percorso_contenuto(self, impronta):
+        """File dell'archivio con il contenuto di impronta SHA-256 data"""
+        return os.path.join(self._cartella_archivio(), impronta[:2], impronta)
+
+    @contextlib.contextmanager
+    def _file_temporaneo(self, impronta=None):
+        """File temporaneo per scrivere un contenuto: anonimo o, data
+        l'impronta, nella cartella dell'archivio in attesa di _pubblica_file
+        (rimosso se non pubblicato)"""
+        if impronta is None:
+            with tempfile.TemporaryFile() as f:
+                yield f
+            return
+        cartella = os.path.dirname(self._percorso_contenuto(impronta))
+        os.makedirs(cartella, exist_ok=True)
+        f = tempfile.NamedTemporaryFile(
+            dir=cartella, prefix=impronta + ".", suffix=".tmp", delete=False
+        )
+        try:
+            with f:
+                yield f
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(f.name)
+
+    def _pubblica_file(self, f, impronta):
+        """Rende definitivo il file temporaneo f: dati su disco (fsync), poi
+        rinomina atomica al nome dell'impronta. Un file con quel nome è quindi
+        sempre completo; dopo un'interruzione restano al più file .tmp o file
+        senza contenuto, che toglie verifica_archivio_allegati"""
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        destinazione = self._percorso_contenuto(impronta)
+        os.replace(f.name, destinazione)
+        if hasattr(os, "O_DIRECTORY"):
+            # POSIX: anche la rinomina deve arrivare su disco
+            fd = os.open(os.path.dirname(destinazione), os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def _scrivi_file(self, destinazione, blocchi):
+        """Scrive i blocchi nel file aperto destinazione, generando ogni
+        blocco dopo averlo scritto (come _scrivi_blob)"""
+        for blocco in blocchi:
+            destinazione.write(blocco)
+            yield blocco
+
+    def _leggi_file(self, percorso):
+        """Genera i blocchi del file percorso letti attraverso mmap"""
+        with open(percorso, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return  # mmap non accetta file vuoti
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for inizio in range(0, len(mm), self.BLOCCO_ALLEGATI):
+                    yield mm[inizio:inizio + self.BLOCCO_ALLEGATI]
+
+    # os.sendfile tra due file regolari: solo Linux (altrove vuole un socket)
+    SENDFILE = hasattr(os, "sendfile") and sys.platform.startswith("linux")
+
+    def _copia_file(self, origine, destinazione):
+        """Copia il file origine nel file aperto destinazione generando i byte
+        copiati a ogni blocco: con SENDFILE la copia avviene nel kernel, senza
+        passare i dati da Python"""
+        with open(origine, "rb") as f:
+            if not self.SENDFILE:
+                for blocco in iter(lambda: f.read(self.BLOCCO_ALLEGATI), b""):
+                    yield destinazione.write(blocco)
+                return
+            destinazione.flush()
+            inizio = 0
+            while True:
+                n = os.sendfile(destinazione.fileno(), f.fileno(), inizio, self.BLOCCO_ALLEGATI)
+                if not n:
+                    return
+                inizio += n
+                yield n
+
+    # I file più recenti possono essere di un caricamento non ancora
+    # confermato (anche di un'altra istanza): la verifica non li tocca
+    ETA_MINIMA_ORFANI = 3600
+
+    def verifica_archivio_allegati(self, controlla_impronte=False, rimuovi=False):
+        """Riconcilia la cartella dell'archivio con la tabella contenuti.
+
+        Restituisce (orfani, temporanei, mancanti, corrotti): percorsi dei file
+        senza contenuto e dei temporanei di caricamenti interrotti (più vecchi
+        di ETA_MINIMA_ORFANI secondi, rimossi se rimuovi), impronte dei
+        contenuti il cui file manca e, con controlla_impronte, di quelli il
+        cui file non corrisponde più all'impronta.
+        """
+        self._collega_allegati()
+        esterni = {impronta: (codec, dimensione) for impronta, codec, dimensione in self.conn.execute(
+            "SELECT sha256, codec, dimensione FROM contenuti WHERE esterno = 1"
+        )}
+        cartella = self._cartella_archivio()
+        limite = time.time() - self.ETA_MINIMA_ORFANI
+        orfani, temporanei, trovati = [], [], set()
+        if os.path.isdir(cartella):
+            for sotto in os.scandir(cartella):
+                if not sotto.is_dir():
+                    continue
+                for voce in os.scandir(sotto.path):
+                    if voce.name in esterni:
+                        trovati.add(voce.name)
+                    elif voce.is_file() and voce.stat().st_mtime < limite:
+                        (temporanei if voce.name.endswith(".tmp") else orfani).append(voce.path)
+        if rimuovi:
+            for percorso in orfani + temporanei:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(percorso)
+        mancanti = sorted(set(esterni) - trovati)
+        corrotti = []
+        if controlla_impronte:
+            for impronta in sorted(trovati):
+                h = hashlib.sha256()
+                blocchi = self._leggi_file(self._percorso_contenuto(impronta))
+                codec, dimensione = esterni[impronta]
+                if codec:
+                    blocchi = decomprimi(codec, blocchi, dimensione or 0, self.BLOCCO_ALLEGATI)
+                try:
+                    for blocco in blocchi:
+                        h.update(blocco)
+                except (ValueError, zlib.error, lzma.LZMAError):
+                    corrotti.append(impronta)
+                    continue
+                if h.hexdigest() != impronta:
+                    corrotti.append(impronta)
+        return orfani, temporanei, mancanti, corrotti
+
+    def get_allegato_intestazione(self, all_id):
+        """(nome_file, dimensione del file, id del contenuto, codec, byte
+        salvati, sha256, esterno) di un allegato, senza leggerne il contenuto"""
+        self._collega_allegati()
+        return self.conn.execute(
+            """SELECT a.nome_file, c.dimensione, a.contenuto_id, c.codec, 
+            c.dimensione_salvata, c.sha256, c.esterno 
+            FROM allegati_qe a LEFT JOIN contenuti c ON c.id = a.contenuto_id 
+            WHERE a.id=?""",
+            (all_id,)
+        ).fetchone()
+
+    def get_riepilogo_allegati(self):
+        """Spazio occupato dagli allegati per archivio e codec, dai soli
+        metadati: (esterno, codec, contenuti, allegati, byte dei file allegati,
+        byte dei contenuti distinti, byte salvati)"""
+        self._collega_allegati()
+        return self.conn.execute(
+            """SELECT esterno, codec, count(*), sum(riferimenti), 
+            sum(riferimenti * dimensione), sum(dimensione), sum(dimensione_salvata) 
+            FROM contenuti GROUP BY esterno, codec ORDER BY esterno, codec"""
+        ).fetchall()
+
+    def get_allegati_headers_by_qe(self, qe_id):
+        """Recupera lista allegati (senza blob) per un QE: (id, nome_file,
+        data_caricamento, descrizione, dimensione, num_pagine, sha256)"""
+        self._collega_allegati()
+        return self.conn.execute(self.SQL_ALLEGATI_QE, (qe_id,)).fetchall()
+
+    def get_spazio_allegati(self, progetto_id):
+        """Allegati dei QE di un progetto dai soli metadati: (qe_id,
+        nome_versione, allegati, byte dei file, pagine) per QE"""
+        self._collega_allegati()
+        return self.conn.execute(self.SQL_SPAZIO_ALLEGATI, (progetto_id,)).fetchall()
+
+    def completa_metadati_allegati(self, interrompi=None):
+        """Migrazione in background: calcola le pagine dei contenuti salvati
+        prima della colonna num_pagine, uno per transazione (la scrittura
+        blocca il database solo per un istante). Si ferma quando
+        interrompi (threading.Event) è impostato; restituisce i contenuti aggiornati."""
+        self._collega_allegati()
+        fatti = ultimo = 0
+        while not (interrompi and interrompi.is_set()):
+            r = self.conn.execute(
+                """SELECT id, sha256, codec, dimensione, dimensione_salvata, esterno 
+                FROM contenuti WHERE id > ? AND num_pagine IS NULL ORDER BY id LIMIT 1""",
+                (ultimo,)
+            ).fetchone()
+            if not r:
+                break
+            ultimo = r[0]
+            try:
+                pagine = self._pagine_contenuto(*r)
+            except (OSError, ValueError, zlib.error, lzma.LZMAError):
+                pagine = 0  # File mancante o danneggiato: lo segnala verifica_archivio_allegati
+            with self.transazione():
+                self.conn.execute(
+                    "UPDATE contenuti SET num_pagine = ? WHERE id = ?", (pagine, r[0])
+                )
+            fatti += 1
+        return fatti
+
+    def _pagine_contenuto(self, cid, impronta, codec, dimensione, salvati, esterno):
+        """Pagine di un contenuto salvato: un file dell'archivio non compresso
+        è letto con mmap, gli altri passano da un file temporaneo"""
+        if esterno and not codec:
+            _, pagine = analizza_file(self._percorso_contenuto(impronta), self.BLOCCO_ALLEGATI)
+            return pagine
+        if esterno:
+            blocchi = self._leggi_file(self._percorso_contenuto(impronta))
+        else:
+            blocchi = self._leggi_blob(cid, salvati or 0)
+        if codec:
+            blocchi = decomprimi(codec, blocchi, dimensione or 0, self.BLOCCO_ALLEGATI)
+        with tempfile.TemporaryFile() as f:
+            for blocco in blocchi:
+                f.write(blocco)
+            if not f.tell():
+                return 0
+            f.flush()
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return conta_pagine_pdf(mm, self.BLOCCO_ALLEGATI)
+    
+    def get_allegato_blob(self, all_id):
+        """Recupera (nome_file, dati) di un allegato per ID, tutto in memoria"""
+        r = self.get_allegato_intestazione(all_id)
+        if not r:
+            return None
+        nome, dimensione, cid, codec, _, impronta, esterno = r
+        if cid is None:
+            return nome, b""
+        if esterno:
+            with open(self._percorso_contenuto(impronta), "rb") as f:
+                dati = f.read()
+        else:
+            dati = self.conn.execute(
+                "SELECT dati FROM contenuti_dati WHERE id=?", (cid,)
+            ).fetchone()[0]
+        if codec:
+            dati = b"".join(decomprimi(codec, (dati,), dimensione or 0, self.BLOCCO_ALLEGATI))
+        return nome, dati
+    
+    def aggiorna_descrizione_allegato(self, all_id, descrizione):
+        """Aggiorna la descrizione di un allegato"""
+        self._collega_allegati()
+        self.conn.execute(
+            "UPDATE allegati_qe SET descrizione=? WHERE id=?", (descrizione, all_id)
+        )
+        self._conferma()
+    
+    def elimina_allegato(self, all_id):
+        """Elimina allegato"""
+        self._collega_allegati()
+        self.conn.execute("DELETE FROM allegati_qe WHERE id=?", (all_id,))
+        self._conferma()
+
+    # --- BACKUP ---
+
+    # Pagine copiate a ogni passo dell'API di backup: tra un passo e l'altro
+    # si aggiorna il progresso e si può interrompere
+    PAGINE_BACKUP = 1024
+
+    # Sottocartella di QE_DATI per i backup senza destinazione esplicita
+    CARTELLA_BACKUP = "backup"
+
+    def crea_backup(self, dst=None, progresso=None, interrompi=None):
+        """Copia il database in dst (predefinito: QE_DATI/backup/qezero_BACKUP_<data>.db)
+        e gli allegati nel file accanto (percorso_allegati(dst));
+        restituisce il percorso di dst.
+
+        Le due copie sono un'istantanea coerente presa con l'API di backup di
+        SQLite, PAGINE_BACKUP pagine per passo, dentro una sola transazione di
+        lettura: le scritture delle altre connessioni (l'interfaccia mentre il
+        backup gira in un thread, il Toolkit) proseguono senza comparire nella
+        copia. progresso(fatti, totale) riceve i byte copiati; se interrompi
+        (threading.Event) viene impostato solleva BackupAnnullato. Le copie
+        si scrivono in file temporanei accanto alla destinazione, che
+        sostituiscono (os.replace) solo a backup riuscito: se non riesce sono
+        rimossi solo i temporanei e un dst già esistente resta com'era.
+        """
+        if dst is None:
+            ts = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+            # Fuori da QE_DATI: le copie non si mescolano ai file in uso
+            cartella = os.path.join(
+                os.path.dirname(self._percorso_allegati()), self.CARTELLA_BACKUP
+            )
+            os.makedirs(cartella, exist_ok=True)
+            dst = os.path.join(cartella, f"qezero_BACKUP_{ts}.db")
+        self._collega_allegati()
+        self.conn.commit()
+        copie = (("main", dst), (SCHEMA_ALLEGATI, percorso_allegati(dst)))
+        temporanei = []
+        try:
+            for _, percorso in copie:
+                fd, temporaneo = tempfile.mkstemp(
+                    dir=os.path.dirname(os.path.abspath(percorso)),
+                    prefix=os.path.basename(percorso) + ".", suffix=".tmp"
+                )
+                os.close(fd)
+                temporanei.append(temporaneo)
+            self.conn.execute("BEGIN")
+            try:
+                # La lettura di entrambi gli schemi fissa l'istantanea per tutti i passi
+                dimensioni = [
+                    self.conn.execute(f"PRAGMA {schema}.page_count").fetchone()[0]
+                    * self.conn.execute(f"PRAGMA {schema}.page_size").fetchone()[0]
+                    for schema, _ in copie
+                ]
+                esterni = self.conn.execute(
+                    "SELECT COALESCE(sum(dimensione_salvata), 0) FROM contenuti WHERE esterno = 1"
+                ).fetchone()[0]
+                totale = sum(dimensioni) + esterni
+                fatti = 0
+                
+                def avanza(n):
+                    nonlocal fatti
+                    if interrompi and interrompi.is_set():
+                        raise BackupAnnullato()
+                    fatti += n
+                    if progresso:
+                        progresso(fatti, totale)
+                
+                for (schema, _), percorso, dimensione in zip(copie, temporanei, dimensioni):
+                    copiati = 0
+                    
+                    def passo(_, restanti, pagine):
+                        nonlocal copiati
+                        ora = dimensione * (pagine - restanti) // pagine
+                        avanza(ora - copiati)
+                        copiati = ora
+                    
+                    dest = sqlite3.connect(percorso)
+                    try:
+                        self.conn.backup(
+                            dest, pages=self.PAGINE_BACKUP, progress=passo, name=schema
+                        )
+                        if schema == SCHEMA_ALLEGATI:
+                            self._includi_archivio(dest, avanza)
+                    finally:
+                        dest.close()
+            finally:
+                self.conn.rollback()
+            for (_, percorso), temporaneo in zip(copie, temporanei):
+                os.replace(temporaneo, percorso)
+        except BaseException:
+            for percorso in temporanei:
+                for f in (percorso, percorso + "-journal", percorso + "-wal", percorso + "-shm"):
+                    if os.path.exists(f):
+                        os.remove(f)
+            raise
+        return dst
+
+    def _includi_archivio(self, dest, avanza=None):
+        """Nella copia dest del file degli allegati i contenuti dell'archivio
+        su cartella diventano BLOB: il backup non dipende dalla cartella.
+        avanza(byte), se dato, è chiamato dopo ogni blocco"""
+        with dest:
+            esterni = dest.execute(
+                "SELECT id, sha256 FROM contenuti WHERE esterno = 1"
+            ).fetchall()
+            for cid, impronta in esterni:
+                origine = self._percorso_contenuto(impronta)
+                if self.BLOB_INCREMENTALE:
+                    dest.execute(
+                        "INSERT OR REPLACE INTO contenuti_dati (id, dati) VALUES (?, zeroblob(?))",
+                        (cid, os.path.getsize(origine))
+                    )
+                    with dest.blobopen("contenuti_dati", "dati", cid) as blob:
+                        for blocco in self._leggi_file(origine):
+                            blob.write(blocco)
+                            if avanza:
+                                avanza(len(blocco))
+                else:
+                    with open(origine, "rb") as f:
+                        dati = f.read()
+                    dest.execute(
+                        "INSERT OR REPLACE INTO contenuti_dati (id, dati) VALUES (?, ?)",
+                        (cid, dati)
+                    )
+                    if avanza:
+                        avanza(len(dati))
+            dest.execute("UPDATE contenuti SET esterno = 0 WHERE esterno = 1")
+
+    def chiudi(self):
+        """Chiude il database (checkpoint del WAL). I file non più usati
+        dell'archivio su cartella li rimuove solo verifica_archivio_allegati
+        con rimuovi, dal pannello Admin"""
+        chiudi(self.conn)
@@ -0,0 +1,441 @@
+# QE Zero - Report, export e modalità senza interfaccia
+# Stampe HTML, CSV e totali del QE senza tkinter (riga di comando e job notturni)
+#
+# Copyright (C) 2025 Rodolfo Sabelli
+#
+# Questo programma è software libero: puoi ridistribuirlo e/o modificarlo
+# secondo i termini della GNU General Public License versione 3 o della
+# European Union Public License versione 1.2 (a tua scelta).
+#
+# Questo programma è distribuito nella speranza che sia utile,
+# ma SENZA ALCUNA GARANZIA; senza neppure la garanzia implicita di
+# COMMERCIABILITÀ o IDONEITÀ PER UN PARTICOLARE SCOPO.
+#
+# Vedi LICENSE.txt per il testo completo delle licenze.
+#
+# Contatti: rodolfo.sabelli@gmail.com
+# Repository: [URL GITHUB/GITLAB]
+
+import argparse
+import contextlib
+import csv
+import datetime
+import json
+import os
+import sqlite3
+import sys
+from itertools import groupby
+
+from qe_calcolo import calcola_voci, euro, formatta_cent
+from qe_database import DatabaseManager
+
+
+# =============================================================================
+# DATI DEL QE PER STAMPE ED EXPORT
+# =============================================================================
+def sezioni_qe(db, qe_id, voci=None, calc=None):
+    """QE, progetto, mappa categorie e voci calcolate divise per sezione.
+
+    voci e calc (già calcolati, es. dalla cache della GUI) evitano di
+    rileggere il QE. Restituisce (qe, proj, calc, cat_map, l1, l2).
+    """
+    qe = db.get_qe_by_id(qe_id)
+    if qe is None:
+        raise ValueError(f"QE {qe_id} inesistente")
+    proj = db.get_progetto_by_id(qe[1])
+    if calc is None:
+        voci = db.get_voci_by_qe(qe_id)
+        calc = calcola_voci(voci)
+    
+    # Mappa categorie
+    cat_map = {}
+    cats = db.get_catalogo(proj[1])
+    for c in cats:
+        cat_map[c[1]] = c[3]
+    
+    # Separa voci
+    l1 = []
+    l2 = []
+    
+    for k, r in enumerate(voci):
+        item = {
+            'r': r, 'code': r.codice_completo, 'desc': r.descrizione, 
+            'imp': calc.imp[k], 'one': calc.one[k], 
+            'iva': calc.iva[k], 'tot': calc.tot[k]
+        }
+        
+        if r.flag_base_asta == 1:
+            l1.append(item)
+        else:
+            l2.append(item)
+    
+    return qe, proj, calc, cat_map, l1, l2
+
+
+def html_qe(db, qe_id, voci=None, calc=None):
+    """Stampa HTML del QE (stessa impaginazione della stampa della GUI)"""
+    qe, proj, calc, cat_map, l1, l2 = sezioni_qe(db, qe_id, voci, calc)
+    t_oneri = calc.tot_oneri
+    t_iva = calc.tot_iva
+    t_tasse = calc.tot_tasse
+    
+    # Configurazione ente
+    ente_nome = db.get_config("ente_nome")
+    ente_dettagli = (
+        f"{db.get_config('ente_indirizzo')} - "
+        f"{db.get_config('ente_citta')}<br>"
+        f"Tel: {db.get_config('ente_tel')}"
+    )
+    
+    def build_table_rows(items):
+        """Costruisce righe HTML per una sezione"""
+        h = ""
+        t_s = 0
+        
+        items.sort(key=lambda x: x['r'].codice_padre)
+        
+        for key, group in groupby(items, key=lambda x: x['r'].codice_padre):
+            g_list = list(group)
+            
+            s_imp = sum(x['imp'] for x in g_list)
+            s_one = sum(x['one'] for x in g_list)
+            s_iva = sum(x['iva'] for x in g_list)
+            s_tot = sum(x['tot'] for x in g_list)
+            t_s += s_tot
+            
+            cat_desc = cat_map.get(key, f"Categoria {key}")
+            
+            # Riga categoria
+            h += (
+                f"<tr class='cat-row'><td>{key}</td><td>{cat_desc}</td>"
+                f"<td align='right'>{formatta_cent(s_imp)}</td>"
+                f"<td align='right'>{formatta_cent(s_one)}</td>"
+                f"<td align='right'>{formatta_cent(s_iva)}</td>"
+                f"<td align='right'>{formatta_cent(s_tot)}</td></tr>"
+            )
+            
+            # Righe voci
+            for i in g_list:
+                h += (
+                    f"<tr><td style='padding-left:20px;'>{i['code']}</td>"
+                    f"<td>{i['desc']}</td>"
+                    f"<td align='right'>{formatta_cent(i['imp'])}</td>"
+                    f"<td align='right'>{formatta_cent(i['one'])}</td>"
+                    f"<td align='right'>{formatta_cent(i['iva'])}</td>"
+                    f"<td align='right'>{formatta_cent(i['tot'])}</td></tr>"
+                )
+        
+        return h, t_s
+    
+    r1, tot1 = build_table_rows(l1)
+    r2, tot2 = build_table_rows(l2)
+    
+    # Riga IVA
+    r2 += (
+        f"<tr style='background-color:#e6f7ff; font-weight:bold;'>"
+        f"<td></td><td>Riepilogo IVA e Imposte</td>"
+        f"<td align='right'>{formatta_cent(t_tasse)}</td>"
+        f"<td align='right'>{formatta_cent(t_oneri)}</td>"
+        f"<td align='right'>{formatta_cent(t_iva)}</td>"
+        f"<td align='right'></td></tr>"
+    )
+    
+    # Calcolo totali
+    t1_imp = calc.tot_sec1
+    tot2_full = calc.tot_sec2_imp + t_tasse
+    tot_qe = calc.totale
+    
+    imp_stanziato = proj[6] or 0
+    economie = imp_stanziato - tot_qe
+    col_eco = "green" if economie >= 0 else "red"
+    
+    # Header HTML
+    header_html = (
+        f"<div class='h-ente'><h2>{ente_nome}</h2>"
+        f"<p>{ente_dettagli}</p><hr>"
+        f"<h3>Progetto: {proj[4]} (CUP: {proj[2]})</h3>"
+        f"<p><b>QE:</b> {qe[2]}<br><b>Note:</b> {qe[4]}</p></div>"
+    )
+    
+    table_start = (
+        "<table style='width:100%; table-layout: fixed; border-collapse: collapse;'>"
+        "<thead><tr>"
+        "<th width='8%'>Cod</th><th width='32%'>Descrizione</th>"
+        "<th width='15%' align='right'>Imponibile</th>"
+        "<th width='15%' align='right'>Oneri</th>"
+        "<th width='15%' align='right'>IVA</th>"
+        "<th width='15%' align='right'>Totale</th>"
+        "</tr></thead><tbody>"
+    )
+    
+    # HTML completo
+    html = f"""<html>
+<head>
+<style>
+body {{ font-family: Arial; padding: 30px; }}
+table {{ margin-bottom: 20px; font-size: 12px; width:100%; border-collapse:collapse; }}
+td, th {{ border: 1px solid #ccc; padding: 5px; }}
+th {{ background: #ddd; }}
+.cat-row {{ background-color: #d9d9d9; font-weight: bold; }}
+.tot-row {{ background: #ccc; font-weight: bold; }}
+.sec-title {{ background-color: #000; color: #fff; padding: 5px; font-weight: bold; margin-top: 20px; }}
+</style>
+</head>
+<body>
+{header_html}
+<div class="sec-title">1. SPESE PER L'ESECUZIONE DELL'INTERVENTO</div>
+{table_start}{r1}
+<tr class="tot-row">
+<td colspan="2" align="right">Totale (1):</td>
+<td align="right">{formatta_cent(t1_imp)}</td>
+<td></td><td></td><td></td>
+</tr></tbody></table>
+
+<div class="sec-title">2. SOMME A DISPOSIZIONE</div>
+{table_start}{r2}
+<tr class="tot-row">
+<td colspan="2" align="right">Totale (2):</td>
+<td align="right">{formatta_cent(tot2_full)}</td>
+<td></td><td></td><td></td>
+</tr></tbody></table>
+
+<br>
+<table style="width:100%; border: 2px solid #000;">
+<tr>
+<td width="70%" align="right"><b>TOTALE INTERVENTO (1+2):</b></td>
+<td width="30%" align="right"><b>{formatta_cent(tot_qe)} €</b></td>
+</tr>
+<tr>
+<td align="right">Importo Stanziato:</td>
+<td align="right">{formatta_cent(imp_stanziato)} €</td>
+</tr>
+<tr>
+<td align="right"><b>Economie / (Fabbisogni):</b></td>
+<td align="right" style="color:{col_eco}"><b>{formatta_cent(economie)} €</b></td>
+</tr>
+</table>
+</body>
+</html>"""
+    return html
+
+
+def scrivi_csv_qe(f, db, qe_id, voci=None, calc=None):
+    """Scrive il QE in CSV (separatore ';', importi in formato italiano) sul file f"""
+    qe, proj, calc, cat_map, l1, l2 = sezioni_qe(db, qe_id, voci, calc)
+    t_oneri = calc.tot_oneri
+    t_iva = calc.tot_iva
+    t_tasse = calc.tot_tasse
+    
+    t1_imp = calc.tot_sec1
+    t2_imp = calc.tot_sec2_imp
+    
+    w = csv.writer(f, delimiter=';')
+    w.writerow(["Codice", "Descrizione", "Imponibile", "Oneri", "IVA", "Totale", "Note"])
+    
+    def write_group_section(items_list):
+        items_list.sort(key=lambda x: x['r'].codice_padre)
+        
+        for key, group in groupby(items_list, key=lambda x: x['r'].codice_padre):
+            g_list = list(group)
+            
+            s_imp = sum(x['imp'] for x in g_list)
+            s_one = sum(x['one'] for x in g_list)
+            s_iva = sum(x['iva'] for x in g_list)
+            s_tot = sum(x['tot'] for x in g_list)
+            
+            cat_desc = cat_map.get(key, f"Categoria {key}")
+            
+            w.writerow([
+                key, cat_desc.upper(), 
+                formatta_cent(s_imp), formatta_cent(s_one), 
+                formatta_cent(s_iva), formatta_cent(s_tot), 
+                "Riepilogo Categoria"
+            ])
+            
+            for i in g_list:
+                w.writerow([
+                    i['code'], i['desc'], 
+                    formatta_cent(i['imp']), formatta_cent(i['one']), 
+                    formatta_cent(i['iva']), formatta_cent(i['tot']), ""
+                ])
+    
+    w.writerow(["", "1. SPESE PER L'ESECUZIONE DELL'INTERVENTO", "", "", "", "", ""])
+    write_group_section(l1)
+    w.writerow(["", "Totale (1)", formatta_cent(t1_imp), "", "", "", ""])
+    
+    w.writerow([])
+    w.writerow(["", "2. SOMME A DISPOSIZIONE", "", "", "", "", ""])
+    write_group_section(l2)
+    w.writerow([
+        "", "Riepilogo IVA e Imposte", 
+        formatta_cent(t_tasse), formatta_cent(t_oneri), 
+        formatta_cent(t_iva), "", ""
+    ])
+    w.writerow(["", "Totale (2)", formatta_cent(t2_imp + t_tasse), "", "", "", ""])
+    
+    w.writerow([])
+    tot_qe = calc.totale
+    w.writerow(["", "TOTALE COMPLESSIVO", formatta_cent(tot_qe), "", "", "", ""])
+
+
+# =============================================================================
+# TOTALI DI PROGETTI E QE
+# =============================================================================
+CAMPI_TOTALI = (
+    "progetto_id", "cup", "titolo", "qe_id", "versione", "montante", "imponibile",
+    "imponibile_base_asta", "oneri", "iva", "totale", "stanziamento", "economie"
+)
+
+
+def totali_progetti(db, pid=None):
+    """Totali (in euro) di tutti i QE, da qe_totali: un dict per QE"""
+    progetti = {
+        r[0]: r for r in db.conn.execute(
+            "SELECT id, cup, titolo, importo_cent FROM progetti"
+        )
+    }
+    versioni = dict(db.conn.execute("SELECT id, nome_versione FROM quadri_economici"))
+
+    righe = []
+    for qid, p_id, mont, imp, imp_ba, one, iva, tot in db.get_totali_qe(pid):
+        proj = progetti.get(p_id, (p_id, "", "", 0))
+        stanz = proj[3] or 0
+        righe.append(dict(zip(CAMPI_TOTALI, (
+            p_id, proj[1], proj[2], qid, versioni.get(qid, ""),
+            euro(mont), euro(imp), euro(imp_ba), euro(one), euro(iva), euro(tot),
+            euro(stanz), euro(stanz - tot)
+        ))))
+    return righe
+
+
+# =============================================================================
+# MODALITÀ SENZA INTERFACCIA
+# =============================================================================
+# python qe_zero_2.0.0.py --headless <comando> [opzioni]  (oppure python qe_report.py ...)
+#   totals   totali di tutti i QE (JSON o CSV)
+#   report   stampa HTML di un QE (--qe) o di tutti i QE in una cartella
+#   export   CSV di un QE (--qe) o di tutti i QE in una cartella
+#   backup   copia del database (predefinito: QE_DATI/backup, o --out)
+#   check    verifica che le query frequenti usino gli indici (EXPLAIN QUERY PLAN)
+# Senza --out l'output di un singolo QE va su stdout.
+
+def _apri_output(percorso, bom=False):
+    if percorso in (None, "-"):
+        return sys.stdout, False
+    return open(percorso, "w", newline="", encoding="utf-8-sig" if bom else "utf-8"), True
+
+
+def _cmd_totals(db, args):
+    righe = totali_progetti(db, args.progetto)
+    f, chiudi = _apri_output(args.out, bom=args.formato == "csv")
+    try:
+        if args.formato == "csv":
+            w = csv.DictWriter(f, fieldnames=CAMPI_TOTALI, delimiter=";")
+            w.writeheader()
+            w.writerows(
+                {k: f"{v:.2f}" if isinstance(v, float) else v for k, v in r.items()}
+                for r in righe
+            )
+        else:
+            json.dump(righe, f, ensure_ascii=False, indent=2)
+            f.write("\n")
+    finally:
+        if chiudi:
+            f.close()
+
+
+def _elenco_qe(db, args):
+    if args.qe is not None:
+        return [args.qe]
+    return [r[0] for r in db.get_totali_qe(args.progetto)]
+
+
+def _cmd_per_qe(db, args, scrivi, estensione, bom):
+    """report/export: un QE su stdout o file, più QE in una cartella"""
+    elenco = _elenco_qe(db, args)
+    if args.qe is not None and (args.out is None or not os.path.isdir(args.out)):
+        f, chiudi = _apri_output(args.out, bom)
+        try:
+            scrivi(f, db, args.qe)
+        finally:
+            if chiudi:
+                f.close()
+        return
+
+    cartella = args.out or db.stampe_path
+    os.makedirs(cartella, exist_ok=True)
+    ts = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    prefisso = "Stampa_QE" if estensione == "html" else "QE"
+    for qid in elenco:
+        fn = os.path.join(cartella, f"{prefisso}_{qid}_{ts}.{estensione}")
+        with open(fn, "w", newline="", encoding="utf-8-sig" if bom else "utf-8") as f:
+            scrivi(f, db, qid)
+        print(fn)
+
+
+def _cmd_backup(db, args):
+    print(db.crea_backup(args.out))
+
+
+def _cmd_check(db, args):
+    """Piani di esecuzione delle query indicizzate; False se una non usa l'indice"""
+    esito = True
+    for descr, ok, piano in db.verifica_piani_query():
+        stato = "SALTATA" if ok is None else ("OK" if ok else "SCANSIONE")
+        print(f"{stato:9} {descr}: {piano}")
+        esito = esito and ok is not False
+    return esito
+
+
+def main(argv=None):
+    """Punto di ingresso della riga di comando; restituisce il codice di uscita"""
+    parser = argparse.ArgumentParser(
+        prog="qe_zero --headless",
+        description="QE Zero senza interfaccia grafica: totali, stampe, export, backup e verifiche"
+    )
+    parser.add_argument("comando", choices=("totals", "report", "export", "backup", "check"))
+    parser.add_argument("--db", help="percorso di un database esistente (predefinito: QE_DATI/qe_zero.db)")
+    parser.add_argument("--progetto", type=int, help="solo i QE di questo progetto")
+    parser.add_argument("--qe", type=int, help="un solo QE (report/export)")
+    parser.add_argument("--formato", choices=("json", "csv"), default="json",
+                        help="formato dei totali (predefinito: json)")
+    parser.add_argument("--out", help="file o cartella di destinazione (predefinito: stdout)")
+    args = parser.parse_args(argv)
+
+    if args.db:
+        # Relativo alla cartella corrente; un percorso sbagliato non deve
+        # creare un nuovo database con i dati demo
+        args.db = os.path.abspath(args.db)
+        if not os.path.isfile(args.db):
+            print(f"Database inesistente: {args.db}", file=sys.stderr)
+            return 1
+
+    try:
+        # I messaggi delle migrazioni non devono mescolarsi all'output (stdout)
+        with contextlib.redirect_stdout(sys.stderr):
+            db = DatabaseManager(args.db) if args.db else DatabaseManager()
+    except (OSError, sqlite3.Error) as e:
+        print(f"Impossibile aprire il database: {e}", file=sys.stderr)
+        return 1
+
+    try:
+        if args.comando == "totals":
+            _cmd_totals(db, args)
+        elif args.comando == "report":
+            _cmd_per_qe(db, args, lambda f, d, q: f.write(html_qe(d, q)), "html", False)
+        elif args.comando == "export":
+            _cmd_per_qe(db, args, scrivi_csv_qe, "csv", True)
+        elif args.comando == "backup":
+            _cmd_backup(db, args)
+        elif not _cmd_check(db, args):
+            return 1
+    except (OSError, ValueError, sqlite3.Error) as e:
+        print(f"Errore: {e}", file=sys.stderr)
+        return 1
+    finally:
+        db.chiudi()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -28,6 +28,17 @@ from openpyxl.styles import Font, Alignment, PatternFill, Border, Side
 import subprocess
 import platform
 
+from qe_calcolo import calcola_voci, euro, formatta_cent, formatta_euro, leggi_cent
+from qe_database import DatabaseManager, connetti, chiudi
+
+
+def col_importo_cent(conn, alias=""):
+    """Colonna importo_cent se il DB è già migrato ai centesimi, altrimenti NULL
+    (in quel caso il motore di calcolo converte valore_imponibile)"""
+    cols = [r[1] for r in conn.execute("PRAGMA table_info(voci)")]
+    return f"{alias}importo_cent" if "importo_cent" in cols else "NULL"
+
+
 # =============================================================================
 # CLASSE TAB 1: ESPORTATORE SCHEDE CATALOGO
 # =============================================================================
@@ -73,7 +84,7 @@ class TabExportCataloghi(ttk.Frame):
 
     def connetti_e_carica(self):
         try:
-            self.conn = sqlite3.connect(self.db_path)
+            self.conn = self.app_root.conn
             cursor = self.conn.cursor()
             cursor.execute("SELECT id, nome FROM normative ORDER BY id")
             self.list_norm.delete(0, tk.END); self.map_normative = {}
@@ -171,7 +182,7 @@ class TabBaseAsta(ttk.Frame):
 
     def connetti_e_carica(self):
         try:
-            self.conn = sqlite3.connect(self.db_path)
+            self.conn = self.app_root.conn
             cur = self.conn.cursor()
             cur.execute("SELECT id, titolo, cup FROM progetti ORDER BY id DESC")
             rows = cur.fetchall()
@@ -196,10 +207,9 @@ class TabBaseAsta(ttk.Frame):
         self.txt_preview.config(state='normal'); self.txt_preview.delete("1.0", tk.END); self.txt_preview.config(state='disabled')
         self.btn_export.config(state='disabled'); self.data_cache = None
 
-    def fmt(self, val):
-        try: v = float(val)
-        except: v = 0.0
-        return f"€ {v:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
+    def fmt(self, cent):
+        # Importi in centesimi interi
+        return "€ " + formatta_cent(cent)
 
     def on_select_qe(self, e):
         idx = self.cb_qe.current()
@@ -209,25 +219,24 @@ class TabBaseAsta(ttk.Frame):
     def calcola_riepilogo(self, qid):
         cur = self.conn.cursor()
         try:
-            cur.execute("""SELECT codice_completo, descrizione, valore_imponibile, is_percentuale, 
-                           flag_base_asta, flag_soggetto_ribasso, flag_calcolo_montante
+            cur.execute(f"""SELECT codice_completo, descrizione, valore_imponibile, is_percentuale, 
+                           flag_base_asta, flag_soggetto_ribasso, flag_calcolo_montante, {col_importo_cent(self.conn)},
+                           codice_padre, macro_base_calcolo
                            FROM voci WHERE qe_id=? ORDER BY codice_completo ASC""", (qid,))
             rows = cur.fetchall()
         except sqlite3.OperationalError:
             cur.execute("""SELECT codice_completo, descrizione, valore_imponibile, is_percentuale, 
-                           flag_base_asta, flag_soggetto_ribasso FROM voci WHERE qe_id=? ORDER BY codice_completo ASC""", (qid,))
-            rows = [list(r) + [0] for r in cur.fetchall()]
+                           flag_base_asta, flag_soggetto_ribasso, codice_padre, macro_base_calcolo
+                           FROM voci WHERE qe_id=? ORDER BY codice_completo ASC""", (qid,))
+            rows = [list(r[:6]) + [0, None] + list(r[6:]) for r in cur.fetchall()]
 
-        montante = 0.0
-        for r in rows:
-            if r[3] == 0 and r[6] == 1: montante += r[2]
+        calc = calcola_voci(rows, indici=(2, 3, None, None, None, 4, 6, 7), indici_basi=(8, 0, 9))
 
-        lista_A = []; lista_B = []; tot_A = 0.0; tot_B = 0.0
+        lista_A = []; lista_B = []; tot_A = 0; tot_B = 0
         
-        for r in rows:
-            cod, desc, raw_val, is_perc, flg_base, flg_rib, _ = r
+        for r, imp in zip(rows, calc.imp):
+            cod, desc, raw_val, is_perc, flg_base, flg_rib = r[:6]
             if flg_base == 1: 
-                imp = raw_val if is_perc == 0 else (montante * raw_val / 100)
                 item = (cod, desc, imp)
                 if flg_rib == 1: lista_A.append(item); tot_A += imp
                 else: lista_B.append(item); tot_B += imp
@@ -276,27 +285,27 @@ class TabBaseAsta(ttk.Frame):
             a_right = Alignment(horizontal="right"); a_left = Alignment(horizontal="left")
             
             ws.merge_cells('A1:B1')
-            ws['A1'] = "IMPORTO TOTALE A BASE D'ASTA"; ws['C1'] = float(self.data_cache['tot_gen'])
+            ws['A1'] = "IMPORTO TOTALE A BASE D'ASTA"; ws['C1'] = euro(self.data_cache['tot_gen'])
             ws['A1'].font = f_head; ws['A1'].fill = fill_blue; ws['B1'].fill = fill_blue
             ws['C1'].font = f_head; ws['C1'].fill = fill_blue; ws['C1'].number_format = '#,##0.00 €'; ws['C1'].alignment = a_right
             
             row = 3
             ws.merge_cells(f'A{row}:B{row}')
-            ws[f'A{row}'] = "A) IMPORTO SOGGETTO A RIBASSO"; ws[f'C{row}'] = float(self.data_cache['tot_A'])
+            ws[f'A{row}'] = "A) IMPORTO SOGGETTO A RIBASSO"; ws[f'C{row}'] = euro(self.data_cache['tot_A'])
             ws[f'A{row}'].font = f_green; ws[f'C{row}'].font = f_green; ws[f'C{row}'].number_format = '#,##0.00 €'; ws[f'C{row}'].alignment = a_right
             row += 1
             for i in self.data_cache['lista_A']:
-                ws[f'A{row}'] = i[0]; ws[f'B{row}'] = i[1]; ws[f'C{row}'] = float(i[2])
+                ws[f'A{row}'] = i[0]; ws[f'B{row}'] = i[1]; ws[f'C{row}'] = euro(i[2])
                 ws[f'C{row}'].number_format = '#,##0.00 €'; ws[f'C{row}'].alignment = a_right
                 for c in ['A','B','C']: ws[f'{c}{row}'].font = f_std; ws[f'{c}{row}'].border = b_bot
                 row += 1
             row += 2
             ws.merge_cells(f'A{row}:B{row}')
-            ws[f'A{row}'] = "B) SOMME NON SOGGETTE A RIBASSO"; ws[f'C{row}'] = float(self.data_cache['tot_B'])
+            ws[f'A{row}'] = "B) SOMME NON SOGGETTE A RIBASSO"; ws[f'C{row}'] = euro(self.data_cache['tot_B'])
             ws[f'A{row}'].font = f_red; ws[f'C{row}'].font = f_red; ws[f'C{row}'].number_format = '#,##0.00 €'; ws[f'C{row}'].alignment = a_right
             row += 1
             for i in self.data_cache['lista_B']:
-                ws[f'A{row}'] = i[0]; ws[f'B{row}'] = i[1]; ws[f'C{row}'] = float(i[2])
+                ws[f'A{row}'] = i[0]; ws[f'B{row}'] = i[1]; ws[f'C{row}'] = euro(i[2])
                 ws[f'C{row}'].number_format = '#,##0.00 €'; ws[f'C{row}'].alignment = a_right
                 for c in ['A','B','C']: ws[f'{c}{row}'].font = f_std; ws[f'{c}{row}'].border = b_bot
                 row += 1
@@ -358,7 +367,7 @@ class TabRiepilogoIva(ttk.Frame):
 
     def connetti_e_carica(self):
         try:
-            self.conn = sqlite3.connect(self.db_path)
+            self.conn = self.app_root.conn
             cur = self.conn.cursor()
             cur.execute("SELECT id, titolo, cup FROM progetti ORDER BY id DESC")
             rows = cur.fetchall()
@@ -386,10 +395,9 @@ class TabRiepilogoIva(ttk.Frame):
         self.btn_export.config(state='disabled')
         self.dati_iva = None
 
-    def fmt(self, val):
-        try: v = float(val)
-        except: v = 0.0
-        return f"€ {v:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
+    def fmt(self, cent):
+        # Importi in centesimi interi
+        return "€ " + formatta_cent(cent)
 
     def on_select_qe(self, e):
         idx = self.cb_qe.current()
@@ -407,27 +415,28 @@ class TabRiepilogoIva(ttk.Frame):
                 perc_iva,               -- 4
                 perc_oneri,             -- 5
                 includi_oneri_in_iva,   -- 6
-                codice_completo         -- 7
+                codice_completo,        -- 7
+                {cent},                 -- 8
+                codice_padre,           -- 9
+                macro_base_calcolo      -- 10
             FROM voci 
             WHERE qe_id=?
             ORDER BY codice_completo
         """
         try:
-            cur.execute(query, (qid,))
+            cur.execute(query.format(cent=col_importo_cent(self.conn)), (qid,))
             rows = cur.fetchall()
         except Exception as e:
             messagebox.showerror("Errore SQL", f"Errore lettura voci:\n{e}")
             return
 
-        montante = sum(r[0] for r in rows if r[1] == 0 and r[2] == 1)
+        calc = calcola_voci(rows, indici=(0, 1, 5, 6, 4, 3, 2, 8), indici_basi=(9, 7, 10))
 
         iva_base_dict = {} 
         iva_oneri_dict = {}
-        totale_generale_iva = 0.0
+        totale_generale_iva = 0
 
-        for r in rows:
-            raw_val = r[0]
-            is_perc = r[1]
+        for k, r in enumerate(rows):
             codice = r[7] if r[7] else "?"
             try: aliquota_iva = float(r[4]) if r[4] is not None else 0.0
             except: aliquota_iva = 0.0
@@ -435,23 +444,20 @@ class TabRiepilogoIva(ttk.Frame):
             except: perc_oneri = 0.0
             flag_iva_su_oneri = (r[6] == 1) 
 
-            valore_riga = (montante * raw_val / 100) if is_perc == 1 else raw_val
-
             if aliquota_iva > 0:
-                iva_base_calc = valore_riga * (aliquota_iva / 100.0)
+                iva_base_calc = calc.iva_imp[k]
                 if iva_base_calc != 0:
                     if aliquota_iva not in iva_base_dict:
-                        iva_base_dict[aliquota_iva] = {'importo': 0.0, 'codici': []}
+                        iva_base_dict[aliquota_iva] = {'importo': 0, 'codici': []}
                     iva_base_dict[aliquota_iva]['importo'] += iva_base_calc
                     iva_base_dict[aliquota_iva]['codici'].append(str(codice))
                     totale_generale_iva += iva_base_calc
 
             if perc_oneri > 0 and flag_iva_su_oneri and aliquota_iva > 0:
-                valore_onere = valore_riga * (perc_oneri / 100.0)
-                iva_onere_calc = valore_onere * (aliquota_iva / 100.0)
+                iva_onere_calc = calc.iva_oneri(k)
                 if iva_onere_calc != 0:
                     if aliquota_iva not in iva_oneri_dict:
-                        iva_oneri_dict[aliquota_iva] = {'importo': 0.0, 'codici': []}
+                        iva_oneri_dict[aliquota_iva] = {'importo': 0, 'codici': []}
                     iva_oneri_dict[aliquota_iva]['importo'] += iva_onere_calc
                     iva_oneri_dict[aliquota_iva]['codici'].append(str(codice))
                     totale_generale_iva += iva_onere_calc
@@ -534,7 +540,7 @@ class TabRiepilogoIva(ttk.Frame):
             a_wrap = Alignment(wrap_text=True, vertical="top")
 
             ws['A1'] = "TOTALE IVA CALCOLATA"
-            ws['B1'] = float(self.dati_iva['totale'])
+            ws['B1'] = euro(self.dati_iva['totale'])
             ws['A1'].font = f_head; ws['A1'].fill = fill_blue; ws['A1'].alignment = a_left
             ws['B1'].font = f_head; ws['B1'].fill = fill_blue; ws['B1'].alignment = a_right
             ws['B1'].number_format = '#,##0.00 €'
@@ -554,7 +560,7 @@ class TabRiepilogoIva(ttk.Frame):
                     desc = fmt_string.format(perc=self.get_perc_label(k), note=note_counter)
                     
                     ws[f'A{row}'] = desc
-                    ws[f'B{row}'] = float(item['importo'])
+                    ws[f'B{row}'] = euro(item['importo'])
                     ws[f'A{row}'].font = font_style; ws[f'A{row}'].alignment = a_left; ws[f'A{row}'].border = b_bot
                     ws[f'B{row}'].font = font_style; ws[f'B{row}'].number_format = '#,##0.00 €'; ws[f'B{row}'].alignment = a_right; ws[f'B{row}'].border = b_bot
                     row += 1; note_counter += 1
@@ -592,36 +598,10 @@ class TabCronoprogramma(ttk.Frame):
         
         self.voce_corrente_id = None 
         self.voce_corrente_iid = None 
-        self.totale_voce_target = 0.0
+        self.totale_voce_target = 0  # Centesimi
         
-        self.init_db_structure()
         self.setup_ui()
 
-    def init_db_structure(self):
-        try:
-            conn = sqlite3.connect(self.db_path)
-            conn.execute('''CREATE TABLE IF NOT EXISTS fpv_testata (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                qe_id INTEGER,
-                descrizione TEXT,
-                data_creazione TEXT,
-                FOREIGN KEY (qe_id) REFERENCES quadri_economici (id) ON DELETE CASCADE
-            )''')
-            conn.execute('''CREATE TABLE IF NOT EXISTS fpv_dettaglio (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                versione_id INTEGER,
-                voce_id INTEGER,
-                fornitore TEXT,
-                anno_1 REAL,
-                anno_2 REAL,
-                anno_3 REAL,
-                FOREIGN KEY (versione_id) REFERENCES fpv_testata (id) ON DELETE CASCADE,
-                FOREIGN KEY (voce_id) REFERENCES voci (id) ON DELETE CASCADE
-            )''')
-            conn.commit(); conn.close()
-        except Exception as e:
-            messagebox.showerror("Errore DB", f"Impossibile inizializzare tabelle FPV:\n{e}")
-
     def setup_ui(self):
         f_sel = ttk.LabelFrame(self, text="1. Seleziona Progetto e QE", padding=10)
         f_sel.pack(side='top', fill='x', padx=10, pady=5)
@@ -709,16 +689,15 @@ class TabCronoprogramma(ttk.Frame):
     def fmt(self, val): 
         try: v = float(val)
         except: v = 0.0
-        return f"{v:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
+        return formatta_euro(v)
     
-    def parse(self, val_str):
-        if not val_str: return 0.0
-        try: return float(str(val_str).replace("€", "").strip().replace(".", "").replace(",", "."))
-        except: return 0.0
+    def parse_cent(self, val_str):
+        # Stringa in formato italiano -> centesimi interi (senza passare dai float)
+        return leggi_cent(val_str)
 
     def connetti_e_carica(self):
         try:
-            self.conn = sqlite3.connect(self.db_path)
+            self.conn = self.app_root.conn
             cur = self.conn.cursor()
             cur.execute("SELECT id, titolo FROM progetti ORDER BY id DESC")
             rows = cur.fetchall()
@@ -775,47 +754,37 @@ class TabCronoprogramma(ttk.Frame):
         cur = self.conn.cursor()
         
         if versione_id:
-            query = """SELECT v.id, v.codice_completo, v.descrizione, v.valore_imponibile, v.is_percentuale, v.flag_calcolo_montante,
-                       v.perc_oneri, v.includi_oneri_in_iva, v.perc_iva, d.fornitore, d.anno_1, d.anno_2, d.anno_3
+            query = f"""SELECT v.id, v.codice_completo, v.descrizione, v.valore_imponibile, v.is_percentuale, v.flag_calcolo_montante,
+                       v.perc_oneri, v.includi_oneri_in_iva, v.perc_iva, d.fornitore, d.anno_1_cent, d.anno_2_cent, d.anno_3_cent,
+                       {col_importo_cent(self.conn, "v.")}, v.codice_padre, v.flag_base_asta, v.macro_base_calcolo
                        FROM voci v LEFT JOIN fpv_dettaglio d ON v.id = d.voce_id AND d.versione_id = ?
                        WHERE v.qe_id=? ORDER BY v.codice_completo"""
             cur.execute(query, (versione_id, qid))
         else:
-            query = """SELECT id, codice_completo, descrizione, valore_imponibile, is_percentuale, flag_calcolo_montante,
-                       perc_oneri, includi_oneri_in_iva, perc_iva, NULL, 0, 0, 0
+            query = f"""SELECT id, codice_completo, descrizione, valore_imponibile, is_percentuale, flag_calcolo_montante,
+                       perc_oneri, includi_oneri_in_iva, perc_iva, NULL, 0, 0, 0, {col_importo_cent(self.conn)},
+                       codice_padre, flag_base_asta, macro_base_calcolo
                        FROM voci WHERE qe_id=? ORDER BY codice_completo"""
             cur.execute(query, (qid,))
             
         rows = cur.fetchall()
-        montante = 0.0
-        for r in rows:
-            try: f_mont = r[5] 
-            except: f_mont = 0
-            if r[4] == 0 and f_mont == 1: montante += r[3]
-
-        for r in rows:
-            imp = r[3] if r[4] == 0 else (montante * r[3] / 100)
-            oneri = imp * r[6] / 100
-            base_iva = (imp + oneri) if r[7] == 1 else imp
-            iva = base_iva * r[8] / 100
-            tot_lordo = imp + oneri + iva
+        calc = calcola_voci(rows, indici=(3, 4, 6, 7, 8, 15, 5, 13), indici_basi=(14, 1, 16))
+
+        # Importi in centesimi: la riga è bilanciata solo se A1+A2+A3 == totale
+        for r, tot_lordo in zip(rows, calc.tot):
 
             forn = r[9] if r[9] else "Da individuare"
-            try: a1 = float(r[10]) if r[10] else 0.0
-            except: a1 = 0.0
-            try: a2 = float(r[11]) if r[11] else 0.0
-            except: a2 = 0.0
+            a1 = r[10] or 0
+            a2 = r[11] or 0
             
             if versione_id is None: a3 = tot_lordo 
-            else: 
-                try: a3 = float(r[12]) if r[12] is not None else (tot_lordo - a1 - a2)
-                except: a3 = 0.0
+            else: a3 = r[12] if r[12] is not None else (tot_lordo - a1 - a2)
 
-            diff = abs(tot_lordo - (a1 + a2 + a3))
-            icon = "✔" if diff < 0.02 else "⚠"
-            tag = "ok" if diff < 0.02 else "err"
+            ok = (a1 + a2 + a3 == tot_lordo)
+            icon = "✔" if ok else "⚠"
+            tag = "ok" if ok else "err"
 
-            self.tr.insert("", "end", iid=str(r[0]), values=(r[1], r[2], forn, self.fmt(tot_lordo), icon, a1, a2, a3), tags=(tag,))
+            self.tr.insert("", "end", iid=str(r[0]), values=(r[1], r[2], forn, self.fmt(euro(tot_lordo)), icon, a1, a2, a3), tags=(tag,))
 
     def on_select_voce(self, e):
         sel = self.tr.selection()
@@ -825,22 +794,23 @@ class TabCronoprogramma(ttk.Frame):
         vals = self.tr.item(sel)['values']
         
         self.lbl_info_voce.config(text=f"{vals[0]} - {vals[1]}")
-        self.totale_voce_target = self.parse(vals[3])
+        self.totale_voce_target = self.parse_cent(vals[3])
         self.var_forn.set(vals[2])
         
-        self.vars_anni[0].set(self.fmt(vals[5]))
-        self.vars_anni[1].set(self.fmt(vals[6]))
-        self.vars_anni[2].set(self.fmt(vals[7]))
+        # A1..A3 sono memorizzati nel treeview in centesimi
+        self.vars_anni[0].set(self.fmt(euro(int(vals[5]))))
+        self.vars_anni[1].set(self.fmt(euro(int(vals[6]))))
+        self.vars_anni[2].set(self.fmt(euro(int(vals[7]))))
         self.calcola_dinamica()
 
     def calcola_dinamica(self, event=None):
         if not self.voce_corrente_id: return
         try:
-            v1 = self.parse(self.vars_anni[0].get())
-            v2 = self.parse(self.vars_anni[1].get())
+            v1 = self.parse_cent(self.vars_anni[0].get())
+            v2 = self.parse_cent(self.vars_anni[1].get())
             residuo = self.totale_voce_target - (v1 + v2)
-            self.vars_anni[2].set(self.fmt(residuo))
-            if residuo < -0.01: self.lbl_diff.config(text="Eccesso (A1+A2 > Tot)", foreground="red")
+            self.vars_anni[2].set(self.fmt(euro(residuo)))
+            if residuo < 0: self.lbl_diff.config(text="Eccesso (A1+A2 > Tot)", foreground="red")
             else: self.lbl_diff.config(text="Bilanciato (Residuo in A3)", foreground="green")
         except: pass
 
@@ -851,8 +821,8 @@ class TabCronoprogramma(ttk.Frame):
         if not self.voce_corrente_id: return
         
         # 1. Ottengo i valori attuali
-        val_a1 = self.parse(self.vars_anni[0].get())
-        val_a3 = self.parse(self.vars_anni[2].get()) # Questo è il residuo visibile
+        val_a1 = self.parse_cent(self.vars_anni[0].get())
+        val_a3 = self.parse_cent(self.vars_anni[2].get()) # Questo è il residuo visibile
         
         # 2. Sommo il residuo (A3) al primo anno (A1)
         # Logica: Totale = A1 + A2 + A3. 
@@ -860,7 +830,7 @@ class TabCronoprogramma(ttk.Frame):
         nuovo_a1 = val_a1 + val_a3
         
         # 3. Aggiorno la GUI per A1
-        self.vars_anni[0].set(self.fmt(nuovo_a1))
+        self.vars_anni[0].set(self.fmt(euro(nuovo_a1)))
         
         # 4. Forzo il ricalcolo per aggiornare A3 (che diventerà 0) e le label di stato
         self.calcola_dinamica()
@@ -869,12 +839,12 @@ class TabCronoprogramma(ttk.Frame):
     def applica_modifiche_riga(self):
         if not self.voce_corrente_iid: return
         f = self.var_forn.get()
-        a1 = self.parse(self.vars_anni[0].get())
-        a2 = self.parse(self.vars_anni[1].get())
-        a3 = self.parse(self.vars_anni[2].get())
-        diff = abs(self.totale_voce_target - (a1 + a2 + a3))
-        icon = "✔" if diff < 0.02 else "⚠"
-        tag = "ok" if diff < 0.02 else "err"
+        a1 = self.parse_cent(self.vars_anni[0].get())
+        a2 = self.parse_cent(self.vars_anni[1].get())
+        a3 = self.parse_cent(self.vars_anni[2].get())
+        ok = (a1 + a2 + a3 == self.totale_voce_target)
+        icon = "✔" if ok else "⚠"
+        tag = "ok" if ok else "err"
         curr = list(self.tr.item(self.voce_corrente_iid, 'values'))
         curr[2] = f; curr[4] = icon; curr[5] = a1; curr[6] = a2; curr[7] = a3
         self.tr.item(self.voce_corrente_iid, values=curr, tags=(tag,))
@@ -903,8 +873,11 @@ class TabCronoprogramma(ttk.Frame):
             count = 0
             for iid in items:
                 vals = self.tr.item(iid)['values']
-                cur.execute("""INSERT INTO fpv_dettaglio (versione_id, voce_id, fornitore, anno_1, anno_2, anno_3)
-                               VALUES (?, ?, ?, ?, ?, ?)""", (ver_id, int(iid), vals[2], vals[5], vals[6], vals[7]))
+                a1, a2, a3 = int(vals[5]), int(vals[6]), int(vals[7])
+                cur.execute("""INSERT INTO fpv_dettaglio (versione_id, voce_id, fornitore, anno_1, anno_2, anno_3,
+                               anno_1_cent, anno_2_cent, anno_3_cent)
+                               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""", 
+                            (ver_id, int(iid), vals[2], euro(a1), euro(a2), euro(a3), a1, a2, a3))
                 count += 1
             self.conn.commit()
             messagebox.showinfo("Salvato", f"Versione salvata con successo!\nID: {ver_id}\nRighe: {count}")
@@ -923,10 +896,10 @@ class TabCronoprogramma(ttk.Frame):
         ws.append(["Codice", "Descrizione", "Fornitore", "Totale Lordo", "Anno 1", "Anno 2", "Anno 3"])
         for iid in children:
             v = self.tr.item(iid)['values']
-            tot = self.parse(v[3])
-            a1 = float(v[5])
-            a2 = float(v[6])
-            a3 = float(v[7])
+            tot = euro(self.parse_cent(v[3]))
+            a1 = euro(int(v[5]))
+            a2 = euro(int(v[6]))
+            a3 = euro(int(v[7]))
             ws.append([v[0], v[1], v[2], tot, a1, a2, a3])
             for c in range(4, 8): ws.cell(row=ws.max_row, column=c).number_format = '#,##0.00 €'
         ws.column_dimensions['B'].width = 50; ws.column_dimensions['C'].width = 30
@@ -948,9 +921,24 @@ class CatalogoExportApp(tk.Tk):
             if path_manuale and os.path.exists(path_manuale): self.db_path = path_manuale
             else: self.destroy(); return
 
+        # Una sola connessione (WAL) condivisa da tutte le schede
+        self.conn = connetti(self.db_path)
+        self.protocol("WM_DELETE_WINDOW", self.chiudi_app)
+
+        # Stesso registro di migrazioni di QE Zero (comprese le tabelle FPV):
+        # su un DB già aggiornato è una sola lettura di PRAGMA user_version
+        try:
+            DatabaseManager.su_connessione(self.conn).aggiorna_schema()
+        except sqlite3.Error as e:
+            messagebox.showerror("Errore DB", f"Impossibile aggiornare la struttura del database:\n{e}")
+
         self.setup_ui()
         self.avvia_connessioni()
 
+    def chiudi_app(self):
+        chiudi(self.conn)
+        self.destroy()
+
     def trova_percorso_db(self):
         db_name = "qe_zero.db"
         program_dir = os.path.dirname(os.path.abspath(__file__))
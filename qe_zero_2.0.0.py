@@ -16,6 +16,13 @@
 # Contatti: rodolfo.sabelli@gmail.com
 # Repository: [URL GITHUB/GITLAB]
 
+import sys
+
+# Modalità senza interfaccia (server, job notturni): non importa tkinter
+if __name__ == "__main__" and "--headless" in sys.argv[1:]:
+    from qe_report import main
+    sys.exit(main([a for a in sys.argv[1:] if a != "--headless"]))
+
 import tkinter as tk
 from tkinter import ttk
 from tkinter import messagebox
@@ -27,630 +34,25 @@ import os
 import webbrowser
 import csv
 import urllib.request
-import shutil
 import subprocess
 import platform
-from itertools import groupby
-
-# =============================================================================
-# 1. DATABASE MANAGER
-# =============================================================================
-class DatabaseManager:
-    def __init__(self, db_name="qe_zero.db"):
-        """Inizializza il database manager con percorsi ottimizzati"""
-        # PATH LOGIC OTTIMIZZATA
-        program_dir = os.path.dirname(os.path.abspath(__file__))
-        local_path = os.path.join(program_dir, "QE_DATI")
-
-        # Modalità Portable: cartella locale ha priorità
-        if os.path.exists(local_path):
-            self.documents_path = local_path
-            # NUOVO: Se siamo in portable, la cartella stampe sta nella directory del programma
-            # Risultato: .../QE_ZERO/QE_STAMPE
-            self.stampe_path = os.path.join(program_dir, "QE_STAMPE")
-        else:
-            # Modalità Standard: cartella in Documenti utente
-            base_docs = os.path.expanduser("~/Documents")
-            self.documents_path = os.path.join(base_docs, "QE_DATI")
-            
-            # NUOVO: Se siamo in standard, la cartella stampe sta in Documenti
-            # Risultato: ~/Documents/QE_STAMPE (accanto a QE_DATI)
-            self.stampe_path = os.path.join(base_docs, "QE_STAMPE")
-            
-            # Creazione cartella DATI (Logica esistente)
-            if not os.path.exists(self.documents_path):
-                try:
-                    os.makedirs(self.documents_path)
-                except OSError as e:
-                    messagebox.showerror(
-                        "Errore", 
-                        f"Impossibile creare la cartella {self.documents_path}\n{e}"
-                    )
-
-        # --- NUOVO CODICE AGGIUNTO: CREAZIONE CARTELLA STAMPE ---
-        # Questo blocco viene eseguito a prescindere dalla modalità (Portable o Standard)
-        # Verifica se QE_STAMPE esiste, altrimenti la crea
-        if not os.path.exists(self.stampe_path):
-            try:
-                os.makedirs(self.stampe_path)
-            except OSError as e:
-                # Gestione errore non bloccante (puoi cambiare in messagebox se preferisci)
-                print(f"Errore nella creazione della cartella stampe: {e}")
-        # --------------------------------------------------------
-
-        self.db_path = os.path.join(self.documents_path, db_name)   
-        self.conn = sqlite3.connect(self.db_path)
-        self.conn.execute("PRAGMA foreign_keys = 1")
-        
-        # Sequenza inizializzazione ottimizzata
-        self.crea_tabelle()
-        self.check_aggiornamento_db_allegati()
-        self.migra_db_1_3()
-        self.popola_dati_base()
-        self.popola_demo_se_vuoto()
-
-    def crea_tabelle(self):
-        """Crea tutte le tabelle del database con schema ottimizzato"""
-        c = self.conn.cursor()
-        
-        # Tabella normative
-        c.execute('''CREATE TABLE IF NOT EXISTS normative (
-            id INTEGER PRIMARY KEY AUTOINCREMENT, 
-            nome TEXT UNIQUE, 
-            descrizione TEXT
-        )''')
-        
-        # Tabella progetti
-        c.execute('''CREATE TABLE IF NOT EXISTS progetti (
-            id INTEGER PRIMARY KEY AUTOINCREMENT, 
-            normativa_id INTEGER, 
-            cup TEXT, 
-            anno INTEGER, 
-            titolo TEXT, 
-            importo REAL, 
-            FOREIGN KEY (normativa_id) REFERENCES normative (id)
-        )''')
-        
-        # Tabella quadri economici
-        c.execute('''CREATE TABLE IF NOT EXISTS quadri_economici (
-            id INTEGER PRIMARY KEY AUTOINCREMENT, 
-            progetto_id INTEGER, 
-            nome_versione TEXT, 
-            data_creazione TEXT, 
-            note TEXT, 
-            FOREIGN KEY (progetto_id) REFERENCES progetti (id) ON DELETE CASCADE
-        )''')
-        
-        # Tabella voci (include flag_calcolo_montante)
-        c.execute('''CREATE TABLE IF NOT EXISTS voci (
-            id INTEGER PRIMARY KEY AUTOINCREMENT, 
-            qe_id INTEGER, 
-            codice_padre TEXT, 
-            codice_completo TEXT, 
-            descrizione TEXT, 
-            tipo TEXT, 
-            valore_imponibile REAL, 
-            is_percentuale INTEGER, 
-            perc_oneri REAL, 
-            includi_oneri_in_iva INTEGER, 
-            perc_iva REAL, 
-            flag_base_asta INTEGER, 
-            flag_soggetto_ribasso INTEGER, 
-            macro_base_calcolo TEXT, 
-            flag_calcolo_montante INTEGER DEFAULT 0, 
-            FOREIGN KEY (qe_id) REFERENCES quadri_economici (id) ON DELETE CASCADE
-        )''')
-        
-        # Tabella catalogo voci
-        c.execute('''CREATE TABLE IF NOT EXISTS catalogo_voci (
-            id INTEGER PRIMARY KEY AUTOINCREMENT, 
-            normativa_id INTEGER, 
-            codice TEXT, 
-            macro_gruppo INTEGER, 
-            descrizione TEXT, 
-            UNIQUE(normativa_id, codice), 
-            FOREIGN KEY (normativa_id) REFERENCES normative (id) ON DELETE CASCADE
-        )''')
-        
-        # Tabella configurazione
-        c.execute('''CREATE TABLE IF NOT EXISTS configurazione (
-            chiave TEXT PRIMARY KEY, 
-            valore TEXT
-        )''')
-        
-        # Tabella allegati (include descrizione)
-        c.execute('''CREATE TABLE IF NOT EXISTS allegati_qe (
-            id INTEGER PRIMARY KEY AUTOINCREMENT, 
-            qe_id INTEGER, 
-            nome_file TEXT, 
-            tipo_file TEXT, 
-            dati BLOB, 
-            data_caricamento TEXT,
-            descrizione TEXT DEFAULT '',
-            FOREIGN KEY (qe_id) REFERENCES quadri_economici (id) ON DELETE CASCADE
-        )''')
-        
-        self.conn.commit()
-
-    def check_aggiornamento_db_allegati(self):
-        """Migrazione: aggiunge colonna descrizione a tabella allegati se mancante"""
-        try:
-            self.conn.execute("SELECT descrizione FROM allegati_qe LIMIT 1")
-        except sqlite3.OperationalError:
-            try:
-                self.conn.execute("ALTER TABLE allegati_qe ADD COLUMN descrizione TEXT DEFAULT ''")
-                self.conn.commit()
-                print("✓ Migrazione allegati: colonna 'descrizione' aggiunta")
-            except sqlite3.OperationalError:
-                pass  # Colonna già esistente
-    
-    def migra_db_1_3(self):
-        """Migrazione v1.3: aggiunge flag_calcolo_montante per DB legacy"""
-        try:
-            self.conn.execute("SELECT flag_calcolo_montante FROM voci LIMIT 1")
-        except sqlite3.OperationalError:
-            try:
-                self.conn.execute("ALTER TABLE voci ADD COLUMN flag_calcolo_montante INTEGER DEFAULT 0")
-                self.conn.commit()
-                print("✓ Migrazione v1.3: colonna 'flag_calcolo_montante' aggiunta")
-            except sqlite3.OperationalError:
-                pass  # Colonna già esistente
-
-    def popola_dati_base(self):
-        """Popola dati iniziali: configurazione e normative standard"""
-        # Configurazione base
-        self.conn.execute(
-            "INSERT OR IGNORE INTO configurazione (chiave, valore) VALUES (?, ?)", 
-            ("admin_password", "admin")
-        )
-        
-        # Normative standard
-        normative = [
-            ("D.Lgs. 36/2023 - Opere", "Realizzazione di opere pubbliche"),
-            ("D.Lgs. 36/2023 - Beni e Servizi", "Acquisizione di beni e servizi"),
-            ("DPR 207/2010", "Ex Regolamento"),
-            ("FESR 2021-2027", "Realizzazione di opere pubbliche")
-        ]
-        
-        for n, d in normative: 
-            self.conn.execute(
-                "INSERT OR IGNORE INTO normative (nome, descrizione) VALUES (?, ?)", 
-                (n, d)
-            )
-        
-        self.conn.commit()
-        
-        # Popolamento catalogo D.Lgs. 36/2023 - Opere
-        try:
-            id_36_opere = self.conn.execute("SELECT id FROM normative WHERE nome='D.Lgs. 36/2023 - Opere'").fetchone()[0]
-            if self.conn.execute("SELECT count(*) FROM catalogo_voci WHERE normativa_id=?", (id_36_opere,)).fetchone()[0] == 0:
-                dati = [(id_36_opere, "A", 1, "IMPORTO DEI LAVORI"), (id_36_opere, "B", 1, "IMPORTO DEI COSTI DELLA SICUREZZA"), (id_36_opere, "C", 1, "IMPORTO PER IL CONTRASTO ALLA CRIMINALITÀ"), (id_36_opere, "D", 1, "OPERE DI MITIGAZIONE E COSTI AMBIENTALI"),
-                        (id_36_opere, "E.01", 2, "Lavori in amministrazione diretta"), (id_36_opere, "E.02", 2, "Rilievi e indagini (a cura della S.A.)"), (id_36_opere, "E.03", 2, "Rilievi e indagini (a cura del Progettista)"), (id_36_opere, "E.04", 2, "Allacciamenti pubblici servizi"), (id_36_opere, "E.05", 2, "Imprevisti"), (id_36_opere, "E.06", 2, "Accantonamenti"), (id_36_opere, "E.07", 2, "Acquisizione aree/espropri"), (id_36_opere, "E.08", 2, "Spese tecniche"), (id_36_opere, "E.09", 2, "Spese attività tecnico-amministrative"), (id_36_opere, "E.10", 2, "Spese Art. 45"), (id_36_opere, "E.11", 2, "Commissioni"), (id_36_opere, "E.12", 2, "Pubblicità"), (id_36_opere, "E.13", 2, "Prove laboratorio"), (id_36_opere, "E.14", 2, "Collaudi"), (id_36_opere, "E.15", 2, "Verifica archeologica"), (id_36_opere, "E.16", 2, "Tutela giurisdizionale"), (id_36_opere, "E.17", 2, "Opere artistiche")]
-                self.conn.executemany("INSERT OR IGNORE INTO catalogo_voci (normativa_id, codice, macro_gruppo, descrizione) VALUES (?, ?, ?, ?)", dati)
-        except: pass
-        try:
-            id_36_serv = self.conn.execute("SELECT id FROM normative WHERE nome='D.Lgs. 36/2023 - Beni e Servizi'").fetchone()[0]
-            if self.conn.execute("SELECT count(*) FROM catalogo_voci WHERE normativa_id=?", (id_36_serv,)).fetchone()[0] == 0:
-                dati = [(id_36_serv, "1.01", 1, "Importo servizi/forniture"), (id_36_serv, "1.02", 1, "Oneri sicurezza interferenziali"), (id_36_serv, "2.01", 2, "Lavori in economia"), (id_36_serv, "2.02", 2, "Imprevisti"), (id_36_serv, "2.03", 2, "Spese tecniche"), (id_36_serv, "2.04", 2, "Pubblicità/Gara"), (id_36_serv, "2.05", 2, "Revisione prezzi")]
-                self.conn.executemany("INSERT OR IGNORE INTO catalogo_voci (normativa_id, codice, macro_gruppo, descrizione) VALUES (?, ?, ?, ?)", dati)
-        except: pass
-        try:
-            id_207 = self.conn.execute("SELECT id FROM normative WHERE nome='DPR 207/2010'").fetchone()[0]
-            if self.conn.execute("SELECT count(*) FROM catalogo_voci WHERE normativa_id=?", (id_207,)).fetchone()[0] == 0:
-                dati = [(id_207, "1.01", 1, "Lavori"), (id_207, "1.02", 1, "Sicurezza"), (id_207, "2.01", 2, "Lavori in economia"), (id_207, "2.02", 2, "Rilievi, accertamenti e indagini"), (id_207, "2.03", 2, "Allacciamenti"), (id_207, "2.04", 2, "Imprevisti"), (id_207, "2.05", 2, "Acquisizione aree"), (id_207, "2.06", 2, "Revisione prezzi"), (id_207, "2.07", 2, "Spese tecniche"), (id_207, "2.08", 2, "Spese per attività amministrative"), (id_207, "2.09", 2, "Commissioni di gara"), (id_207, "2.10", 2, "Pubblicità"), (id_207, "2.11", 2, "Collaudi")]
-                self.conn.executemany("INSERT OR IGNORE INTO catalogo_voci (normativa_id, codice, macro_gruppo, descrizione) VALUES (?, ?, ?, ?)", dati)
-        except: pass
-        try:
-            id_fesr = self.conn.execute("SELECT id FROM normative WHERE nome='FESR 2021-2027'").fetchone()[0]
-            if self.conn.execute("SELECT count(*) FROM catalogo_voci WHERE normativa_id=?", (id_fesr,)).fetchone()[0] == 0:
-                dati = [(id_fesr, "A.01", 1, "Lavori"), (id_fesr, "A.02", 1, "Sicurezza"), (id_fesr, "B.01", 2, "Economia"), (id_fesr, "B.02", 2, "Rilievi"), (id_fesr, "B.03", 2, "Allacciamenti"), (id_fesr, "B.04", 2, "Imprevisti"), (id_fesr, "B.05", 2, "Aree"), (id_fesr, "B.06", 2, "Accantonamenti"), (id_fesr, "B.07", 2, "Spese tecniche"), (id_fesr, "B.08", 2, "Consulenza"), (id_fesr, "B.09", 2, "Commissioni"), (id_fesr, "B.10", 2, "Pubblicità"), (id_fesr, "B.11", 2, "Collaudi"), (id_fesr, "B.12", 2, "Forniture")]
-                self.conn.executemany("INSERT OR IGNORE INTO catalogo_voci (normativa_id, codice, macro_gruppo, descrizione) VALUES (?, ?, ?, ?)", dati)
-        except: pass
-        self.conn.commit()
-        
-    def popola_demo_se_vuoto(self):
-        """Crea progetto demo solo se il database è completamente vuoto"""
-        count = self.conn.execute("SELECT count(*) FROM progetti").fetchone()[0]
-        
-        if count == 0:
-            try:
-                id_36 = self.conn.execute(
-                    "SELECT id FROM normative WHERE nome='D.Lgs. 36/2023 - Opere'"
-                ).fetchone()
-                
-                if not id_36:
-                    return
-                
-                id_36 = id_36[0]
-                
-                # Inserisci progetto demo
-                self.conn.execute(
-                    """INSERT INTO progetti 
-                    (normativa_id, cup, anno, titolo, importo) 
-                    VALUES (?,?,?,?,?)""", 
-                    (id_36, "H61I24000130006", 2025, "Rete di attracchi via mare", 5623000.0)
-                )
-                
-                pid = self.conn.execute("SELECT last_insert_rowid()").fetchone()[0]
-                
-                # Inserisci QE demo
-                self.conn.execute(
-                    """INSERT INTO quadri_economici 
-                    (progetto_id, nome_versione, data_creazione, note) 
-                    VALUES (?,?,?,?)""", 
-                    (pid, "1. PFTE", datetime.date.today().strftime("%d/%m/%Y"), "Versione 1.0")
-                )
-                
-                qid1 = self.conn.execute("SELECT last_insert_rowid()").fetchone()[0]
-                
-                # Inserisci voce demo
-                self.conn.execute(
-                    """INSERT INTO voci 
-                    (qe_id, codice_padre, codice_completo, descrizione, tipo, 
-                    valore_imponibile, is_percentuale, perc_oneri, includi_oneri_in_iva, 
-                    perc_iva, flag_base_asta, flag_soggetto_ribasso, macro_base_calcolo, 
-                    flag_calcolo_montante) 
-                    VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)""", 
-                    (qid1, "A", "A.01", "Lavori Edili", "fisso", 100000.0, 
-                     0, 0, 0, 10.0, 1, 1, "", 1)
-                )
-                
-                self.conn.commit()
-                print("✓ Progetto demo creato con successo")
-                
-            except Exception as e:
-                print(f"Errore creazione progetto demo: {e}")
-
-    # --- CRUD OPERATIONS: CONFIGURAZIONE E NORMATIVE ---
-    
-    def get_normative(self):
-        """Recupera tutte le normative ordinate per ID"""
-        return self.conn.execute(
-            "SELECT id, nome, descrizione FROM normative ORDER BY id"
-        ).fetchall()
-    
-    def get_config(self, k):
-        """Recupera valore di configurazione per chiave"""
-        r = self.conn.execute(
-            "SELECT valore FROM configurazione WHERE chiave=?", (k,)
-        ).fetchone()
-        return r[0] if r else ""
-    
-    def set_config(self, k, v):
-        """Salva valore di configurazione"""
-        self.conn.execute(
-            "INSERT OR REPLACE INTO configurazione (chiave, valore) VALUES (?, ?)", 
-            (k, v)
-        )
-        self.conn.commit()
-    
-    def inserisci_normativa(self, n, d):
-        """Inserisce nuova normativa"""
-        try:
-            self.conn.execute(
-                "INSERT INTO normative (nome, descrizione) VALUES (?, ?)", 
-                (n, d)
-            )
-            self.conn.commit()
-            return True
-        except sqlite3.IntegrityError:
-            return False
-    
-    def aggiorna_normativa(self, nid, n, d):
-        """Aggiorna normativa esistente"""
-        try:
-            self.conn.execute(
-                "UPDATE normative SET nome=?, descrizione=? WHERE id=?", 
-                (n, d, nid)
-            )
-            self.conn.commit()
-            return True
-        except sqlite3.IntegrityError:
-            return False
-    
-    def elimina_normativa(self, nid):
-        """Elimina normativa (e progetti collegati in cascade)"""
-        self.conn.execute("DELETE FROM normative WHERE id=?", (nid,))
-        self.conn.commit()
-    
-    def duplica_normativa(self, old_id, new_name, new_desc):
-        """Duplica normativa e il suo catalogo voci"""
-        try:
-            self.conn.execute(
-                "INSERT INTO normative (nome, descrizione) VALUES (?, ?)", 
-                (new_name, new_desc)
-            )
-            new_id = self.conn.execute("SELECT last_insert_rowid()").fetchone()[0]
-            
-            self.conn.execute(
-                """INSERT INTO catalogo_voci 
-                (normativa_id, codice, macro_gruppo, descrizione) 
-                SELECT ?, codice, macro_gruppo, descrizione 
-                FROM catalogo_voci WHERE normativa_id = ?""", 
-                (new_id, old_id)
-            )
-            
-            self.conn.commit()
-            return True
-        except Exception as e:
-            print(f"Errore duplicazione normativa: {e}")
-            return False
-
-    # --- CRUD OPERATIONS: CATALOGO VOCI ---
-    
-    def get_catalogo(self, normativa_id, mid=None):
-        """Recupera catalogo voci per normativa (opzionalmente filtrato per macro)"""
-        sql = """SELECT id, codice, macro_gruppo, descrizione 
-                 FROM catalogo_voci WHERE normativa_id=?"""
-        params = [normativa_id]
-        
-        if mid is not None:
-            sql += " AND macro_gruppo=?"
-            params.append(mid)
-        
-        sql += " ORDER BY codice"
-        
-        return self.conn.execute(sql, params).fetchall()
-    
-    def aggiorna_catalogo(self, nid, c, m, d):
-        """Aggiorna o inserisce voce di catalogo"""
-        r = self.conn.execute(
-            "SELECT id FROM catalogo_voci WHERE normativa_id=? AND codice=?", 
-            (nid, c)
-        ).fetchone()
-        
-        if not r:
-            self.conn.execute(
-                """INSERT INTO catalogo_voci 
-                (normativa_id, codice, macro_gruppo, descrizione) 
-                VALUES (?,?,?,?)""", 
-                (nid, c, m, d)
-            )
-        else:
-            self.conn.execute(
-                """UPDATE catalogo_voci 
-                SET macro_gruppo=?, descrizione=? WHERE id=?""", 
-                (m, d, r[0])
-            )
-        
-        self.conn.commit()
-    
-    def aggiorna_voce_catalogo_id(self, cat_id, nid, c, m, d):
-        """Aggiorna voce catalogo per ID (o inserisce se None)"""
-        if cat_id:
-            self.conn.execute(
-                """UPDATE catalogo_voci 
-                SET codice=?, macro_gruppo=?, descrizione=? WHERE id=?""", 
-                (c, m, d, cat_id)
-            )
-        else:
-            self.conn.execute(
-                """INSERT INTO catalogo_voci 
-                (normativa_id, codice, macro_gruppo, descrizione) 
-                VALUES (?,?,?,?)""", 
-                (nid, c, m, d)
-            )
-        self.conn.commit()
-    
-    def elimina_voce_catalogo(self, cat_id):
-        """Elimina voce dal catalogo"""
-        self.conn.execute("DELETE FROM catalogo_voci WHERE id=?", (cat_id,))
-        self.conn.commit()
-
-    # --- CRUD OPERATIONS: PROGETTI ---
-    
-    def get_prossimo_codice(self, qe_id, codice_padre):
-        """Calcola il prossimo codice disponibile per una categoria"""
-        rows = self.conn.execute(
-            "SELECT codice_completo FROM voci WHERE qe_id=? AND codice_padre=?", 
-            (qe_id, codice_padre)
-        ).fetchall()
-        
-        numeri = [
-            int(r[0].split('.')[-1]) 
-            for r in rows 
-            if r[0].split('.')[-1].isdigit()
-        ]
-        
-        prossimo = max(numeri) + 1 if numeri else 1
-        return f"{codice_padre}.{prossimo:02d}"
-    
-    def inserisci_progetto(self, nid, c, a, t, i):
-        """Inserisce nuovo progetto"""
-        self.conn.execute(
-            """INSERT INTO progetti 
-            (normativa_id, cup, anno, titolo, importo) 
-            VALUES (?,?,?,?,?)""", 
-            (nid, c, a, t, i)
-        )
-        self.conn.commit()
-    
-    def aggiorna_progetto_dati(self, pid, c, a, t, i):
-        """Aggiorna dati progetto esistente"""
-        self.conn.execute(
-            """UPDATE progetti 
-            SET cup=?, anno=?, titolo=?, importo=? 
-            WHERE id=?""", 
-            (c, a, t, i, pid)
-        )
-        self.conn.commit()
-    
-    def elimina_progetto(self, pid):
-        """Elimina progetto (QE in cascade)"""
-        self.conn.execute("DELETE FROM progetti WHERE id=?", (pid,))
-        self.conn.commit()
-    
-    def get_tutti_progetti(self):
-        """Recupera tutti i progetti con info normativa"""
-        return self.conn.execute(
-            """SELECT p.id, p.cup, p.anno, p.titolo, p.importo, n.nome 
-            FROM progetti p 
-            JOIN normative n ON p.normativa_id = n.id 
-            ORDER BY p.id DESC"""
-        ).fetchall()
-    
-    def get_progetto_by_id(self, pid):
-        """Recupera singolo progetto per ID"""
-        return self.conn.execute(
-            "SELECT * FROM progetti WHERE id=?", (pid,)
-        ).fetchone()
-
-    # --- CRUD OPERATIONS: QUADRI ECONOMICI ---
-    
-    def inserisci_qe(self, pid, n, nt):
-        """Inserisce nuovo QE"""
-        self.conn.execute(
-            """INSERT INTO quadri_economici 
-            (progetto_id, nome_versione, data_creazione, note) 
-            VALUES (?,?,?,?)""", 
-            (pid, n, datetime.date.today().strftime("%d/%m/%Y"), nt)
-        )
-        self.conn.commit()
-    
-    def aggiorna_qe(self, qid, n, nt):
-        """Aggiorna QE esistente"""
-        self.conn.execute(
-            """UPDATE quadri_economici 
-            SET nome_versione=?, note=? 
-            WHERE id=?""", 
-            (n, nt, qid)
-        )
-        self.conn.commit()
-    
-    def elimina_qe(self, qid):
-        """Elimina QE (voci in cascade)"""
-        self.conn.execute("DELETE FROM quadri_economici WHERE id=?", (qid,))
-        self.conn.commit()
-    
-    def duplica_qe(self, qid, n):
-        """Duplica QE con tutte le sue voci"""
-        r = self.conn.execute(
-            "SELECT * FROM quadri_economici WHERE id=?", (qid,)
-        ).fetchone()
-        
-        if not r:
-            return
-        
-        # Inserisci nuovo QE
-        self.conn.execute(
-            """INSERT INTO quadri_economici 
-            (progetto_id, nome_versione, data_creazione, note) 
-            VALUES (?,?,?,?)""", 
-            (r[1], n, datetime.date.today().strftime("%d/%m/%Y"), f"Copia di {r[2]}")
-        )
-        new_qid = self.conn.execute("SELECT last_insert_rowid()").fetchone()[0]
-        
-        # Copia tutte le voci
-        voci = self.conn.execute("SELECT * FROM voci WHERE qe_id=?", (qid,)).fetchall()
-        
-        for v in voci:
-            # Gestione compatibilità: flag_calcolo_montante potrebbe non esistere
-            f_mont = v[14] if len(v) > 14 else 0
-            
-            self.conn.execute(
-                """INSERT INTO voci 
-                (qe_id, codice_padre, codice_completo, descrizione, tipo, 
-                valore_imponibile, is_percentuale, perc_oneri, includi_oneri_in_iva, 
-                perc_iva, flag_base_asta, flag_soggetto_ribasso, macro_base_calcolo, 
-                flag_calcolo_montante) 
-                VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)""", 
-                (new_qid, v[2], v[3], v[4], v[5], v[6], v[7], v[8], v[9], 
-                 v[10], v[11], v[12], v[13], f_mont)
-            )
-        
-        self.conn.commit()
-    
-    def get_qe_by_progetto(self, pid):
-        """Recupera tutti i QE di un progetto"""
-        return self.conn.execute(
-            "SELECT * FROM quadri_economici WHERE progetto_id=? ORDER BY id DESC", 
-            (pid,)
-        ).fetchall()
-    
-    def get_qe_by_id(self, qid):
-        """Recupera singolo QE per ID"""
-        return self.conn.execute(
-            "SELECT * FROM quadri_economici WHERE id=?", (qid,)
-        ).fetchone()
-
-    # --- CRUD OPERATIONS: VOCI ---
-    
-    def get_voci_by_qe(self, qid):
-        """Recupera tutte le voci di un QE"""
-        return self.conn.execute(
-            "SELECT * FROM voci WHERE qe_id=? ORDER BY codice_completo ASC", 
-            (qid,)
-        ).fetchall()
-    
-    def inserisci_voce(self, qe_id, cp, cf, desc, tipo, val, isp, po, inc, pi, 
-                       f_base, f_rib, m_base, f_mont):
-        """Inserisce nuova voce"""
-        self.conn.execute(
-            """INSERT INTO voci 
-            (qe_id, codice_padre, codice_completo, descrizione, tipo, 
-            valore_imponibile, is_percentuale, perc_oneri, includi_oneri_in_iva, 
-            perc_iva, flag_base_asta, flag_soggetto_ribasso, macro_base_calcolo, 
-            flag_calcolo_montante) 
-            VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)""", 
-            (qe_id, cp, cf, desc, tipo, val, isp, po, inc, pi, f_base, f_rib, m_base, f_mont)
-        )
-        self.conn.commit()
-    
-    def aggiorna_voce(self, vid, desc, val, isp, po, inc, pi, f_base, f_rib, 
-                      m_base, tipo_str, f_mont):
-        """Aggiorna voce esistente"""
-        self.conn.execute(
-            """UPDATE voci SET 
-            descrizione=?, valore_imponibile=?, is_percentuale=?, perc_oneri=?, 
-            includi_oneri_in_iva=?, perc_iva=?, flag_base_asta=?, 
-            flag_soggetto_ribasso=?, macro_base_calcolo=?, tipo=?, 
-            flag_calcolo_montante=? 
-            WHERE id=?""", 
-            (desc, val, isp, po, inc, pi, f_base, f_rib, m_base, tipo_str, f_mont, vid)
-        )
-        self.conn.commit()
-    
-    def elimina_voce(self, vid):
-        """Elimina voce"""
-        self.conn.execute("DELETE FROM voci WHERE id=?", (vid,))
-        self.conn.commit()
-
-    # --- CRUD OPERATIONS: ALLEGATI ---
-    
-    def inserisci_allegato(self, qe_id, nome, tipo, blob_data):
-        """Inserisce nuovo allegato"""
-        self.conn.execute(
-            """INSERT INTO allegati_qe 
-            (qe_id, nome_file, tipo_file, dati, data_caricamento) 
-            VALUES (?, ?, ?, ?, ?)""", 
-            (qe_id, nome, tipo, blob_data, 
-             datetime.datetime.now().strftime("%d/%m/%Y %H:%M"))
-        )
-        self.conn.commit()
-    
-    def get_allegati_headers_by_qe(self, qe_id):
-        """Recupera lista allegati (senza blob) per un QE"""
-        return self.conn.execute(
-            """SELECT id, nome_file, data_caricamento 
-            FROM allegati_qe WHERE qe_id=? ORDER BY id DESC""", 
-            (qe_id,)
-        ).fetchall()
-    
-    def get_allegato_blob(self, all_id):
-        """Recupera blob allegato per ID"""
-        return self.conn.execute(
-            "SELECT nome_file, dati FROM allegati_qe WHERE id=?", 
-            (all_id,)
-        ).fetchone()
-    
-    def elimina_allegato(self, all_id):
-        """Elimina allegato"""
-        self.conn.execute("DELETE FROM allegati_qe WHERE id=?", (all_id,))
-        self.conn.commit()
+import bisect
+import threading
+from itertools import product
 
+from qe_calcolo import (
+    calcola_voci, calcola_voce, centesimi,
+    formatta_euro, formatta_cent, formatta_colonna, leggi_euro,
+    GrafoBasi, CicloDipendenze, leggi_base, formatta_base, ha_base_propria,
+    calcola_scenari, leggi_cent, importo_valido, ObiettivoQE
+)
+from qe_database import (
+    DatabaseManager, percorso_allegati, SCHEMA_ALLEGATI, CaricamentoAnnullato, BackupAnnullato
+)
+from qe_report import html_qe, scrivi_csv_qe
 
 # =============================================================================
-# 2. APP GESTIONALE
+# APP GESTIONALE
 # =============================================================================
 class AppGestionale(tk.Tk):
     def __init__(self):
@@ -662,7 +64,11 @@ class AppGestionale(tk.Tk):
         self.setup_styles()
         
         # Database
-        self.db = DatabaseManager()
+        try:
+            self.db = DatabaseManager()
+        except (OSError, sqlite3.Error) as e:
+            messagebox.showerror("Errore", f"Impossibile aprire il database:\n{e}")
+            raise
         
         # Variabili di stato
         self.init_state_variables()
@@ -671,6 +77,48 @@ class AppGestionale(tk.Tk):
         self.setup_menu()
         self.setup_notebook()
         self.setup_all_tabs()
+        
+        self.protocol("WM_DELETE_WINDOW", self.chiudi_app)
+        
+        # Metadati degli allegati caricati prima della versione corrente
+        self._lavori = []
+        self.avvia_lavoro(self.completa_metadati)
+
+    def avvia_lavoro(self, funzione, *args):
+        """Esegue funzione(*args, interrompi) in un thread; interrompi è un
+        threading.Event che chiudi_app imposta prima di attenderne la fine.
+        Restituisce (thread, interrompi)."""
+        interrompi = threading.Event()
+        t = threading.Thread(target=funzione, args=(*args, interrompi), daemon=True)
+        self._lavori = [l for l in self._lavori if l[0].is_alive()]
+        self._lavori.append((t, interrompi))
+        t.start()
+        return t, interrompi
+
+    def completa_metadati(self, interrompi):
+        """Thread: calcola le pagine degli allegati senza metadati su una
+        connessione propria, senza bloccare l'interfaccia"""
+        try:
+            db = DatabaseManager.su_file(self.db.db_path)
+        except (OSError, sqlite3.Error):
+            return
+        try:
+            n = db.completa_metadati_allegati(interrompi)
+            if n:
+                print(f"✓ Migrazione: metadati calcolati per {n} allegati")
+        except (OSError, sqlite3.Error) as e:
+            print(f"Metadati allegati non completati: {e}")
+        finally:
+            db.chiudi()
+
+    def chiudi_app(self):
+        """Chiude il database (checkpoint del WAL) e la finestra"""
+        for _, interrompi in self._lavori:
+            interrompi.set()
+        for t, _ in self._lavori:
+            t.join(timeout=5)
+        self.db.chiudi()
+        self.destroy()
 
     def setup_styles(self):
         """Configura gli stili dell'interfaccia"""
@@ -729,12 +177,25 @@ class AppGestionale(tk.Tk):
         self.flag_base_asta_var = tk.IntVar()
         self.flag_soggetto_ribasso_var = tk.IntVar()
         self.flag_calcolo_montante_var = tk.IntVar()
+        self.base_calcolo_var = tk.StringVar()
         self.normativa_var = tk.StringVar()
         self.inv_inc_var = tk.IntVar()
         
         # Valori calcolati
-        self.tot_base_asta_per_calcoli = 0.0
+        self.tot_base_asta_per_calcoli = 0
         self.inv_res_val = 0.0
+        
+        # Cache calcoli QE: {qe_id: (voci, CalcoloQE)}, valida finché
+        # PRAGMA data_version non segnala scritture di un'altra connessione
+        self._calcoli_qe = {}
+        self._versione_dati = None
+        
+        # Archivio progetti caricato a pagine: id dell'ultima riga, None a fine elenco
+        self.progetti_cursore = None
+        
+        # Stato dell'editor voci (vedi refresh_v)
+        self.stato_v = None
+        self.nomi_qe_confronto = {}
 
     def setup_menu(self):
         """Crea il menu dell'applicazione"""
@@ -794,20 +255,128 @@ class AppGestionale(tk.Tk):
         try:
             if v is None:
                 return "0,00"
-            return f"{v:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
-        except:
+            return formatta_euro(v)
+        except (TypeError, ValueError):
+            return "0,00"
+    
+    def fmt_cent(self, c):
+        """Formatta un importo in centesimi interi (es: 123456 -> 1.234,56)"""
+        if not c:
             return "0,00"
+        return formatta_cent(c)
 
     def parse(self, s):
         """Converte stringa formato italiano in float"""
-        if not s:
-            return 0.0
-        try:
-            # Rimuove €, spazi, converte separatori
-            clean = str(s).replace('€', '').strip().replace('.', '').replace(',', '.')
-            return float(clean)
-        except:
-            return 0.0
+        return leggi_euro(s)
+
+    def finestra_progresso(self, parent, titolo):
+        """Finestra con barra di avanzamento per le operazioni lunghe sui file.
+
+        Restituisce (finestra, progresso): progresso(fatti, totale) aggiorna
+        barra e byte trasferiti e lascia ridisegnare l'interfaccia.
+        """
+        w = tk.Toplevel(parent)
+        w.title(titolo)
+        w.transient(parent)
+        w.resizable(False, False)
+        pb = ttk.Progressbar(w, length=320, mode='determinate', maximum=1.0)
+        pb.pack(padx=15, pady=(15, 5))
+        lbl = ttk.Label(w, text="")
+        lbl.pack(padx=15, pady=(0, 15))
+        
+        def progresso(fatti, totale, nome=""):
+            pb['value'] = fatti / totale if totale else 1.0
+            testo = f"{fatti / 2**20:.1f} di {totale / 2**20:.1f} MB"
+            lbl.config(text=f"{nome}\n{testo}" if nome else testo)
+            w.update()
+        
+        return w, progresso
+
+    def lavoro_con_progresso(self, parent, titolo, funzione, errori, al_termine):
+        """Esegue funzione(db, progresso, interrompi) in un thread, con barra di
+        avanzamento e pulsante Annulla (che imposta interrompi).
+
+        db è un DatabaseManager su una connessione propria del thread, che non
+        tocca l'interfaccia: la finestra legge lo stato ogni 100 ms. Alla fine
+        al_termine(esito) riceve il risultato di funzione oppure l'eccezione:
+        quelle in errori sono previste, le altre sono anche stampate.
+        """
+        w, progresso = self.finestra_progresso(parent, titolo)
+        stato = {'fatti': 0, 'totale': 0, 'nome': "", 'esito': None}
+        
+        def avanza(fatti, totale, nome=""):
+            stato.update(fatti=fatti, totale=totale, nome=nome)
+        
+        def lavoro(interrompi):
+            try:
+                db = DatabaseManager.su_file(self.db.db_path)
+            except (OSError, sqlite3.Error) as e:
+                stato['esito'] = e
+                return
+            try:
+                stato['esito'] = funzione(db, avanza, interrompi)
+            except errori as e:
+                stato['esito'] = e
+            except Exception as e:
+                # Imprevista (MemoryError, un errore del codice): al_termine deve
+                # comunque ricevere l'errore e non un esito vuoto
+                print(f"{titolo}: errore imprevisto: {e!r}")
+                stato['esito'] = e
+            finally:
+                db.chiudi()
+        
+        t, interrompi = self.avvia_lavoro(lavoro)
+        ttk.Button(w, text="Annulla", command=interrompi.set).pack(pady=(0, 15))
+        w.protocol("WM_DELETE_WINDOW", interrompi.set)
+        w.grab_set()
+        
+        def controlla():
+            if t.is_alive():
+                progresso(stato['fatti'], stato['totale'], stato['nome'])
+                w.after(100, controlla)
+                return
+            w.destroy()
+            al_termine(stato['esito'])
+        
+        controlla()
+
+    def carica_allegati(self, parent, percorsi, descrizione, al_termine):
+        """Carica i file percorsi come allegati del QE corrente in un thread,
+        tutti in una transazione; al_termine(esito) riceve (id, errori) di
+        carica_allegati_da_file oppure l'eccezione"""
+        qe_id = self.qe_corrente_id
+        self.lavoro_con_progresso(
+            parent, f"Caricamento di {len(percorsi)} file",
+            lambda db, avanza, interrompi: db.carica_allegati_da_file(
+                qe_id, percorsi, "pdf", descrizione, avanza, interrompi
+            ),
+            (CaricamentoAnnullato, OSError, sqlite3.Error), al_termine
+        )
+
+    def calcola_qe(self, qid):
+        """Restituisce voci e calcolo del QE (ricalcolato solo dopo modifiche).
+
+        Le modifiche di questa finestra scartano il calcolo con invalida_calcolo;
+        quelle di un altro processo (il Toolkit) cambiano PRAGMA data_version,
+        che costa una lettura e fa scartare tutta la cache.
+        """
+        versione = self.db.conn.execute("PRAGMA data_version").fetchone()[0]
+        if versione != self._versione_dati:
+            self._calcoli_qe.clear()
+            self._versione_dati = versione
+        c = self._calcoli_qe.get(qid)
+        if c is None:
+            voci = self.db.get_voci_by_qe(qid)
+            c = (voci, calcola_voci(voci))
+            self._calcoli_qe[qid] = c
+        return c
+
+    def invalida_calcolo(self, qid=None):
+        """Scarta il calcolo memorizzato di un QE (o di tutti)"""
+        if qid is None:
+            self._calcoli_qe.clear()
+        else:
+            self._calcoli_qe.pop(qid, None)
 
     def on_tab_change(self, event):
         """Gestisce il cambio di tab per refresh automatici"""
@@ -895,7 +464,7 @@ class AppGestionale(tk.Tk):
         
         self.tr_p = ttk.Treeview(
             c_list, 
-            columns=("ID", "Norm", "CUP", "Anno", "Tit", "Imp"), 
+            columns=("ID", "Norm", "CUP", "Anno", "Tit", "Imp", "TotQE", "Eco"), 
             show='headings', 
             selectmode='browse'
         )
@@ -906,19 +475,26 @@ class AppGestionale(tk.Tk):
             ("Norm", "Normativa", 180),
             ("CUP", "CUP", 100),
             ("Anno", "Anno", 50),
-            ("Tit", "Titolo", 400),
-            ("Imp", "Budget", 120)
+            ("Tit", "Titolo", 300),
+            ("Imp", "Budget", 120),
+            ("TotQE", "Totale Ultimo QE", 120),
+            ("Eco", "Economie", 110)
         ]
         
         for col, text, width in columns_config:
             self.tr_p.heading(col, text=text)
-            self.tr_p.column(col, width=width, anchor='e' if col == "Imp" else 'w')
+            self.tr_p.column(
+                col, width=width, 
+                anchor='e' if col in ("Imp", "TotQE", "Eco") else 'w'
+            )
         
-        # Scrollbar
-        sb = ttk.Scrollbar(c_list, orient="vertical", command=self.tr_p.yview)
-        self.tr_p.configure(yscrollcommand=sb.set)
+        self.tr_p.tag_configure('fabbisogno', foreground='red')
+        
+        # Scrollbar: avvicinandosi al fondo carica la pagina successiva
+        self.sb_p = ttk.Scrollbar(c_list, orient="vertical", command=self.tr_p.yview)
+        self.tr_p.configure(yscrollcommand=self.scorri_progetti)
         self.tr_p.pack(side='left', fill='both', expand=True)
-        sb.pack(side='right', fill='y')
+        self.sb_p.pack(side='right', fill='y')
         
         self.tr_p.bind("<Double-1>", self.seleziona_progetto)
         
@@ -932,6 +508,7 @@ class AppGestionale(tk.Tk):
         ttk.Button(f_side, text="Modifica", command=self.carica_modifica_progetto).pack(
             fill='x', pady=5
         )
+        ttk.Button(f_side, text="Duplica", command=self.duplica_progetto).pack(fill='x', pady=5)
         
         ttk.Button(
             f_side, 
@@ -977,6 +554,8 @@ class AppGestionale(tk.Tk):
         # Modalità modifica o inserimento
         if self.id_modifica_proj:
             self.db.aggiorna_progetto_dati(self.id_modifica_proj, c, a, t, imp)
+            if self.id_modifica_proj == self.progetto_corrente_id:
+                self.stato_v = None  # Stanziamento cambiato: l'editor voci va ricostruito
             self.reset_form_p()
         else:
             self.db.inserisci_progetto(nid, c, a, t, imp)
@@ -984,15 +563,42 @@ class AppGestionale(tk.Tk):
         
         self.refresh_progetti()
     
+    # Righe dell'archivio progetti lette per pagina
+    PAGINA_PROGETTI = 200
+
     def refresh_progetti(self):
-        """Aggiorna lista progetti"""
+        """Aggiorna lista progetti (solo la prima pagina: le altre allo scorrimento)"""
         self.refresh_normative_combo()
         self.tr_p.delete(*self.tr_p.get_children())
-        
-        for r in self.db.get_tutti_progetti():
+        self.progetti_cursore = None
+        self.carica_pagina_progetti()
+    
+    def scorri_progetti(self, primo, ultimo):
+        """yscrollcommand della lista progetti: aggiorna la scrollbar e, vicino
+        al fondo, aggiunge la pagina successiva"""
+        self.sb_p.set(primo, ultimo)
+        if self.progetti_cursore is not None and float(ultimo) > 0.9:
+            self.carica_pagina_progetti()
+    
+    def carica_pagina_progetti(self):
+        """Accoda alla lista la pagina di progetti successiva al cursore"""
+        righe = self.db.get_progetti_pagina(self.progetti_cursore, self.PAGINA_PROGETTI)
+        self.progetti_cursore = righe[-1][0] if len(righe) == self.PAGINA_PROGETTI else None
+        
+        for r in righe:
+            tot_qe = r[6]
+            
+            if tot_qe is None:
+                tot_str, eco_str, tags = "", "", ()
+            else:
+                eco = (r[4] or 0) - tot_qe
+                tot_str, eco_str = self.fmt_cent(tot_qe), self.fmt_cent(eco)
+                tags = ('fabbisogno',) if eco < 0 else ()
+            
             self.tr_p.insert(
                 "", "end", 
-                values=(r[0], r[5], r[1], r[2], r[3], self.fmt(r[4]))
+                values=(r[0], r[5], r[1], r[2], r[3], self.fmt_cent(r[4]), tot_str, eco_str),
+                tags=tags
             )
     
     def seleziona_progetto(self, e):
@@ -1048,7 +654,7 @@ class AppGestionale(tk.Tk):
         self.e_tit.insert(0, v[4])
         
         self.e_imp.delete(0, tk.END)
-        self.e_imp.insert(0, self.fmt(v[5]))
+        self.e_imp.insert(0, self.fmt_cent(v[6]))
         
         # Modalità modifica visiva
         self.f_in_proj.config(bg=self.bg_edit)
@@ -1070,6 +676,28 @@ class AppGestionale(tk.Tk):
         self.e_tit.delete(0, tk.END)
         self.e_imp.delete(0, tk.END)
     
+    def chiedi_copia_completa(self, cosa):
+        """Chiede se la copia include allegati e cronoprogrammi FPV
+        (True/False, None se l'utente annulla)"""
+        return messagebox.askyesnocancel(
+            "Duplica",
+            f"Duplicare {cosa}.\n\nCopiare anche allegati e cronoprogrammi FPV?"
+        )
+    
+    def duplica_progetto(self):
+        """Duplica progetto selezionato con tutti i suoi QE"""
+        s = self.tr_p.selection()
+        if not s:
+            return
+        
+        vals = self.tr_p.item(s)['values']
+        completa = self.chiedi_copia_completa(f"il progetto '{vals[4]}' con tutti i suoi QE")
+        if completa is None:
+            return
+        
+        self.db.duplica_progetto(vals[0], f"Copia {vals[4]}", allegati=completa, fpv=completa)
+        self.refresh_progetti()
+    
     def elimina_progetto(self):
         """Elimina progetto selezionato"""
         s = self.tr_p.selection()
@@ -1078,6 +706,7 @@ class AppGestionale(tk.Tk):
         
         if messagebox.askyesno("Conferma", "Eliminare il progetto selezionato?"):
             self.db.elimina_progetto(self.tr_p.item(s)['values'][0])
+            self.invalida_calcolo()
             self.refresh_progetti()
 
     # --- TAB 2: GESTIONE VERSIONI QE ---
@@ -1253,35 +882,14 @@ class AppGestionale(tk.Tk):
         if not self.progetto_corrente_id:
             return
         
+        totali = {
+            t[0]: t[7] for t in self.db.get_totali_qe(self.progetto_corrente_id)
+        }
+        
         for q in self.db.get_qe_by_progetto(self.progetto_corrente_id):
-            voci = self.db.get_voci_by_qe(q[0])
-            
-            # Calcolo montante (solo voci con flag=1 e importo fisso)
-            montante = 0.0
-            for r in voci:
-                if r[7] == 0:  # Solo importi fissi
-                    f_mont = r[14] if len(r) > 14 else 0
-                    if f_mont == 1:
-                        montante += r[6]
-            
-            # Calcolo totale QE
-            tot_qe = 0.0
-            for r in voci:
-                # Imponibile (fisso o percentuale su montante)
-                imp = r[6] if r[7] == 0 else (montante * r[6] / 100)
-                
-                # Oneri
-                one = imp * r[8] / 100
-                
-                # IVA (su imp+oneri se flag=1, altrimenti solo su imp)
-                base_iva = (imp + one) if r[9] else imp
-                iva = base_iva * r[10] / 100
-                
-                tot_qe += (imp + one + iva)
-            
             self.tr_q.insert(
                 "", "end", 
-                values=(q[0], q[2], q[3], self.fmt(tot_qe), q[4])
+                values=(q[0], q[2], q[3], self.fmt_cent(totali.get(q[0], 0)), q[4])
             )
     
     def dup_q(self):
@@ -1293,7 +901,11 @@ class AppGestionale(tk.Tk):
         qid = self.tr_q.item(s)['values'][0]
         nome_orig = self.tr_q.item(s)['values'][1]
         
-        self.db.duplica_qe(qid, f"Copia {nome_orig}")
+        completa = self.chiedi_copia_completa(f"la versione '{nome_orig}'")
+        if completa is None:
+            return
+        
+        self.db.duplica_qe(qid, f"Copia {nome_orig}", allegati=completa, fpv=completa)
         self.refresh_qe()
     
     def del_q(self):
@@ -1303,7 +915,9 @@ class AppGestionale(tk.Tk):
             return
         
         if messagebox.askyesno("Conferma", "Eliminare questa versione QE?"):
-            self.db.elimina_qe(self.tr_q.item(s)['values'][0])
+            qid = self.tr_q.item(s)['values'][0]
+            self.db.elimina_qe(qid)
+            self.invalida_calcolo(qid)
             self.refresh_qe()
 
     # --- TAB 3: EDITOR VOCI (PARTE 1: LAYOUT UI) ---
@@ -1337,6 +951,12 @@ class AppGestionale(tk.Tk):
             command=self.apri_gestione_allegati
         ).pack(side='right', padx=10, pady=5)
         
+        ttk.Button(
+            f_top, 
+            text="Allinea allo Stanziamento", 
+            command=self.apri_allinea_stanziamento
+        ).pack(side='right', pady=5)
+        
         # PanedWindow: treeview | form editor
         paned = tk.PanedWindow(self.t3, orient=tk.HORIZONTAL, sashwidth=5)
         paned.pack(fill='both', expand=True, padx=2, pady=2)
@@ -1547,6 +1167,23 @@ class AppGestionale(tk.Tk):
         self.e_iva = ttk.Entry(f_fiscal, width=8)
         self.e_iva.pack(side='left', padx=5)
         
+        # Riga 3: Base di calcolo delle voci a percentuale (vuota = montante)
+        f_base = ttk.Frame(lf_econ)
+        f_base.grid(row=2, column=0, columnspan=4, sticky='ew', pady=(5, 0))
+        
+        ttk.Label(f_base, text="Base di calcolo:").pack(side='left')
+        self.cb_base = ttk.Combobox(f_base, textvariable=self.base_calcolo_var, width=28)
+        self.cb_base.pack(side='left', padx=5)
+        self.cb_base.bind("<<ComboboxSelected>>", lambda e: self.toggle_input_type())
+        self.cb_base.bind("<KeyRelease>", lambda e: self.toggle_input_type())
+        
+        ttk.Label(
+            f_base, 
+            text="vuota = montante; es. SEZ:1;CAT:B.07;VOCE:B.07.01", 
+            foreground="gray", 
+            font=("Segoe UI", 8)
+        ).pack(side='left', padx=5)
+        
         # --- SEZIONE 4: OPZIONI ---
         lf_opt = ttk.LabelFrame(f_edit, text="4. Opzioni", padding=5)
         lf_opt.pack(fill='x', padx=5, pady=2)
@@ -1686,17 +1323,178 @@ class AppGestionale(tk.Tk):
         self.e_iva.insert(0, self.e_inv_iva.get())
         
         self.check_iva_oneri_var.set(self.inv_inc_var.get())
+
+    def apri_allinea_stanziamento(self):
+        """Ricerca obiettivo sull'intero QE: scala le voci fisse scelte finché
+        il totale coincide con l'importo stanziato del progetto"""
+        if not self.qe_corrente_id or not self.stato_v:
+            return
+        
+        qid = self.qe_corrente_id
+        budget = self.stato_v['budget']
+        if not budget:
+            messagebox.showinfo("Info", "Il progetto non ha un importo stanziato.")
+            return
+        
+        voci, calc = self.calcola_qe(qid)
+        obiettivo = ObiettivoQE(voci)
+        fisse = [k for k, r in enumerate(voci) if r.is_percentuale != 1]
+        if not fisse:
+            messagebox.showinfo("Info", "Il QE non contiene voci a importo fisso.")
+            return
+        
+        d = tk.Toplevel(self)
+        d.title("Allinea allo Stanziamento")
+        d.geometry("760x520")
+        d.transient(self)
+        
+        ttk.Label(
+            d, 
+            text="Doppio clic (o Spazio) per scegliere le voci da adeguare: "
+                 "sono scalate in proporzione ai loro importi.", 
+            padding=5
+        ).pack(fill='x')
+        
+        f_tree = ttk.Frame(d)
+        f_tree.pack(fill='both', expand=True, padx=5)
+        
+        tr = ttk.Treeview(
+            f_tree, 
+            columns=("Sel", "Cod", "Desc", "Att", "Nuovo"), 
+            show='headings', 
+            selectmode='browse'
+        )
+        for c, name, w in (("Sel", "", 30), ("Cod", "Cod", 70), ("Desc", "Descrizione", 300), 
+                           ("Att", "Attuale", 110), ("Nuovo", "Nuovo", 110)):
+            tr.heading(c, text=name)
+            tr.column(c, width=w, anchor='w' if c == "Desc" else 'e')
+        sb = ttk.Scrollbar(f_tree, orient="vertical", command=tr.yview)
+        tr.configure(yscrollcommand=sb.set)
+        tr.pack(side='left', fill='both', expand=True)
+        sb.pack(side='right', fill='y')
+        
+        lbl_res = ttk.Label(d, text="", padding=5, justify='left')
+        lbl_res.pack(fill='x')
+        
+        # Stato: voci scelte e ultima soluzione
+        scelte = set()
+        soluzione = {}
+        
+        for k in fisse:
+            r = voci[k]
+            tr.insert("", "end", iid=str(k), 
+                      values=("", r.codice_completo, r.descrizione, self.fmt_cent(calc.imp[k]), ""))
+        
+        def ricalcola():
+            """Risolve l'obiettivo a ogni cambio delle voci scelte"""
+            soluzione.clear()
+            for k in fisse:
+                tr.set(str(k), "Nuovo", "")
+            testo = (f"Stanziamento: € {self.fmt_cent(budget)}    "
+                     f"Totale attuale: € {self.fmt_cent(calc.totale)}")
+            if not scelte:
+                lbl_res.config(text=testo + "\nNessuna voce scelta.", foreground="black")
+                return
+            try:
+                importi, totale, fattore = obiettivo.risolvi(budget, scelte)
+            except ValueError as e:
+                lbl_res.config(text=f"{testo}\n{e}", foreground="red")
+                return
+            
+            soluzione.update(importi)
+            for k, c in importi.items():
+                tr.set(str(k), "Nuovo", self.fmt_cent(c))
+            scarto = budget - totale
+            testo += (f"\nFattore: {fattore:.6f}    " if fattore is not None else "\n")
+            testo += f"Totale risultante: € {self.fmt_cent(totale)}"
+            if scarto:
+                testo += f"    Scarto di arrotondamento: € {self.fmt_cent(scarto)}"
+            lbl_res.config(text=testo, foreground="green" if not scarto else "orange")
+        
+        def commuta(event=None):
+            sel = tr.focus()
+            if not sel:
+                return
+            k = int(sel)
+            if k in scelte:
+                scelte.discard(k)
+                tr.set(sel, "Sel", "")
+            else:
+                scelte.add(k)
+                tr.set(sel, "Sel", "✓")
+            ricalcola()
+        
+        def applica():
+            if not soluzione:
+                messagebox.showinfo("Info", "Nessuna soluzione da applicare.", parent=d)
+                return
+            if not messagebox.askyesno(
+                "Conferma", 
+                f"Aggiornare gli importi di {len(soluzione)} voci?", 
+                parent=d
+            ):
+                return
+            if self.calcola_qe(qid)[0] is not voci:
+                # Voci cambiate dopo l'apertura (es. dal Toolkit): la soluzione
+                # è calcolata su importi vecchi e non va scritta
+                messagebox.showwarning(
+                    "Attenzione",
+                    "Il QE è stato modificato nel frattempo: riapri la ricerca obiettivo.",
+                    parent=d
+                )
+                self.refresh_v()
+                d.destroy()
+                return
+            try:
+                self.db.aggiorna_importi_voci(
+                    qid, {voci[k].id: c for k, c in soluzione.items()}
+                )
+            except sqlite3.Error as e:
+                messagebox.showerror("Errore", f"Aggiornamento non riuscito:\n{e}", parent=d)
+                return
+            self.invalida_calcolo(qid)
+            self.refresh_v()
+            d.destroy()
+        
+        tr.bind("<Double-1>", commuta)
+        tr.bind("<space>", commuta)
+        
+        f_btn = ttk.Frame(d)
+        f_btn.pack(fill='x', padx=5, pady=5)
+        ttk.Button(f_btn, text="Applica", command=applica).pack(side='right')
+        ttk.Button(f_btn, text="Chiudi", command=d.destroy).pack(side='right', padx=5)
+        
+        ricalcola()
         
     def toggle_input_type(self):
         """Mostra info quando si seleziona calcolo percentuale"""
         t = self.valore_tipo_var.get()
         
         if t == 'perc':
-            self.lbl_info_perc.config(
-                text=f"Calcolato su: € {self.fmt(self.tot_base_asta_per_calcoli)}"
-            )
+            spec = self.base_calcolo_var.get()
+            if not ha_base_propria(spec):
+                testo = f"Calcolato su: € {self.fmt_cent(self.tot_base_asta_per_calcoli)}"
+            else:
+                base = self._base_propria_v(spec)
+                if base is None:
+                    testo = "Base di calcolo non valida"
+                else:
+                    testo = f"Calcolato su: € {self.fmt_cent(base)} ({spec.strip()})"
+            self.lbl_info_perc.config(text=testo)
         else:
             self.lbl_info_perc.config(text="")
+    
+    def _base_propria_v(self, spec):
+        """Importo (centesimi) della base di calcolo spec nel QE corrente"""
+        st = self.stato_v
+        if not st or st['qe_id'] != self.qe_corrente_id:
+            return None
+        try:
+            rif = leggi_base(spec)
+        except ValueError:
+            return None
+        voci = st['grafo'].voci_base(rif, self.voce_modifica_id)
+        return sum(st['importi'][j][0] for j in voci)
         
     def upd_cat(self, e):
         """Aggiorna combobox categorie in base a macro area"""
@@ -1741,6 +1539,7 @@ class AppGestionale(tk.Tk):
         self.flag_base_asta_var.set(0)
         self.flag_soggetto_ribasso_var.set(0)
         self.flag_calcolo_montante_var.set(0)
+        self.base_calcolo_var.set("")
 
     def save_v(self):
         """Salva o aggiorna voce"""
@@ -1759,10 +1558,22 @@ class AppGestionale(tk.Tk):
         f_mont = self.flag_calcolo_montante_var.get()
         
         tipo_str = self.valore_tipo_var.get()
+        
+        # Base di calcolo (solo voci a percentuale; vuota = montante)
         m_str = ""
+        if tipo_str == 'perc':
+            try:
+                m_str = formatta_base(leggi_base(self.base_calcolo_var.get()))
+            except ValueError as e:
+                messagebox.showwarning("Base di calcolo", str(e))
+                return
         
         if self.voce_modifica_id:
+            r = self.db.get_voce_by_id(self.voce_modifica_id)
+            if m_str and r and not self._verifica_base_v(r.id, r.codice_padre, r.codice_completo, f_base, m_str):
+                return
             # Aggiorna voce esistente
+            vid = self.voce_modifica_id
             self.db.aggiorna_voce(
                 self.voce_modifica_id, self.e_desc.get(), v, 
                 1 if tipo_str == 'perc' else 0, 
@@ -1777,21 +1588,50 @@ class AppGestionale(tk.Tk):
             
             cf = self.db.get_prossimo_codice(self.qe_corrente_id, cp)
             
-            self.db.inserisci_voce(
+            if m_str and not self._verifica_base_v(None, cp, cf, f_base, m_str):
+                return
+            
+            vid = self.db.inserisci_voce(
                 self.qe_corrente_id, cp, cf, self.e_desc.get(), tipo_str, v, 
                 1 if tipo_str == 'perc' else 0, 
                 po, inc, pi, f_base, f_rib, m_str, f_mont
             )
         
-        self.refresh_v()
+        self.invalida_calcolo(self.qe_corrente_id)
+        self.aggiorna_v_incrementale(vid, self.db.get_voce_by_id(vid))
         self.rst_v()
     
+    def _verifica_base_v(self, vid, cp, cod, f_base, spec):
+        """Controlla che la base di calcolo non crei dipendenze circolari"""
+        st = self.stato_v
+        if not st or st['qe_id'] != self.qe_corrente_id:
+            return True
+        
+        grafo = st['grafo']
+        chiave = vid if vid is not None else ("nuova",)
+        try:
+            grafo.aggiorna(chiave, cp, cod, f_base, 1, spec)
+        except CicloDipendenze as e:
+            messagebox.showerror("Base di calcolo", str(e))
+            return False
+        finally:
+            if vid is None:
+                grafo.rimuovi(chiave)
+        
+        if vid is not None:
+            # Ripristina la voce: il grafo si aggiorna dopo il salvataggio
+            r = st['voci'][vid]
+            grafo.aggiorna(vid, r.codice_padre, r.codice_completo, r.flag_base_asta,
+                           r.is_percentuale, r.macro_base_calcolo, consenti_cicli=True)
+        return True
+    
     def del_v(self):
         """Elimina voce selezionata"""
         if self.voce_modifica_id:
             if messagebox.askyesno("Conferma", "Eliminare questa voce?"):
                 self.db.elimina_voce(self.voce_modifica_id)
-                self.refresh_v()
+                self.invalida_calcolo(self.qe_corrente_id)
+                self.aggiorna_v_incrementale(self.voce_modifica_id, None)
                 self.rst_v()
     
     def carica_edit_v(self, e):
@@ -1800,52 +1640,49 @@ class AppGestionale(tk.Tk):
         if not s or not s[0].isdigit():
             return
         
-        r = self.db.conn.execute(
-            "SELECT * FROM voci WHERE id=?", (int(s[0]),)
-        ).fetchone()
+        r = self.db.get_voce_by_id(int(s[0]))
         
         if not r:
             return
         
-        self.voce_modifica_id = r[0]
+        self.voce_modifica_id = r.id
         
         # Mostra codice
-        self.lbl_code.config(text=f"Mod: {r[3]}")
+        self.lbl_code.config(text=f"Mod: {r.codice_completo}")
         
         # Descrizione
         self.e_desc.delete(0, tk.END)
-        self.e_desc.insert(0, r[4])
+        self.e_desc.insert(0, r.descrizione)
         
         # Valore
         self.e_val.delete(0, tk.END)
-        self.e_val.insert(0, self.fmt(r[6]))
+        self.e_val.insert(0, self.fmt(r.valore_imponibile))
         
         # Tipo (fisso/perc)
-        self.valore_tipo_var.set('perc' if r[7] else 'fisso')
+        self.valore_tipo_var.set('perc' if r.is_percentuale else 'fisso')
         
         # Oneri
         self.e_one.delete(0, tk.END)
-        self.e_one.insert(0, self.fmt(r[8]))
+        self.e_one.insert(0, self.fmt(r.perc_oneri))
         
         # Flag includi oneri in IVA
-        self.check_iva_oneri_var.set(r[9])
+        self.check_iva_oneri_var.set(r.includi_oneri_in_iva)
         
         # IVA
         self.e_iva.delete(0, tk.END)
-        self.e_iva.insert(0, self.fmt(r[10]))
+        self.e_iva.insert(0, self.fmt(r.perc_iva))
         
         # Checkbox flags
-        self.flag_base_asta_var.set(r[11])
-        self.flag_soggetto_ribasso_var.set(r[12])
+        self.flag_base_asta_var.set(r.flag_base_asta)
+        self.flag_soggetto_ribasso_var.set(r.flag_soggetto_ribasso)
+        self.flag_calcolo_montante_var.set(r.flag_calcolo_montante)
         
-        # flag_calcolo_montante (index 14)
-        f_mont = r[14] if len(r) > 14 else 0
-        self.flag_calcolo_montante_var.set(f_mont)
+        self.base_calcolo_var.set(r.macro_base_calcolo or "")
         
         self.toggle_input_type()
         
         # Imposta categoria nel combo
-        cod_padre = r[2]
+        cod_padre = r.codice_padre
         cat_row = self.db.conn.execute(
             """SELECT macro_gruppo, descrizione 
             FROM catalogo_voci 
@@ -1868,58 +1705,20 @@ class AppGestionale(tk.Tk):
             self.upd_cat(None)
             self.cb_cat.set(f"{cod_padre} - {desc_cat}")
 
+    TITOLI_SEZIONI_V = {
+        1: "1. SPESE PER L'ESECUZIONE DELL'INTERVENTO",
+        2: "2. SOMME A DISPOSIZIONE"
+    }
+
     def refresh_v(self):
         """Aggiorna treeview voci con calcolo totali e raggruppamenti"""
         self.tr_v.delete(*self.tr_v.get_children())
+        self.stato_v = None
         
         if not self.qe_corrente_id:
             return
         
-        voci = self.db.get_voci_by_qe(self.qe_corrente_id)
-        
-        # CALCOLO MONTANTE: somma imponibili con flag_calcolo_montante=1
-        self.tot_base_asta_per_calcoli = 0.0
-        for r in voci:
-            if r[7] == 0:  # Solo importi fissi
-                f_mont = r[14] if len(r) > 14 else 0
-                if f_mont == 1:
-                    self.tot_base_asta_per_calcoli += r[6]
-        
-        # Aggiorna label info percentuale se attivo
-        if self.valore_tipo_var.get() == 'perc':
-            self.toggle_input_type()
-        
-        # Totali globali
-        tot_base_asta_imp = 0.0
-        tot_oneri_globali = 0.0
-        tot_iva_globali = 0.0
-        tot_tasse_globali = 0.0
-        
-        # Separa voci in sezioni
-        sec1 = []  # Base asta
-        sec2 = []  # Somme a disposizione
-        tot_sec2_imp = 0.0
-        
-        for r in voci:
-            # Calcolo importi
-            imp = r[6] if r[7] == 0 else (self.tot_base_asta_per_calcoli * r[6] / 100)
-            one = imp * r[8] / 100
-            base_iva = (imp + one) if r[9] else imp
-            iva = base_iva * r[10] / 100
-            tot = imp + one + iva
-            
-            tot_oneri_globali += one
-            tot_iva_globali += iva
-            tot_tasse_globali += (one + iva)
-            
-            item = {'r': r, 'imp': imp, 'one': one, 'iva': iva, 'tot': tot}
-            
-            if r[11] == 1:  # flag_base_asta
-                sec1.append(item)
-                tot_base_asta_imp += imp
-            else:
-                sec2.append(item)
-                tot_sec2_imp += imp
+        voci, calc = self.calcola_qe(self.qe_corrente_id)
         
         # Mappa categorie
         cat_map = {}
@@ -1927,103 +1726,327 @@ class AppGestionale(tk.Tk):
         for c in cats:
             cat_map[c[1]] = c[3]
         
-        def render_section(items_list, title, is_sec1):
-            """Renderizza una sezione con raggruppamenti per categoria"""
-            if not items_list and is_sec1:
-                return
+        proj = self.db.get_progetto_by_id(self.progetto_corrente_id)
+        
+        # Stato dell'editor: permette di aggiornare solo le righe toccate
+        st = {
+            'qe_id': self.qe_corrente_id,
+            'voci': {},        # id -> Voce
+            'importi': {},     # id -> (imp, one, iva, tot)
+            'categorie': {},   # (sezione, codice_padre) -> [id ordinati per codice]
+            'somme_cat': {},   # (sezione, codice_padre) -> (imp, one, iva, tot)
+            'montante': calc.montante,
+            'cat_map': cat_map,
+            'budget': (proj[6] or 0) if proj else 0,
+            # Dipendenze delle voci a percentuale con base propria
+            'grafo': GrafoBasi.da_colonne(
+                [r.codice_padre for r in voci], [r.codice_completo for r in voci], 
+                [r.flag_base_asta for r in voci], [r.is_percentuale for r in voci], 
+                [r.macro_base_calcolo for r in voci], chiavi=[r.id for r in voci]
+            )
+        }
+        self.stato_v = st
+        
+        # Importi formattati per colonna in blocco, passati alle righe
+        testi = dict(zip(
+            (r.id for r in voci),
+            zip(*(formatta_colonna(col) for col in (calc.imp, calc.one, calc.iva, calc.tot)))
+        ))
+        
+        for k, r in enumerate(voci):
+            st['voci'][r.id] = r
+            st['importi'][r.id] = (calc.imp[k], calc.one[k], calc.iva[k], calc.tot[k])
+            st['categorie'].setdefault(self._chiave_cat_v(r), []).append(r.id)
+        
+        for key in st['categorie']:
+            st['categorie'][key].sort(key=lambda vid: st['voci'][vid].codice_completo)
+            self._somma_categoria_v(key)
+        
+        self._aggiorna_basi_v()
+        
+        # MONTANTE: somma imponibili fissi con flag_calcolo_montante=1
+        self.tot_base_asta_per_calcoli = calc.montante
+        
+        # Aggiorna label info percentuale se attivo
+        if self.valore_tipo_var.get() == 'perc':
+            self.toggle_input_type()
+        
+        totali = self._totali_sezioni_v()
+        
+        for sez in (1, 2):
+            keys = sorted(k for k in st['categorie'] if k[0] == sez)
             
-            group_tot = tot_base_asta_imp if is_sec1 else (tot_sec2_imp + tot_tasse_globali)
+            # La sezione 1 si mostra solo se contiene voci
+            if not keys and sez == 1:
+                continue
             
             # Header sezione
             self.tr_v.insert(
                 "", "end", 
-                text=title, 
-                values=("", title, self.fmt(group_tot), "", "", "", ""), 
+                iid=f"sec{sez}", 
+                text=self.TITOLI_SEZIONI_V[sez], 
+                values=self._valori_sezione_v(sez, totali), 
                 tags=('group',)
             )
             
-            # Ordina per codice padre
-            items_list.sort(key=lambda x: x['r'][2])
-            
-            # Raggruppa per categoria
-            for key, group in groupby(items_list, key=lambda x: x['r'][2]):
-                g_list = list(group)
-                
-                # Totali categoria
-                s_imp = sum(x['imp'] for x in g_list)
-                s_one = sum(x['one'] for x in g_list)
-                s_iva = sum(x['iva'] for x in g_list)
-                s_tot = sum(x['tot'] for x in g_list)
-                
-                cat_desc = cat_map.get(key, f"Categoria {key}")
-                
-                # Riga categoria
+            # Categorie e relative voci
+            for key in keys:
                 self.tr_v.insert(
                     "", "end", 
-                    values=(
-                        key, cat_desc, 
-                        self.fmt(s_imp), self.fmt(s_one), 
-                        self.fmt(s_iva), self.fmt(s_tot), ""
-                    ), 
+                    iid=self._iid_cat_v(key), 
+                    values=self._valori_categoria_v(key), 
                     tags=('category',)
                 )
-                
-                # Voci della categoria
-                for i in g_list:
-                    r = i['r']
-                    
-                    # Flag info (Ribasso, Montante)
-                    f_mont = r[14] if len(r) > 14 else 0
-                    info_tags = []
-                    if r[12]:  # flag_soggetto_ribasso
-                        info_tags.append("Rib")
-                    if f_mont:
-                        info_tags.append("Mont")
-                    note_str = " ".join(info_tags)
-                    
+                for vid in st['categorie'][key]:
                     self.tr_v.insert(
                         "", "end", 
-                        iid=str(r[0]), 
-                        values=(
-                            "  " + r[3], r[4], 
-                            self.fmt(i['imp']), self.fmt(i['one']), 
-                            self.fmt(i['iva']), self.fmt(i['tot']), 
-                            note_str
-                        )
+                        iid=str(vid), 
+                        values=self._valori_voce_v(vid, testi[vid])
                     )
-            
-            # Riga IVA e imposte (solo sezione 2)
-            if not is_sec1:
-                self.tr_v.insert(
-                    "", "end", 
-                    iid="tax", 
-                    values=(
-                        "", "IVA e altre imposte (Totale)", 
-                        self.fmt(tot_tasse_globali), 
-                        self.fmt(tot_oneri_globali), 
-                        self.fmt(tot_iva_globali), "", ""
-                    ), 
-                    tags=('e18',)
-                )
-        
-        # Renderizza sezioni
-        render_section(sec1, "1. SPESE PER L'ESECUZIONE DELL'INTERVENTO", True)
-        render_section(sec2, "2. SOMME A DISPOSIZIONE", False)
         
-        # Aggiorna totali in UI
-        tot_gen = tot_base_asta_imp + tot_sec2_imp + tot_tasse_globali
-        self.lbl_val_tot.config(text=f"€ {self.fmt(tot_gen)}")
+        # Riga IVA e imposte (in coda alla sezione 2)
+        self.tr_v.insert(
+            "", "end", 
+            iid="tax", 
+            values=self._valori_tasse_v(totali), 
+            tags=('e18',)
+        )
         
-        # Economie/Fabbisogni
-        proj = self.db.get_progetto_by_id(self.progetto_corrente_id)
-        budget = proj[5] if proj else 0.0
+        self._aggiorna_riepilogo_v(totali)
+
+    # --- EDITOR VOCI: AGGIORNAMENTO INCREMENTALE ---
+    
+    def _chiave_cat_v(self, r):
+        """Sezione (1 base d'asta, 2 somme a disposizione) e categoria della voce"""
+        return (1 if r.flag_base_asta == 1 else 2, r.codice_padre)
+    
+    def _iid_cat_v(self, key):
+        return f"cat{key[0]}:{key[1]}"
+    
+    def _somma_categoria_v(self, key):
+        """Ricalcola il subtotale di una categoria dalle sue voci"""
+        st = self.stato_v
+        s_imp = s_one = s_iva = s_tot = 0
+        for vid in st['categorie'][key]:
+            imp, one, iva, tot = st['importi'][vid]
+            s_imp += imp
+            s_one += one
+            s_iva += iva
+            s_tot += tot
+        st['somme_cat'][key] = (s_imp, s_one, s_iva, s_tot)
+    
+    def _aggiorna_basi_v(self):
+        """Basi di calcolo proposte nel form: sezioni e categorie del QE"""
+        cats = sorted({cp for _, cp in self.stato_v['categorie']})
+        self.cb_base['values'] = ["", "SEZ:1", "SEZ:2"] + [f"CAT:{cp}" for cp in cats]
+    
+    def _totali_sezioni_v(self):
+        """Totali di sezione sommando i subtotali di categoria"""
+        tot = {'imp1': 0, 'imp2': 0, 'one': 0, 'iva': 0}
+        for (sez, _), (imp, one, iva, _) in self.stato_v['somme_cat'].items():
+            tot['imp1' if sez == 1 else 'imp2'] += imp
+            tot['one'] += one
+            tot['iva'] += iva
+        tot['tasse'] = tot['one'] + tot['iva']
+        tot['totale'] = tot['imp1'] + tot['imp2'] + tot['tasse']
+        return tot
+    
+    def _valori_voce_v(self, vid, testi=None):
+        """Valori della riga di una voce; testi: importi già formattati"""
+        r = self.stato_v['voci'][vid]
+        if testi is None:
+            testi = tuple(map(self.fmt_cent, self.stato_v['importi'][vid]))
+        
+        # Flag info (Ribasso, Montante)
+        info_tags = []
+        if r.flag_soggetto_ribasso:
+            info_tags.append("Rib")
+        if r.flag_calcolo_montante:
+            info_tags.append("Mont")
+        if vid in self.stato_v['grafo'].bloccate:
+            info_tags.append("Ciclo")
+        elif vid in self.stato_v['grafo'].rif:
+            info_tags.append("Base")
+        
+        return (
+            "  " + r.codice_completo, r.descrizione, *testi, 
+            " ".join(info_tags)
+        )
+    
+    def _valori_categoria_v(self, key):
+        s_imp, s_one, s_iva, s_tot = self.stato_v['somme_cat'][key]
+        cat_desc = self.stato_v['cat_map'].get(key[1], f"Categoria {key[1]}")
+        return (
+            key[1], cat_desc, 
+            self.fmt_cent(s_imp), self.fmt_cent(s_one), 
+            self.fmt_cent(s_iva), self.fmt_cent(s_tot), ""
+        )
+    
+    def _valori_sezione_v(self, sez, totali):
+        group_tot = totali['imp1'] if sez == 1 else (totali['imp2'] + totali['tasse'])
+        return ("", self.TITOLI_SEZIONI_V[sez], self.fmt_cent(group_tot), "", "", "", "")
+    
+    def _valori_tasse_v(self, totali):
+        return (
+            "", "IVA e altre imposte (Totale)", 
+            self.fmt_cent(totali['tasse']), 
+            self.fmt_cent(totali['one']), 
+            self.fmt_cent(totali['iva']), "", ""
+        )
+    
+    def _aggiorna_riepilogo_v(self, totali):
+        """Aggiorna totale intervento, stanziamento ed economie"""
+        tot_gen = totali['totale']
+        budget = self.stato_v['budget']
         diff = budget - tot_gen
         
-        self.lbl_val_stanz.config(text=f"€ {self.fmt(budget)}")
+        self.lbl_val_tot.config(text=f"€ {self.fmt_cent(tot_gen)}")
+        self.lbl_val_stanz.config(text=f"€ {self.fmt_cent(budget)}")
         self.lbl_val_eco.config(
-            text=f"€ {self.fmt(diff)}", 
+            text=f"€ {self.fmt_cent(diff)}", 
             foreground="green" if diff >= 0 else "red"
         )
+    
+    def _indice_dopo_categoria_v(self, key):
+        """Posizione nel treeview subito dopo le voci della categoria key"""
+        succ = [k for k in self.stato_v['categorie'] if k[0] == key[0] and k[1] > key[1]]
+        if succ:
+            return self.tr_v.index(self._iid_cat_v(min(succ)))
+        return self.tr_v.index("sec2" if key[0] == 1 else "tax")
+    
+    def aggiorna_v_incrementale(self, vid, nuova):
+        """Aggiorna l'editor dopo il salvataggio/eliminazione di una sola voce.
+        
+        nuova: riga DB aggiornata della voce (None se eliminata).
+        Ricalcola la voce, la sua categoria, i totali di sezione e, solo se è
+        cambiato il montante, le voci a percentuale. Delle voci con base propria
+        si ricalcola solo il sottografo a valle delle voci cambiate.
+        """
+        st = self.stato_v
+        if not st or st['qe_id'] != self.qe_corrente_id:
+            self.refresh_v()
+            return
+        
+        vecchia = st['voci'].get(vid)
+        key_old = self._chiave_cat_v(vecchia) if vecchia else None
+        key_new = self._chiave_cat_v(nuova) if nuova else None
+        cat_toccate = {k for k in (key_old, key_new) if k}
+        
+        def contrib_montante(r):
+            return r.is_percentuale != 1 and r.flag_calcolo_montante == 1
+        
+        def importi(r, base):
+            return calcola_voce(
+                r.valore_imponibile, r.is_percentuale, r.perc_oneri, 
+                r.includi_oneri_in_iva, r.perc_iva, base, r.importo_cent
+            )
+        
+        # Aggiorna lo stato della voce toccata
+        grafo = st['grafo']
+        if nuova:
+            st['voci'][vid] = nuova
+            da_basi = grafo.aggiorna(
+                vid, nuova.codice_padre, nuova.codice_completo, nuova.flag_base_asta, 
+                nuova.is_percentuale, nuova.macro_base_calcolo, consenti_cicli=True
+            )
+        else:
+            st['voci'].pop(vid, None)
+            st['importi'].pop(vid, None)
+            da_basi = grafo.rimuovi(vid)
+        
+        # Montante: ricalcolato solo se la voce vi contribuiva (prima o dopo)
+        montante_cambiato = False
+        if (vecchia and contrib_montante(vecchia)) or (nuova and contrib_montante(nuova)):
+            m = 0
+            for r in st['voci'].values():
+                if contrib_montante(r):
+                    m += r.importo_cent if r.importo_cent is not None else centesimi(r.valore_imponibile)
+            montante_cambiato = (m != st['montante'])
+            st['montante'] = m
+            self.tot_base_asta_per_calcoli = m
+            if self.valore_tipo_var.get() == 'perc':
+                self.toggle_input_type()
+        
+        da_ricalcolare = [vid] if nuova and vid not in grafo.rif else []
+        if montante_cambiato:
+            da_ricalcolare += [
+                i for i, r in st['voci'].items() 
+                if r.is_percentuale == 1 and i != vid and i not in grafo.rif
+            ]
+        
+        for i in da_ricalcolare:
+            r = st['voci'][i]
+            st['importi'][i] = importi(r, st['montante'])
+            cat_toccate.add(self._chiave_cat_v(r))
+        
+        # Voci con base propria a valle delle voci cambiate (ordine topologico)
+        da_basi = grafo.a_valle(set(da_basi).union(da_ricalcolare, [vid]))
+        for i in da_basi:
+            r = st['voci'][i]
+            base = grafo.base(i, lambda j: st['importi'][j][0])
+            st['importi'][i] = importi(r, base)
+            cat_toccate.add(self._chiave_cat_v(r))
+        da_ricalcolare += [i for i in da_basi if i not in da_ricalcolare]
+        
+        # Rimozione dalla vecchia categoria
+        if vecchia and key_old != key_new:
+            self.tr_v.delete(str(vid))
+            st['categorie'][key_old].remove(vid)
+            if not st['categorie'][key_old]:
+                del st['categorie'][key_old]
+                del st['somme_cat'][key_old]
+                self.tr_v.delete(self._iid_cat_v(key_old))
+                cat_toccate.discard(key_old)
+                self._aggiorna_basi_v()
+        
+        # Inserimento nella nuova categoria (in ordine di codice)
+        if nuova and key_old != key_new:
+            if key_new[0] == 1 and not self.tr_v.exists("sec1"):
+                self.tr_v.insert(
+                    "", 0, iid="sec1", text=self.TITOLI_SEZIONI_V[1], 
+                    values=("", self.TITOLI_SEZIONI_V[1], "", "", "", "", ""), 
+                    tags=('group',)
+                )
+            
+            if key_new not in st['categorie']:
+                pos = self._indice_dopo_categoria_v(key_new)
+                st['categorie'][key_new] = []
+                self._aggiorna_basi_v()
+                self.tr_v.insert(
+                    "", pos, iid=self._iid_cat_v(key_new), 
+                    values=("", "", "", "", "", "", ""), tags=('category',)
+                )
+            
+            membri = st['categorie'][key_new]
+            codici = [st['voci'][i].codice_completo for i in membri]
+            j = bisect.bisect_right(codici, nuova.codice_completo)
+            membri.insert(j, vid)
+            
+            if j + 1 < len(membri):
+                pos = self.tr_v.index(str(membri[j + 1]))
+            else:
+                pos = self._indice_dopo_categoria_v(key_new)
+            self.tr_v.insert("", pos, iid=str(vid), values=self._valori_voce_v(vid))
+        
+        # Patch delle sole righe interessate
+        for i in da_ricalcolare:
+            self.tr_v.item(str(i), values=self._valori_voce_v(i))
+        
+        for key in cat_toccate:
+            self._somma_categoria_v(key)
+            self.tr_v.item(self._iid_cat_v(key), values=self._valori_categoria_v(key))
+        
+        totali = self._totali_sezioni_v()
+        
+        if self.tr_v.exists("sec1"):
+            if any(k[0] == 1 for k in st['categorie']):
+                self.tr_v.item("sec1", values=self._valori_sezione_v(1, totali))
+            else:
+                self.tr_v.delete("sec1")
+        self.tr_v.item("sec2", values=self._valori_sezione_v(2, totali))
+        self.tr_v.item("tax", values=self._valori_tasse_v(totali))
+        
+        self._aggiorna_riepilogo_v(totali)
 
     def apri_gestione_allegati(self):
         """Finestra gestione allegati PDF con descrizione"""
@@ -2032,7 +2055,11 @@ class AppGestionale(tk.Tk):
         
         d = tk.Toplevel(self)
         d.title("Gestione Allegati QE")
-        d.geometry("800x500")
+        d.geometry("900x500")
+        
+        # Riepilogo dello spazio (dai metadati, senza leggere i file)
+        lbl_spazio = ttk.Label(d, text="")
+        lbl_spazio.pack(side='bottom', anchor='w', padx=10, pady=(0, 10))
         
         # Frame principale con layout orizzontale
         f_main = ttk.Frame(d)
@@ -2043,7 +2070,9 @@ class AppGestionale(tk.Tk):
         f_left.pack(side='left', fill='both', expand=True)
         
         # Treeview allegati (aggiunta colonna Descrizione)
-        tr = ttk.Treeview(f_left, columns=("ID", "Nome", "Data", "Desc"), show='headings')
+        tr = ttk.Treeview(
+            f_left, columns=("ID", "Nome", "Data", "Desc", "Dim", "Pag"), show='headings'
+        )
         tr.heading("ID", text="ID")
         tr.column("ID", width=40)
         tr.heading("Nome", text="Nome File")
@@ -2052,6 +2081,18 @@ class AppGestionale(tk.Tk):
         tr.column("Data", width=120)
         tr.heading("Desc", text="Descrizione")
         tr.column("Desc", width=200)
+        # Clic sull'intestazione: ordina per dimensione o pagine (dai metadati)
+        ordine = {'col': None}
+        mb = lambda n: f"{(n or 0) / 2**20:.1f} MB"
+        
+        def ordina(col):
+            ordine['col'] = None if ordine['col'] == col else col
+            refresh()
+        
+        tr.heading("Dim", text="Dimensione", command=lambda: ordina(4))
+        tr.column("Dim", width=80, anchor='e')
+        tr.heading("Pag", text="Pagine", command=lambda: ordina(5))
+        tr.column("Pag", width=60, anchor='e')
         
         # Scrollbar
         sb = ttk.Scrollbar(f_left, orient="vertical", command=tr.yview)
@@ -2064,21 +2105,31 @@ class AppGestionale(tk.Tk):
         f_right.pack(side='right', fill='y', padx=(10, 0))
         
         def refresh():
-            """Aggiorna lista allegati"""
+            """Aggiorna lista allegati e riepilogo dello spazio"""
             tr.delete(*tr.get_children())
-            # Query aggiornata per includere descrizione
-            rows = self.db.conn.execute(
-                "SELECT id, nome_file, data_caricamento, descrizione FROM allegati_qe WHERE qe_id=? ORDER BY id DESC",
-                (self.qe_corrente_id,)
-            ).fetchall()
-            for r in rows:
-                desc = r[3] if len(r) > 3 and r[3] else ""
-                tr.insert("", "end", values=(r[0], r[1], r[2], desc))
+            righe = self.db.get_allegati_headers_by_qe(self.qe_corrente_id)
+            if ordine['col']:
+                righe.sort(key=lambda r: r[ordine['col']] or 0, reverse=True)
+            for r in righe:
+                tr.insert("", "end", values=(
+                    r[0], r[1], r[2], r[3] or "", mb(r[4]), r[5] or ""
+                ))
+            
+            spazio = self.db.get_spazio_allegati(self.progetto_corrente_id)
+            testo = ""
+            for qid, _, n, dimensione, pagine in spazio:
+                if qid == self.qe_corrente_id:
+                    testo = f"Questo QE: {n} allegati, {mb(dimensione)}, {pagine} pagine   —   "
+            testo += (
+                f"Progetto: {sum(r[2] for r in spazio)} allegati, "
+                f"{mb(sum(r[3] for r in spazio))}, {sum(r[4] for r in spazio)} pagine"
+            )
+            lbl_spazio.config(text=testo)
         
-        def carica():
-            """Carica nuovo PDF con descrizione"""
-            fp = filedialog.askopenfilename(filetypes=[("PDF Files", "*.pdf")])
-            if not fp:
+        def carica_percorsi(percorsi):
+            """Carica i file in background con un'unica descrizione"""
+            if not percorsi:
+                messagebox.showwarning("Attenzione", "Nessun file PDF trovato.", parent=d)
                 return
             
             # Dialog per descrizione
@@ -2088,31 +2139,51 @@ class AppGestionale(tk.Tk):
                 parent=d
             )
             
-            try:
-                with open(fp, 'rb') as f:
-                    blob = f.read()
-                
-                # Inserimento con descrizione
-                self.db.conn.execute(
-                    """INSERT INTO allegati_qe 
-                    (qe_id, nome_file, tipo_file, dati, data_caricamento, descrizione) 
-                    VALUES (?, ?, ?, ?, ?, ?)""",
-                    (
-                        self.qe_corrente_id,
-                        os.path.basename(fp),
-                        "pdf",
-                        blob,
-                        datetime.datetime.now().strftime("%d/%m/%Y %H:%M"),
-                        desc if desc else ""
+            def al_termine(esito):
+                if isinstance(esito, CaricamentoAnnullato):
+                    messagebox.showinfo("Annullato", "Caricamento annullato: nessun file aggiunto.", parent=d)
+                    return
+                if isinstance(esito, Exception):
+                    # str() vuoto per alcune eccezioni (MemoryError): almeno il tipo
+                    messagebox.showerror(
+                        "Errore", f"Errore caricamento file:\n{str(esito) or type(esito).__name__}", parent=d
                     )
-                )
-                self.db.conn.commit()
+                    return
                 
+                ids, errori = esito
                 refresh()
-                messagebox.showinfo("OK", "File caricato con successo.", parent=d)
-                
-            except Exception as e:
-                messagebox.showerror("Errore", f"Errore caricamento file:\n{e}", parent=d)
+                if not errori:
+                    messagebox.showinfo("OK", f"{len(ids)} file caricati con successo.", parent=d)
+                    return
+                righe = [f"{os.path.basename(p)}: {str(e) or type(e).__name__}" for p, e in errori[:20]]
+                if len(errori) > 20:
+                    righe.append(f"... e altri {len(errori) - 20}")
+                messagebox.showwarning(
+                    "Caricamento parziale",
+                    f"{len(ids)} file caricati, {len(errori)} non caricati:\n\n" + "\n".join(righe),
+                    parent=d
+                )
+            
+            self.carica_allegati(d, percorsi, desc, al_termine)
+        
+        def carica():
+            """Carica uno o più PDF con descrizione"""
+            fp = filedialog.askopenfilenames(filetypes=[("PDF Files", "*.pdf")], parent=d)
+            if fp:
+                carica_percorsi(list(fp))
+        
+        def carica_cartella():
+            """Carica tutti i PDF di una cartella, sottocartelle comprese"""
+            cartella = filedialog.askdirectory(parent=d)
+            if not cartella:
+                return
+            percorsi = []
+            for radice, cartelle, nomi in os.walk(cartella):
+                cartelle.sort()
+                percorsi += [
+                    os.path.join(radice, n) for n in sorted(nomi) if n.lower().endswith(".pdf")
+                ]
+            carica_percorsi(percorsi)
         
         def modifica_descrizione():
             """Modifica descrizione allegato selezionato"""
@@ -2135,11 +2206,7 @@ class AppGestionale(tk.Tk):
             
             if nuova_desc is not None:  # Anche stringa vuota è valida
                 try:
-                    self.db.conn.execute(
-                        "UPDATE allegati_qe SET descrizione=? WHERE id=?",
-                        (nuova_desc, aid)
-                    )
-                    self.db.conn.commit()
+                    self.db.aggiorna_descrizione_allegato(aid, nuova_desc)
                     refresh()
                     messagebox.showinfo("OK", "Descrizione aggiornata.", parent=d)
                 except Exception as e:
@@ -2153,7 +2220,7 @@ class AppGestionale(tk.Tk):
                 return
             
             aid = tr.item(s)['values'][0]
-            r = self.db.get_allegato_blob(aid)
+            r = self.db.get_allegato_intestazione(aid)
             
             if r:
                 fn = filedialog.asksaveasfilename(
@@ -2162,9 +2229,13 @@ class AppGestionale(tk.Tk):
                     parent=d
                 )
                 if fn:
+                    w, progresso = self.finestra_progresso(d, "Salvataggio allegato")
                     try:
-                        with open(fn, 'wb') as f:
-                            f.write(r[1])
+                        # Scrittura a blocchi: il BLOB non passa intero in memoria
+                        try:
+                            self.db.salva_allegato_su_file(aid, fn, progresso=progresso)
+                        finally:
+                            w.destroy()
                         
                         # Apri file con applicazione predefinita
                         if platform.system() == 'Darwin':  # macOS
@@ -2196,6 +2267,13 @@ class AppGestionale(tk.Tk):
             width=20
         ).pack(fill='x', pady=(0, 5))
         
+        ttk.Button(
+            f_right,
+            text="📁 Carica Cartella",
+            command=carica_cartella,
+            width=20
+        ).pack(fill='x', pady=5)
+        
         ttk.Button(
             f_right,
             text="✏️ Modifica Descrizione",
@@ -2233,190 +2311,7 @@ class AppGestionale(tk.Tk):
         if not self.qe_corrente_id:
             return
         
-        qe = self.db.get_qe_by_id(self.qe_corrente_id)
-        proj = self.db.get_progetto_by_id(qe[1])
-        voci = self.db.get_voci_by_qe(self.qe_corrente_id)
-        
-        # Configurazione ente
-        ente_nome = self.db.get_config("ente_nome")
-        ente_dettagli = (
-            f"{self.db.get_config('ente_indirizzo')} - "
-            f"{self.db.get_config('ente_citta')}<br>"
-            f"Tel: {self.db.get_config('ente_tel')}"
-        )
-        
-        # Calcolo montante
-        montante = 0.0
-        for r in voci:
-            if r[7] == 0:
-                f_mont = r[14] if len(r) > 14 else 0
-                if f_mont == 1:
-                    montante += r[6]
-        
-        # Separa voci
-        l1 = []
-        l2 = []
-        t_oneri = 0.0
-        t_iva = 0.0
-        t_tasse = 0.0
-        
-        for r in voci:
-            imp = r[6] if r[7] == 0 else (montante * r[6] / 100)
-            one = imp * r[8] / 100
-            base_iva = (imp + one) if r[9] else imp
-            iva = base_iva * r[10] / 100
-            tot = imp + one + iva
-            
-            t_oneri += one
-            t_iva += iva
-            t_tasse += (one + iva)
-            
-            item = {
-                'r': r, 'code': r[3], 'desc': r[4], 
-                'imp': imp, 'one': one, 'iva': iva, 'tot': tot
-            }
-            
-            if r[11] == 1:
-                l1.append(item)
-            else:
-                l2.append(item)
-        
-        # Mappa categorie
-        cat_map = {}
-        cats = self.db.get_catalogo(proj[1])
-        for c in cats:
-            cat_map[c[1]] = c[3]
-        
-        def build_table_rows(items):
-            """Costruisce righe HTML per una sezione"""
-            h = ""
-            t_s = 0.0
-            
-            items.sort(key=lambda x: x['r'][2])
-            
-            for key, group in groupby(items, key=lambda x: x['r'][2]):
-                g_list = list(group)
-                
-                s_imp = sum(x['imp'] for x in g_list)
-                s_one = sum(x['one'] for x in g_list)
-                s_iva = sum(x['iva'] for x in g_list)
-                s_tot = sum(x['tot'] for x in g_list)
-                t_s += s_tot
-                
-                cat_desc = cat_map.get(key, f"Categoria {key}")
-                
-                # Riga categoria
-                h += (
-                    f"<tr class='cat-row'><td>{key}</td><td>{cat_desc}</td>"
-                    f"<td align='right'>{self.fmt(s_imp)}</td>"
-                    f"<td align='right'>{self.fmt(s_one)}</td>"
-                    f"<td align='right'>{self.fmt(s_iva)}</td>"
-                    f"<td align='right'>{self.fmt(s_tot)}</td></tr>"
-                )
-                
-                # Righe voci
-                for i in g_list:
-                    h += (
-                        f"<tr><td style='padding-left:20px;'>{i['code']}</td>"
-                        f"<td>{i['desc']}</td>"
-                        f"<td align='right'>{self.fmt(i['imp'])}</td>"
-                        f"<td align='right'>{self.fmt(i['one'])}</td>"
-                        f"<td align='right'>{self.fmt(i['iva'])}</td>"
-                        f"<td align='right'>{self.fmt(i['tot'])}</td></tr>"
-                    )
-            
-            return h, t_s
-        
-        r1, tot1 = build_table_rows(l1)
-        r2, tot2 = build_table_rows(l2)
-        
-        # Riga IVA
-        r2 += (
-            f"<tr style='background-color:#e6f7ff; font-weight:bold;'>"
-            f"<td></td><td>Riepilogo IVA e Imposte</td>"
-            f"<td align='right'>{self.fmt(t_tasse)}</td>"
-            f"<td align='right'>{self.fmt(t_oneri)}</td>"
-            f"<td align='right'>{self.fmt(t_iva)}</td>"
-            f"<td align='right'></td></tr>"
-        )
-        
-        # Calcolo totali
-        t1_imp = sum([x['imp'] for x in l1])
-        t2_imp = sum([x['imp'] for x in l2])
-        tot2_full = t2_imp + t_tasse
-        tot_qe = t1_imp + tot2_full
-        
-        imp_stanziato = proj[5]
-        economie = imp_stanziato - tot_qe
-        col_eco = "green" if economie >= 0 else "red"
-        
-        # Header HTML
-        header_html = (
-            f"<div class='h-ente'><h2>{ente_nome}</h2>"
-            f"<p>{ente_dettagli}</p><hr>"
-            f"<h3>Progetto: {proj[4]} (CUP: {proj[2]})</h3>"
-            f"<p><b>QE:</b> {qe[2]}<br><b>Note:</b> {qe[4]}</p></div>"
-        )
-        
-        table_start = (
-            "<table style='width:100%; table-layout: fixed; border-collapse: collapse;'>"
-            "<thead><tr>"
-            "<th width='8%'>Cod</th><th width='32%'>Descrizione</th>"
-            "<th width='15%' align='right'>Imponibile</th>"
-            "<th width='15%' align='right'>Oneri</th>"
-            "<th width='15%' align='right'>IVA</th>"
-            "<th width='15%' align='right'>Totale</th>"
-            "</tr></thead><tbody>"
-        )
-        
-        # HTML completo
-        html = f"""<html>
-<head>
-<style>
-body {{ font-family: Arial; padding: 30px; }}
-table {{ margin-bottom: 20px; font-size: 12px; width:100%; border-collapse:collapse; }}
-td, th {{ border: 1px solid #ccc; padding: 5px; }}
-th {{ background: #ddd; }}
-.cat-row {{ background-color: #d9d9d9; font-weight: bold; }}
-.tot-row {{ background: #ccc; font-weight: bold; }}
-.sec-title {{ background-color: #000; color: #fff; padding: 5px; font-weight: bold; margin-top: 20px; }}
-</style>
-</head>
-<body>
-{header_html}
-<div class="sec-title">1. SPESE PER L'ESECUZIONE DELL'INTERVENTO</div>
-{table_start}{r1}
-<tr class="tot-row">
-<td colspan="2" align="right">Totale (1):</td>
-<td align="right">{self.fmt(t1_imp)}</td>
-<td></td><td></td><td></td>
-</tr></tbody></table>
-
-<div class="sec-title">2. SOMME A DISPOSIZIONE</div>
-{table_start}{r2}
-<tr class="tot-row">
-<td colspan="2" align="right">Totale (2):</td>
-<td align="right">{self.fmt(tot2_full)}</td>
-<td></td><td></td><td></td>
-</tr></tbody></table>
-
-<br>
-<table style="width:100%; border: 2px solid #000;">
-<tr>
-<td width="70%" align="right"><b>TOTALE INTERVENTO (1+2):</b></td>
-<td width="30%" align="right"><b>{self.fmt(tot_qe)} €</b></td>
-</tr>
-<tr>
-<td align="right">Importo Stanziato:</td>
-<td align="right">{self.fmt(imp_stanziato)} €</td>
-</tr>
-<tr>
-<td align="right"><b>Economie / (Fabbisogni):</b></td>
-<td align="right" style="color:{col_eco}"><b>{self.fmt(economie)} €</b></td>
-</tr>
-</table>
-</body>
-</html>"""
+        html = html_qe(self.db, self.qe_corrente_id, *self.calcola_qe(self.qe_corrente_id))
         
         try:
             ts = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -2451,103 +2346,8 @@ th {{ background: #ddd; }}
             return
         
         try:
-            voci = self.db.get_voci_by_qe(self.qe_corrente_id)
-            proj = self.db.get_progetto_by_id(self.progetto_corrente_id)
-            
-            # Calcolo montante
-            montante = 0.0
-            for r in voci:
-                if r[7] == 0:
-                    f_mont = r[14] if len(r) > 14 else 0
-                    if f_mont == 1:
-                        montante += r[6]
-            
-            # Mappa categorie
-            cat_map = {}
-            cats = self.db.get_catalogo(proj[1])
-            for c in cats:
-                cat_map[c[1]] = c[3]
-            
-            # Separa voci
-            l1 = []
-            l2 = []
-            t_oneri = 0.0
-            t_iva = 0.0
-            t_tasse = 0.0
-            
-            for r in voci:
-                imp = r[6] if r[7] == 0 else (montante * r[6] / 100)
-                one = imp * r[8] / 100
-                base_iva = (imp + one) if r[9] else imp
-                iva = base_iva * r[10] / 100
-                tot = imp + one + iva
-                
-                t_oneri += one
-                t_iva += iva
-                t_tasse += (one + iva)
-                
-                item = {
-                    'r': r, 'code': r[3], 'desc': r[4], 
-                    'imp': imp, 'one': one, 'iva': iva, 'tot': tot
-                }
-                
-                if r[11] == 1:
-                    l1.append(item)
-                else:
-                    l2.append(item)
-            
-            t1_imp = sum([x['imp'] for x in l1])
-            t2_imp = sum([x['imp'] for x in l2])
-            
-            # Scrivi CSV
             with open(fn, 'w', newline='', encoding='utf-8-sig') as f:
-                w = csv.writer(f, delimiter=';')
-                w.writerow(["Codice", "Descrizione", "Imponibile", "Oneri", "IVA", "Totale", "Note"])
-                
-                def write_group_section(items_list):
-                    items_list.sort(key=lambda x: x['r'][2])
-                    
-                    for key, group in groupby(items_list, key=lambda x: x['r'][2]):
-                        g_list = list(group)
-                        
-                        s_imp = sum(x['imp'] for x in g_list)
-                        s_one = sum(x['one'] for x in g_list)
-                        s_iva = sum(x['iva'] for x in g_list)
-                        s_tot = sum(x['tot'] for x in g_list)
-                        
-                        cat_desc = cat_map.get(key, f"Categoria {key}")
-                        
-                        w.writerow([
-                            key, cat_desc.upper(), 
-                            self.fmt(s_imp), self.fmt(s_one), 
-                            self.fmt(s_iva), self.fmt(s_tot), 
-                            "Riepilogo Categoria"
-                        ])
-                        
-                        for i in g_list:
-                            w.writerow([
-                                i['code'], i['desc'], 
-                                self.fmt(i['imp']), self.fmt(i['one']), 
-                                self.fmt(i['iva']), self.fmt(i['tot']), ""
-                            ])
-                
-                w.writerow(["", "1. SPESE PER L'ESECUZIONE DELL'INTERVENTO", "", "", "", "", ""])
-                write_group_section(l1)
-                w.writerow(["", "Totale (1)", self.fmt(t1_imp), "", "", "", ""])
-                
-                w.writerow([])
-                w.writerow(["", "2. SOMME A DISPOSIZIONE", "", "", "", "", ""])
-                write_group_section(l2)
-                w.writerow([
-                    "", "Riepilogo IVA e Imposte", 
-                    self.fmt(t_tasse), self.fmt(t_oneri), 
-                    self.fmt(t_iva), "", ""
-                ])
-                w.writerow(["", "Totale (2)", self.fmt(t2_imp + t_tasse), "", "", "", ""])
-                
-                w.writerow([])
-                tot_qe = t1_imp + t2_imp + t_tasse
-                w.writerow(["", "TOTALE COMPLESSIVO", self.fmt(tot_qe), "", "", "", ""])
+                scrivi_csv_qe(f, self.db, self.qe_corrente_id, *self.calcola_qe(self.qe_corrente_id))
             
             messagebox.showinfo("Export", "Esportazione completata con successo!")
             
@@ -2629,6 +2429,61 @@ th {{ background: #ddd; }}
             font=("Arial", 12, "bold")
         )
         self.lbl_diff_tot.pack(pady=10)
+        
+        # --- SCENARI WHAT-IF SUL QE A ---
+        lf_scen = ttk.LabelFrame(
+            self.t6, 
+            text="Scenari what-if sul QE A (le voci non vengono modificate)", 
+            padding=5
+        )
+        lf_scen.pack(fill='x', padx=20, pady=5)
+        
+        ttk.Label(lf_scen, text="Ribassi (%):").grid(row=0, column=0, sticky='w')
+        self.e_scen_rib = ttk.Entry(lf_scen, width=20)
+        self.e_scen_rib.grid(row=0, column=1, padx=5)
+        
+        ttk.Label(lf_scen, text="Aliquote IVA (%):").grid(row=0, column=2, sticky='w')
+        self.e_scen_iva = ttk.Entry(lf_scen, width=14)
+        self.e_scen_iva.grid(row=0, column=3, padx=5)
+        
+        ttk.Label(lf_scen, text="Montante (€):").grid(row=0, column=4, sticky='w')
+        self.e_scen_mont = ttk.Entry(lf_scen, width=18)
+        self.e_scen_mont.grid(row=0, column=5, padx=5)
+        
+        ttk.Button(lf_scen, text="CALCOLA SCENARI", command=self.effettua_scenari).grid(
+            row=0, column=6, padx=10
+        )
+        ttk.Button(lf_scen, text="Stampa Scenari", command=self.stampa_scenari).grid(
+            row=0, column=7
+        )
+        
+        ttk.Label(
+            lf_scen, 
+            text="Valori separati da ';' (es. 5; 10; 12,5): si calcolano tutte le combinazioni. "
+                 "Campo vuoto = valore del QE invariato.", 
+            foreground="gray", 
+            font=("Segoe UI", 8)
+        ).grid(row=1, column=0, columnspan=8, sticky='w', pady=(3, 0))
+        
+        c_scen = ("Scen", "Mont", "Imp", "Tasse", "Tot", "Diff", "Eco")
+        self.tr_scen = ttk.Treeview(lf_scen, columns=c_scen, show='headings', height=8)
+        self.tr_scen.tag_configure('up', foreground='green')
+        self.tr_scen.tag_configure('down', foreground='red')
+        
+        for c, h, w in [
+            ("Scen", "Scenario", 280),
+            ("Mont", "Montante", 110),
+            ("Imp", "Imponibile", 110),
+            ("Tasse", "Oneri e IVA", 110),
+            ("Tot", "Totale QE", 110),
+            ("Diff", "Diff. vs QE", 100),
+            ("Eco", "Economie", 110)
+        ]:
+            self.tr_scen.heading(c, text=h)
+            self.tr_scen.column(c, width=w, anchor='w' if c == "Scen" else 'e')
+        
+        self.tr_scen.grid(row=2, column=0, columnspan=8, sticky='ew', pady=5)
+        self.scenari_qe = None
     
     def refresh_confronto_combo(self):
         """Aggiorna combobox confronto"""
@@ -2636,11 +2491,31 @@ th {{ background: #ddd; }}
             return
         
         qes = self.db.get_qe_by_progetto(self.progetto_corrente_id)
-        vals = [f"{q[0]} - {q[2]}" for q in qes]
+        totali = {
+            t[0]: t[7] for t in self.db.get_totali_qe(self.progetto_corrente_id)
+        }
+        
+        # Etichetta combo -> nome versione (l'etichetta include il totale)
+        self.nomi_qe_confronto = {}
+        vals = []
+        for q in qes:
+            lbl = f"{q[0]} - {q[2]} (€ {self.fmt_cent(totali.get(q[0], 0))})"
+            self.nomi_qe_confronto[lbl] = q[2]
+            vals.append(lbl)
         
         self.cb_qe1['values'] = vals
         self.cb_qe2['values'] = vals
     
+    def dati_confronto(self, qid):
+        """Imponibili per codice voce e totale imposte di un QE"""
+        voci, calc = self.calcola_qe(qid)
+        
+        data = {}
+        for k, r in enumerate(voci):
+            data[r.codice_completo] = {'desc': r.descrizione, 'imp': calc.imp[k], 'flag': r.flag_base_asta}
+        
+        return data, calc.tot_tasse
+    
     def effettua_confronto(self):
         """Confronta due versioni QE"""
         s1, s2 = self.cb_qe1.get(), self.cb_qe2.get()
@@ -2650,48 +2525,22 @@ th {{ background: #ddd; }}
             return
         
         id1, id2 = int(s1.split(' - ')[0]), int(s2.split(' - ')[0])
-        v1 = self.db.get_voci_by_qe(id1)
-        v2 = self.db.get_voci_by_qe(id2)
-        
-        def get_calc_imponibili(vl):
-            """Calcola imponibili per lista voci"""
-            # Calcolo montante
-            m = 0.0
-            for r in vl:
-                if r[7] == 0:
-                    f_mont = r[14] if len(r) > 14 else 0
-                    if f_mont == 1:
-                        m += r[6]
-            
-            res = {}
-            tx = 0.0
-            
-            for r in vl:
-                i = r[6] if r[7] == 0 else (m * r[6] / 100)
-                res[r[3]] = {'desc': r[4], 'imp': i}
-                
-                o = i * r[8] / 100
-                base_iva = (i + o) if r[9] else i
-                iv = base_iva * r[10] / 100
-                tx += (o + iv)
-            
-            return res, tx
         
-        d1, t1 = get_calc_imponibili(v1)
-        d2, t2 = get_calc_imponibili(v2)
+        d1, t1 = self.dati_confronto(id1)
+        d2, t2 = self.dati_confronto(id2)
         
         codes = sorted(list(set(d1.keys()) | set(d2.keys())))
         
         self.tr_diff.delete(*self.tr_diff.get_children())
         
-        sa = 0.0
-        sb = 0.0
-        grand_delta = 0.0
+        sa = 0
+        sb = 0
+        grand_delta = 0
         
         for c in codes:
-            i1 = d1.get(c, {'desc': '', 'imp': 0.0})['imp']
+            i1 = d1.get(c, {'desc': '', 'imp': 0})['imp']
             desc = d2.get(c, {'desc': d1.get(c, {'desc': ''})['desc']})['desc']
-            i2 = d2.get(c, {'desc': '', 'imp': 0.0})['imp']
+            i2 = d2.get(c, {'desc': '', 'imp': 0})['imp']
             d = i2 - i1
             
             sa += i1
@@ -2700,14 +2549,14 @@ th {{ background: #ddd; }}
             
             perc = ((i2 - i1) / i1 * 100) if i1 != 0 else (0.0 if i2 == 0 else 100.0)
             
-            tag = 'up' if d > 0.01 else ('down' if d < -0.01 else '')
+            tag = 'up' if d > 0 else ('down' if d < 0 else '')
             
             self.tr_diff.insert(
                 "", "end", 
                 values=(
                     c, desc, 
-                    self.fmt(i1), self.fmt(i2), 
-                    self.fmt(d), f"{perc:+.2f}%"
+                    self.fmt_cent(i1), self.fmt_cent(i2), 
+                    self.fmt_cent(d), f"{perc:+.2f}%"
                 ), 
                 tags=(tag,)
             )
@@ -2717,24 +2566,173 @@ th {{ background: #ddd; }}
         grand_delta += dt
         
         perc_t = ((t2 - t1) / t1 * 100) if t1 != 0 else 0.0
-        tagt = 'up' if dt > 0.01 else ('down' if dt < -0.01 else '')
+        tagt = 'up' if dt > 0 else ('down' if dt < 0 else '')
         
         self.tr_diff.insert(
             "", "end", 
             values=(
                 "", "IVA e altre imposte", 
-                self.fmt(t1), self.fmt(t2), 
-                self.fmt(dt), f"{perc_t:+.2f}%"
+                self.fmt_cent(t1), self.fmt_cent(t2), 
+                self.fmt_cent(dt), f"{perc_t:+.2f}%"
             ), 
             tags=(tagt,)
         )
         
         col_tot = "green" if grand_delta >= 0 else "red"
         self.lbl_diff_tot.config(
-            text=f"Variazione Totale: {self.fmt(grand_delta)} €", 
+            text=f"Variazione Totale: {self.fmt_cent(grand_delta)} €", 
             foreground=col_tot
         )
     
+    def _valori_scenario(self, testo, nome, cent=False):
+        """Valori separati da ';' di un parametro degli scenari ([None] se vuoto).
+        ValueError se uno non è un numero: non deve diventare uno scenario a 0"""
+        parti = [x.strip() for x in testo.split(';') if x.strip()]
+        if not parti:
+            return [None]
+        errati = [x for x in parti if not importo_valido(x)]
+        if errati:
+            raise ValueError(f"{nome}: valori non validi " + ", ".join(f"'{x}'" for x in errati))
+        return [leggi_cent(x) if cent else leggi_euro(x) for x in parti]
+    
+    def effettua_scenari(self):
+        """Calcola gli scenari what-if sul QE A e li mostra in tabella"""
+        s1 = self.cb_qe1.get()
+        if not s1:
+            messagebox.showwarning("Attenzione", "Seleziona il QE A su cui calcolare gli scenari")
+            return
+        
+        qid = int(s1.split(' - ')[0])
+        
+        parametri, errori = [], []
+        for entry, nome, cent in (
+            (self.e_scen_rib, "Ribassi", False), 
+            (self.e_scen_iva, "Aliquote IVA", False), 
+            (self.e_scen_mont, "Montante", True)
+        ):
+            try:
+                parametri.append(self._valori_scenario(entry.get(), nome, cent))
+            except ValueError as e:
+                errori.append(str(e))
+        if errori:
+            messagebox.showwarning(
+                "Attenzione", "\n".join(errori) + "\n\nUsa numeri separati da ';' (es. 10; 12,5)."
+            )
+            return
+        
+        # Tutte le combinazioni dei parametri; il primo scenario è il QE invariato
+        scenari = [{}]
+        for rib, iva, mont in product(*parametri):
+            sc = {k: v for k, v in (("ribasso", rib), ("iva", iva), ("montante", mont)) 
+                  if v is not None}
+            if sc:
+                scenari.append(sc)
+        
+        voci, calc = self.calcola_qe(qid)
+        proj = self.db.get_progetto_by_id(self.progetto_corrente_id)
+        budget = (proj[6] or 0) if proj else None
+        
+        tabella = calcola_scenari(voci, scenari).tabella(calc.totale, budget)
+        self.scenari_qe = (self.nomi_qe_confronto.get(s1, ""), tabella)
+        
+        self.tr_scen.delete(*self.tr_scen.get_children())
+        for nome, mont, imp, tasse, tot, diff, eco in tabella:
+            tag = '' if not eco else ('up' if eco > 0 else 'down')
+            self.tr_scen.insert(
+                "", "end", 
+                values=(
+                    nome, self.fmt_cent(mont), self.fmt_cent(imp), self.fmt_cent(tasse), 
+                    self.fmt_cent(tot), self.fmt_cent(diff), 
+                    "-" if eco is None else self.fmt_cent(eco)
+                ), 
+                tags=(tag,)
+            )
+    
+    def stampa_scenari(self):
+        """Genera report HTML degli scenari what-if"""
+        if not self.scenari_qe:
+            messagebox.showwarning("Attenzione", "Calcola prima gli scenari.")
+            return
+        
+        nome_qe, tabella = self.scenari_qe
+        
+        righe = ""
+        for nome, mont, imp, tasse, tot, diff, eco in tabella:
+            col = "black" if not eco else ("green" if eco > 0 else "red")
+            righe += (
+                f"<tr><td>{nome}</td>"
+                f"<td style='text-align: right;'>{self.fmt_cent(mont)}</td>"
+                f"<td style='text-align: right;'>{self.fmt_cent(imp)}</td>"
+                f"<td style='text-align: right;'>{self.fmt_cent(tasse)}</td>"
+                f"<td style='text-align: right; font-weight:bold;'>{self.fmt_cent(tot)}</td>"
+                f"<td style='text-align: right;'>{self.fmt_cent(diff)}</td>"
+                f"<td style='text-align: right; color:{col}; font-weight:bold;'>"
+                f"{'-' if eco is None else self.fmt_cent(eco)}</td></tr>"
+            )
+        
+        ente = self.db.get_config("ente_nome")
+        dett = f"{self.db.get_config('ente_indirizzo')} - {self.db.get_config('ente_citta')}"
+        proj = self.db.get_progetto_by_id(self.progetto_corrente_id)
+        
+        html = f"""<html>
+<head>
+<style>
+body {{ font-family: 'Segoe UI', Arial, sans-serif; padding: 40px; }}
+table {{ width: 100%; border-collapse: collapse; margin-top: 0; font-size: 12px; }}
+th, td {{ border: 1px solid #ddd; padding: 6px; text-align: left; }}
+th {{ background-color: #ddd; color: #000; font-weight: bold; }}
+h1, h2, h3 {{ color: #003366; text-align: center; }}
+.meta {{ text-align: center; color: #555; margin-bottom: 30px; }}
+</style>
+</head>
+<body>
+<h1>{ente}</h1>
+<p class="meta">{dett}</p>
+<hr>
+<h2>SCENARI WHAT-IF DEL QUADRO ECONOMICO</h2>
+<p class="meta">
+<b>Progetto:</b> {proj[4]} (CUP: {proj[2]})<br>
+QE di riferimento: {nome_qe} - Importo finanziato: € {self.fmt_cent(proj[6] or 0)}
+</p>
+
+<table style="width:100%; table-layout: fixed; border-collapse: collapse;">
+<thead>
+<tr>
+<th width="30%">Scenario</th>
+<th width="12%" style="text-align: right;">Montante</th>
+<th width="12%" style="text-align: right;">Imponibile</th>
+<th width="11%" style="text-align: right;">Oneri e IVA</th>
+<th width="12%" style="text-align: right;">Totale QE</th>
+<th width="11%" style="text-align: right;">Diff. vs QE</th>
+<th width="12%" style="text-align: right;">Economie</th>
+</tr>
+</thead>
+<tbody>{righe}</tbody>
+</table>
+
+<p style="font-size:10px; color:gray; margin-top:30px;">
+Il ribasso si applica alle voci fisse soggette a ribasso; montante, voci a percentuale, 
+oneri e IVA sono ricalcolati di conseguenza.<br>
+Generato il {datetime.datetime.now().strftime("%d/%m/%Y")}
+</p>
+</body>
+</html>"""
+        
+        try:
+            ts = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+            fn = os.path.join(
+                self.db.stampe_path, 
+                f"Report_Scenari_{ts}.html")
+            
+            with open(fn, "w", encoding="utf-8") as f:
+                f.write(html)
+            
+            url = 'file://' + urllib.request.pathname2url(os.path.abspath(fn))
+            webbrowser.open(url)
+            
+        except Exception as e:
+            messagebox.showerror("Errore Stampa", f"Impossibile creare il report:\n{e}")
+
     def stampa_confronto(self):
         """Genera report HTML di confronto"""
         items = self.tr_diff.get_children()
@@ -2745,32 +2743,8 @@ th {{ background: #ddd; }}
         id1 = int(self.cb_qe1.get().split(' - ')[0])
         id2 = int(self.cb_qe2.get().split(' - ')[0])
         
-        v1 = self.db.get_voci_by_qe(id1)
-        v2 = self.db.get_voci_by_qe(id2)
-        
-        def get_data_calc(voci):
-            montante = 0.0
-            for r in voci:
-                if r[7] == 0:
-                    f_mont = r[14] if len(r) > 14 else 0
-                    if f_mont == 1:
-                        montante += r[6]
-            
-            data = {}
-            taxes = 0.0
-            
-            for r in voci:
-                imp = r[6] if r[7] == 0 else (montante * r[6] / 100)
-                one = imp * r[8] / 100
-                base_iva = (imp + one) if r[9] else imp
-                iva = base_iva * r[10] / 100
-                taxes += (one + iva)
-                data[r[3]] = {'desc': r[4], 'imp': imp, 'flag': r[11]}
-            
-            return data, taxes
-        
-        d1, t1 = get_data_calc(v1)
-        d2, t2 = get_data_calc(v2)
+        d1, t1 = self.dati_confronto(id1)
+        d2, t2 = self.dati_confronto(id2)
         
         all_codes = sorted(list(set(d1.keys()) | set(d2.keys())))
         
@@ -2788,25 +2762,25 @@ th {{ background: #ddd; }}
         
         def build_html_rows(cod_list):
             h = ""
-            sum_a = 0.0
-            sum_b = 0.0
+            sum_a = 0
+            sum_b = 0
             
             for c in cod_list:
-                i1 = d1.get(c, {'imp': 0.0})['imp']
-                i2 = d2.get(c, {'imp': 0.0})['imp']
+                i1 = d1.get(c, {'imp': 0})['imp']
+                i2 = d2.get(c, {'imp': 0})['imp']
                 diff = i2 - i1
                 sum_a += i1
                 sum_b += i2
                 
                 desc = d2.get(c, {'desc': d1.get(c, {'desc': ''})['desc']})['desc']
                 perc = ((i2 - i1) / i1 * 100) if i1 != 0 else (0.0 if i2 == 0 else 100.0)
-                col = "green" if diff > 0.01 else ("red" if diff < -0.01 else "black")
+                col = "green" if diff > 0 else ("red" if diff < 0 else "black")
                 
                 h += (
                     f"<tr><td>{c}</td><td>{desc}</td>"
-                    f"<td style='text-align: right;'>{self.fmt(i1)}</td>"
-                    f"<td style='text-align: right;'>{self.fmt(i2)}</td>"
-                    f"<td style='text-align: right; color:{col};'>{self.fmt(diff)}</td>"
+                    f"<td style='text-align: right;'>{self.fmt_cent(i1)}</td>"
+                    f"<td style='text-align: right;'>{self.fmt_cent(i2)}</td>"
+                    f"<td style='text-align: right; color:{col};'>{self.fmt_cent(diff)}</td>"
                     f"<td style='text-align: right; color:{col}; font-weight:bold;'>{perc:+.2f}%</td></tr>"
                 )
             
@@ -2817,26 +2791,26 @@ th {{ background: #ddd; }}
         
         d1_tot = b1 - a1
         p1_tot = ((b1 - a1) / a1 * 100) if a1 != 0 else 0.0
-        c1 = "green" if d1_tot > 0.01 else ("red" if d1_tot < -0.01 else "black")
+        c1 = "green" if d1_tot > 0 else ("red" if d1_tot < 0 else "black")
         
         h1 += (
             f"<tr class='tot-row'><td colspan='2'>Totale (1)</td>"
-            f"<td style='text-align: right;'>{self.fmt(a1)}</td>"
-            f"<td style='text-align: right;'>{self.fmt(b1)}</td>"
-            f"<td style='text-align: right; color:{c1}'>{self.fmt(d1_tot)}</td>"
+            f"<td style='text-align: right;'>{self.fmt_cent(a1)}</td>"
+            f"<td style='text-align: right;'>{self.fmt_cent(b1)}</td>"
+            f"<td style='text-align: right; color:{c1}'>{self.fmt_cent(d1_tot)}</td>"
             f"<td style='text-align: right; color:{c1}'>{p1_tot:+.2f}%</td></tr>"
         )
         
         d_t = t2 - t1
-        col_t = "green" if d_t > 0.01 else ("red" if d_t < -0.01 else "black")
+        col_t = "green" if d_t > 0 else ("red" if d_t < 0 else "black")
         pt = ((t2 - t1) / t1 * 100) if t1 != 0 else 0.0
         
         h2 += (
             f"<tr style='background-color:#e6f7ff; font-weight:bold;'>"
             f"<td></td><td>IVA e altre imposte (Totale)</td>"
-            f"<td style='text-align: right;'>{self.fmt(t1)}</td>"
-            f"<td style='text-align: right;'>{self.fmt(t2)}</td>"
-            f"<td style='text-align: right; color:{col_t}'>{self.fmt(d_t)}</td>"
+            f"<td style='text-align: right;'>{self.fmt_cent(t1)}</td>"
+            f"<td style='text-align: right;'>{self.fmt_cent(t2)}</td>"
+            f"<td style='text-align: right; color:{col_t}'>{self.fmt_cent(d_t)}</td>"
             f"<td style='text-align: right; color:{col_t}'>{pt:+.2f}%</td></tr>"
         )
         
@@ -2844,27 +2818,27 @@ th {{ background: #ddd; }}
         tot2_b = b2 + t2
         diff2 = tot2_b - tot2_a
         pt2 = ((tot2_b - tot2_a) / tot2_a * 100) if tot2_a != 0 else 0.0
-        c2 = "green" if diff2 > 0.01 else ("red" if diff2 < -0.01 else "black")
+        c2 = "green" if diff2 > 0 else ("red" if diff2 < 0 else "black")
         
         h2 += (
             f"<tr class='tot-row'><td colspan='2'>Totale (2)</td>"
-            f"<td style='text-align: right;'>{self.fmt(tot2_a)}</td>"
-            f"<td style='text-align: right;'>{self.fmt(tot2_b)}</td>"
-            f"<td style='text-align: right; color:{c2}'>{self.fmt(diff2)}</td>"
+            f"<td style='text-align: right;'>{self.fmt_cent(tot2_a)}</td>"
+            f"<td style='text-align: right;'>{self.fmt_cent(tot2_b)}</td>"
+            f"<td style='text-align: right; color:{c2}'>{self.fmt_cent(diff2)}</td>"
             f"<td style='text-align: right; color:{c2}'>{pt2:+.2f}%</td></tr>"
         )
         
         tot1 = a1 + tot2_a
         tot2 = b1 + tot2_b
         d_tot = tot2 - tot1
-        col_g = "green" if d_tot > 0.01 else ("red" if d_tot < -0.01 else "black")
+        col_g = "green" if d_tot > 0 else ("red" if d_tot < 0 else "black")
         ptot = ((tot2 - tot1) / tot1 * 100) if tot1 != 0 else 0.0
         
         ente = self.db.get_config("ente_nome")
         dett = f"{self.db.get_config('ente_indirizzo')} - {self.db.get_config('ente_citta')}"
         proj = self.db.get_progetto_by_id(self.progetto_corrente_id)
-        qe_a = self.cb_qe1.get().split(' - ')[1]
-        qe_b = self.cb_qe2.get().split(' - ')[1]
+        qe_a = self.nomi_qe_confronto.get(self.cb_qe1.get(), "")
+        qe_b = self.nomi_qe_confronto.get(self.cb_qe2.get(), "")
         
         html = f"""<html>
 <head>
@@ -2921,9 +2895,9 @@ Confronto: {qe_a} (A) vs {qe_b} (B)
 <table style="width:100%; table-layout: fixed; border-collapse: collapse; border: 2px solid #000;">
 <tr class="tot-row">
 <th width="36%" style="text-align: right; padding: 6px;">TOTALE COMPLESSIVO (1+2):</th>
-<th width="16%" style="text-align: right; padding: 6px;">{self.fmt(tot1)}</th>
-<th width="16%" style="text-align: right; padding: 6px;">{self.fmt(tot2)}</th>
-<th width="16%" style="text-align: right; color:{col_g}; padding: 6px;">{self.fmt(d_tot)}</th>
+<th width="16%" style="text-align: right; padding: 6px;">{self.fmt_cent(tot1)}</th>
+<th width="16%" style="text-align: right; padding: 6px;">{self.fmt_cent(tot2)}</th>
+<th width="16%" style="text-align: right; color:{col_g}; padding: 6px;">{self.fmt_cent(d_tot)}</th>
 <th width="16%" style="text-align: right; color:{col_g}; padding: 6px;">{ptot:+.2f}%</th>
 </tr>
 </table>
@@ -2966,32 +2940,8 @@ Generato il {datetime.datetime.now().strftime("%d/%m/%Y")}
         id1 = int(self.cb_qe1.get().split(' - ')[0])
         id2 = int(self.cb_qe2.get().split(' - ')[0])
         
-        v1 = self.db.get_voci_by_qe(id1)
-        v2 = self.db.get_voci_by_qe(id2)
-        
-        def gd(vl):
-            m = 0.0
-            d = {}
-            tx = 0.0
-            
-            for r in vl:
-                if r[7] == 0:
-                    f_mont = r[14] if len(r) > 14 else 0
-                    if f_mont == 1:
-                        m += r[6]
-            
-            for r in vl:
-                i = r[6] if r[7] == 0 else (m * r[6] / 100)
-                o = i * r[8] / 100
-                base_iva = (i + o) if r[9] else i
-                iv = base_iva * r[10] / 100
-                tx += (o + iv)
-                d[r[3]] = {'desc': r[4], 'imp': i, 'flag': r[11]}
-            
-            return d, tx
-        
-        d1, t1 = gd(v1)
-        d2, t2 = gd(v2)
+        d1, t1 = self.dati_confronto(id1)
+        d2, t2 = self.dati_confronto(id2)
         
         codes = sorted(list(set(d1.keys()) | set(d2.keys())))
         
@@ -3011,18 +2961,18 @@ Generato il {datetime.datetime.now().strftime("%d/%m/%Y")}
                         s2.append(c)
                 
                 def ws(cl):
-                    sa = 0.0
-                    sb = 0.0
+                    sa = 0
+                    sb = 0
                     
                     for c in cl:
-                        i1 = d1.get(c, {'imp': 0.0})['imp']
-                        i2 = d2.get(c, {'imp': 0.0})['imp']
+                        i1 = d1.get(c, {'imp': 0})['imp']
+                        i2 = d2.get(c, {'imp': 0})['imp']
                         d = i2 - i1
                         perc = ((i2 - i1) / i1 * 100) if i1 != 0 else (0.0 if i2 == 0 else 100.0)
                         sa += i1
                         sb += i2
                         de = d2.get(c, {'desc': d1.get(c, {'desc': ''})['desc']})['desc']
-                        w.writerow([c, de, self.fmt(i1), self.fmt(i2), self.fmt(d), f"{perc:+.2f}%"])
+                        w.writerow([c, de, self.fmt_cent(i1), self.fmt_cent(i2), self.fmt_cent(d), f"{perc:+.2f}%"])
                     
                     return sa, sb
                 
@@ -3030,7 +2980,7 @@ Generato il {datetime.datetime.now().strftime("%d/%m/%Y")}
                 a1, b1 = ws(s1)
                 d1_tot = b1 - a1
                 p1_tot = ((b1 - a1) / a1 * 100) if a1 != 0 else 0.0
-                w.writerow(["Totale 1", "", self.fmt(a1), self.fmt(b1), self.fmt(d1_tot), f"{p1_tot:+.2f}%"])
+                w.writerow(["Totale 1", "", self.fmt_cent(a1), self.fmt_cent(b1), self.fmt_cent(d1_tot), f"{p1_tot:+.2f}%"])
                 
                 w.writerow([])
                 w.writerow(["2. SOMME DISP", "", "", "", "", ""])
@@ -3038,20 +2988,20 @@ Generato il {datetime.datetime.now().strftime("%d/%m/%Y")}
                 
                 dt = t2 - t1
                 pt = ((t2 - t1) / t1 * 100) if t1 != 0 else 0.0
-                w.writerow(["", "IVA Tot", self.fmt(t1), self.fmt(t2), self.fmt(dt), f"{pt:+.2f}%"])
+                w.writerow(["", "IVA Tot", self.fmt_cent(t1), self.fmt_cent(t2), self.fmt_cent(dt), f"{pt:+.2f}%"])
                 
                 t2a = a2 + t1
                 t2b = b2 + t2
                 dt2 = t2b - t2a
                 pt2 = ((t2b - t2a) / t2a * 100) if t2a != 0 else 0.0
-                w.writerow(["Totale 2", "", self.fmt(t2a), self.fmt(t2b), self.fmt(dt2), f"{pt2:+.2f}%"])
+                w.writerow(["Totale 2", "", self.fmt_cent(t2a), self.fmt_cent(t2b), self.fmt_cent(dt2), f"{pt2:+.2f}%"])
                 
                 w.writerow([])
                 ta = a1 + t2a
                 tb = b1 + t2b
                 dgen = tb - ta
                 pgen = ((tb - ta) / ta * 100) if ta != 0 else 0.0
-                w.writerow(["TOTALE", "", self.fmt(ta), self.fmt(tb), self.fmt(dgen), f"{pgen:+.2f}%"])
+                w.writerow(["TOTALE", "", self.fmt_cent(ta), self.fmt_cent(tb), self.fmt_cent(dgen), f"{pgen:+.2f}%"])
             
             messagebox.showinfo("Export", "Esportazione completata con successo!")
             
@@ -3135,6 +3085,36 @@ Generato il {datetime.datetime.now().strftime("%d/%m/%Y")}
             fill='x', pady=5
         )
         
+        # 4. Allegati
+        lf_allegati = ttk.LabelFrame(f_top_container, text="4. Allegati", padding=10)
+        lf_allegati.pack(side='left', fill='both', padx=(5, 0))
+        
+        ttk.Label(lf_allegati, text="Compressione:").pack(anchor='w')
+        self.cb_compressione = ttk.Combobox(
+            lf_allegati, 
+            state="readonly", 
+            width=12, 
+            values=self.CODEC_COMPRESSIONE
+        )
+        self.cb_compressione.pack(fill='x', pady=2)
+        self.cb_compressione.bind("<<ComboboxSelected>>", self.salva_compressione)
+        
+        ttk.Label(lf_allegati, text="Archivio:").pack(anchor='w')
+        self.cb_archivio = ttk.Combobox(
+            lf_allegati, 
+            state="readonly", 
+            width=12, 
+            values=("database", "cartella")
+        )
+        self.cb_archivio.pack(fill='x', pady=2)
+        self.cb_archivio.bind("<<ComboboxSelected>>", self.salva_archivio)
+        ttk.Button(lf_allegati, text="Spazio Risparmiato", command=self.report_allegati).pack(
+            fill='x', pady=5
+        )
+        ttk.Button(lf_allegati, text="Verifica Archivio", command=self.verifica_archivio).pack(
+            fill='x', pady=5
+        )
+        
         # PanedWindow: Normative | Catalogo
         paned = tk.PanedWindow(self.f_adm, orient=tk.HORIZONTAL, bg="#ccc")
         paned.pack(fill='both', expand=True, padx=5, pady=5)
@@ -3204,24 +3184,29 @@ Generato il {datetime.datetime.now().strftime("%d/%m/%Y")}
         ).pack(fill='x', pady=2)
 
     def backup_db(self):
-        """Crea backup database"""
-        try:
-            ts = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-            src = self.db.db_path
-            dst = os.path.join(self.db.documents_path, f"qezero_BACKUP_{ts}.db")
-            
-            shutil.copy2(src, dst)
-            messagebox.showinfo("Backup", f"Backup creato con successo:\n{os.path.basename(dst)}")
-            
-        except Exception as e:
-            messagebox.showerror("Errore Backup", f"Errore durante il backup:\n{e}")
+        """Crea backup database in background: l'interfaccia resta utilizzabile
+        e le modifiche fatte nel frattempo non entrano nella copia"""
+        def al_termine(esito):
+            if isinstance(esito, BackupAnnullato):
+                messagebox.showinfo("Backup", "Backup annullato.")
+            elif isinstance(esito, Exception):
+                messagebox.showerror("Errore Backup", f"Errore durante il backup:\n{esito}")
+            else:
+                messagebox.showinfo("Backup", f"Backup creato con successo:\n{esito}")
+        
+        self.lavoro_con_progresso(
+            self, "Backup database",
+            lambda db, avanza, interrompi: db.crea_backup(progresso=avanza, interrompi=interrompi),
+            (BackupAnnullato, OSError, sqlite3.Error), al_termine
+        )
 
     def importa_backup_dialog(self):
         """Dialog importazione progetti da backup"""
+        cartella_backup = os.path.join(self.db.documents_path, self.db.CARTELLA_BACKUP)
         file_path = filedialog.askopenfilename(
             title="Seleziona file di Backup (.db)",
             filetypes=[("Database SQLite", "*.db"), ("Tutti i file", "*.*")],
-            initialdir=self.db.documents_path
+            initialdir=cartella_backup if os.path.isdir(cartella_backup) else self.db.documents_path
         )
         
         if not file_path:
@@ -3229,6 +3214,15 @@ Generato il {datetime.datetime.now().strftime("%d/%m/%Y")}
         
         try:
             conn_backup = sqlite3.connect(file_path)
+            # Allegati nel backup stesso (versioni precedenti) o nel file accanto
+            file_allegati = percorso_allegati(file_path)
+            if os.path.exists(file_allegati):
+                conn_backup.execute(f"ATTACH DATABASE ? AS {SCHEMA_ALLEGATI}", (file_allegati,))
+            try:
+                conn_backup.execute("SELECT 1 FROM allegati_qe LIMIT 1")
+                ha_allegati = True
+            except sqlite3.OperationalError:
+                ha_allegati = False  # File degli allegati non trovato
             rows = conn_backup.execute(
                 "SELECT id, titolo, cup, importo, normativa_id FROM progetti ORDER BY id DESC"
             ).fetchall()
@@ -3327,84 +3321,67 @@ Generato il {datetime.datetime.now().strftime("%d/%m/%Y")}
                                 ).fetchall()
                                 v_rows = [list(r) + [0] for r in tmp_v]
                             
-                            a_rows = conn_backup.execute(
-                                "SELECT nome_file, tipo_file, dati, data_caricamento FROM allegati_qe WHERE qe_id=?",
-                                (old_qid,)
-                            ).fetchall()
-                            
                             qes_to_import.append({
                                 'meta': qe_row,
-                                'voci': v_rows,
-                                'allegati': a_rows
+                                'voci': v_rows
                             })
                         
                         # Inserimento nel DB corrente
-                        new_nid = 1
-                        if norm_data:
-                            norm_name, norm_desc = norm_data
-                            curr_norm = self.db.conn.execute(
-                                "SELECT id FROM normative WHERE nome=?",
-                                (norm_name,)
-                            ).fetchone()
+                        # (un progetto per transazione: se fallisce non ne resta nulla a metà)
+                        with self.db.transazione():
+                            new_nid = 1
+                            if norm_data:
+                                norm_name, norm_desc = norm_data
+                                curr_norm = self.db.conn.execute(
+                                    "SELECT id FROM normative WHERE nome=?",
+                                    (norm_name,)
+                                ).fetchone()
                             
-                            if curr_norm:
-                                new_nid = curr_norm[0]
-                            else:
-                                self.db.conn.execute(
-                                    "INSERT INTO normative (nome, descrizione) VALUES (?, ?)",
-                                    (norm_name, norm_desc)
-                                )
-                                new_nid = self.db.conn.execute(
-                                    "SELECT last_insert_rowid()"
-                                ).fetchone()[0]
-                                
-                                for c_row in cat_rows:
+                                if curr_norm:
+                                    new_nid = curr_norm[0]
+                                else:
                                     self.db.conn.execute(
-                                        """INSERT INTO catalogo_voci
-                                        (normativa_id, codice, macro_gruppo, descrizione)
-                                        VALUES (?, ?, ?, ?)""",
-                                        (new_nid, c_row[0], c_row[1], c_row[2])
+                                        "INSERT INTO normative (nome, descrizione) VALUES (?, ?)",
+                                        (norm_name, norm_desc)
                                     )
+                                    new_nid = self.db.conn.execute(
+                                        "SELECT last_insert_rowid()"
+                                    ).fetchone()[0]
+                                
+                                    for c_row in cat_rows:
+                                        self.db.conn.execute(
+                                            """INSERT INTO catalogo_voci
+                                            (normativa_id, codice, macro_gruppo, descrizione)
+                                            VALUES (?, ?, ?, ?)""",
+                                            (new_nid, c_row[0], c_row[1], c_row[2])
+                                        )
                         
-                        # Inserisci progetto
-                        self.db.conn.execute(
-                            """INSERT INTO progetti
-                            (normativa_id, cup, anno, titolo, importo)
-                            VALUES (?, ?, ?, ?, ?)""",
-                            (new_nid, p_row[0], p_row[1], p_row[2], p_row[3])
-                        )
-                        new_pid = self.db.conn.execute("SELECT last_insert_rowid()").fetchone()[0]
-                        
-                        # Inserisci QE e voci
-                        for qe_obj in qes_to_import:
-                            qm = qe_obj['meta']
+                            # Inserisci progetto
                             self.db.conn.execute(
-                                """INSERT INTO quadri_economici
-                                (progetto_id, nome_versione, data_creazione, note)
-                                VALUES (?, ?, ?, ?)""",
-                                (new_pid, qm[1], qm[2], qm[3])
+                                """INSERT INTO progetti
+                                (normativa_id, cup, anno, titolo, importo, importo_cent)
+                                VALUES (?, ?, ?, ?, ?, ?)""",
+                                (new_nid, p_row[0], p_row[1], p_row[2], p_row[3], centesimi(p_row[3]))
                             )
-                            new_qid = self.db.conn.execute("SELECT last_insert_rowid()").fetchone()[0]
-                            
-                            for v in qe_obj['voci']:
+                            new_pid = self.db.conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+                        
+                            # Inserisci QE e voci
+                            for qe_obj in qes_to_import:
+                                qm = qe_obj['meta']
                                 self.db.conn.execute(
-                                    """INSERT INTO voci
-                                    (qe_id, codice_padre, codice_completo, descrizione, tipo,
-                                    valore_imponibile, is_percentuale, perc_oneri, includi_oneri_in_iva,
-                                    perc_iva, flag_base_asta, flag_soggetto_ribasso, macro_base_calcolo,
-                                    flag_calcolo_montante)
-                                    VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)""",
-                                    (new_qid, v[0], v[1], v[2], v[3], v[4], v[5], v[6],
-                                     v[7], v[8], v[9], v[10], v[11], v[12])
+                                    """INSERT INTO quadri_economici
+                                    (progetto_id, nome_versione, data_creazione, note)
+                                    VALUES (?, ?, ?, ?)""",
+                                    (new_pid, qm[1], qm[2], qm[3])
                                 )
+                                new_qid = self.db.conn.execute("SELECT last_insert_rowid()").fetchone()[0]
                             
-                            for a in qe_obj['allegati']:
-                                self.db.conn.execute(
-                                    """INSERT INTO allegati_qe
-                                    (qe_id, nome_file, tipo_file, dati, data_caricamento)
-                                    VALUES (?, ?, ?, ?, ?)""",
-                                    (new_qid, a[0], a[1], a[2], a[3])
-                                )
+                                self.db.inserisci_voci_bulk(new_qid, qe_obj['voci'])
+                            
+                                # Allegati letti dal backup uno alla volta, e solo
+                                # se il contenuto non è già nel database corrente
+                                if ha_allegati:
+                                    self.db.copia_allegati_da(conn_backup, qm[0], new_qid)
                         
                         count_ok += 1
                         
@@ -3414,7 +3391,6 @@ Generato il {datetime.datetime.now().strftime("%d/%m/%Y")}
                             f"Errore durante l'importazione del progetto ID {old_pid}:\n{e}"
                         )
                 
-                self.db.conn.commit()
                 conn_backup.close()
                 messagebox.showinfo("Fatto", f"Importati correttamente {count_ok} progetti.")
                 imp_win.destroy()
@@ -3454,11 +3430,70 @@ Generato il {datetime.datetime.now().strftime("%d/%m/%Y")}
         for k, e in self.entries_cfg.items():
             e.delete(0, tk.END)
             e.insert(0, self.db.get_config(k))
+        self.cb_compressione.set(self.db.get_config("allegati_compressione") or "nessuna")
+        self.cb_archivio.set(self.db.get_config("allegati_archivio") or "database")
+    
+    # Compressione dei nuovi allegati ("nessuna" = configurazione vuota)
+    CODEC_COMPRESSIONE = ("nessuna", "zlib", "lzma")
+    
+    def salva_compressione(self, e=None):
+        """Salva il codec di compressione dei nuovi allegati"""
+        codec = self.cb_compressione.get()
+        self.db.set_config("allegati_compressione", "" if codec == "nessuna" else codec)
+    
+    def salva_archivio(self, e=None):
+        """Salva dove vanno i nuovi allegati: BLOB nel database o file nella
+        cartella QE_DATI/allegati (quelli già salvati restano dove sono)"""
+        archivio = self.cb_archivio.get()
+        self.db.set_config("allegati_archivio", "" if archivio == "database" else archivio)
+    
+    def verifica_archivio(self):
+        """Verifica l'archivio degli allegati su cartella"""
+        try:
+            orfani, temporanei, mancanti, corrotti = self.db.verifica_archivio_allegati(
+                controlla_impronte=True, rimuovi=True
+            )
+        except OSError as e:
+            messagebox.showerror("Errore", f"Verifica non riuscita:\n{e}")
+            return
+        testo = (
+            f"File non più usati rimossi: {len(orfani)}\n"
+            f"File temporanei rimossi: {len(temporanei)}\n"
+            f"File mancanti: {len(mancanti)}\n"
+            f"File danneggiati: {len(corrotti)}"
+        )
+        if mancanti or corrotti:
+            testo += "\n\n" + "\n".join(mancanti + corrotti)
+            messagebox.showwarning("Verifica Archivio", testo)
+        else:
+            messagebox.showinfo("Verifica Archivio", testo)
+    
+    def report_allegati(self):
+        """Riepilogo dello spazio occupato dagli allegati e di quello risparmiato"""
+        righe = self.db.get_riepilogo_allegati()
+        mb = lambda n: f"{(n or 0) / 2**20:.1f} MB"
+        n_cont = sum(r[2] for r in righe)
+        n_all = sum(r[3] or 0 for r in righe)
+        file_tot = sum(r[4] or 0 for r in righe)
+        distinti = sum(r[5] or 0 for r in righe)
+        salvati = sum(r[6] or 0 for r in righe)
+        testo = (
+            f"Allegati: {n_all} ({n_cont} contenuti distinti)\n"
+            f"Dimensione dei file: {mb(file_tot)}\n"
+            f"Risparmiati con i duplicati: {mb(file_tot - distinti)}\n"
+            f"Risparmiati con la compressione: {mb(distinti - salvati)}\n"
+            f"Occupati su disco: {mb(salvati)}\n"
+        )
+        for esterno, codec, n, _, _, originali, compressi in righe:
+            testo += (
+                f"\n{codec or 'non compressi'}{' (cartella)' if esterno else ''}: "
+                f"{n} contenuti, {mb(originali)} -> {mb(compressi)}"
+            )
+        messagebox.showinfo("Spazio Allegati", testo)
     
     def save_config(self):
         """Salva configurazione"""
-        for k, e in self.entries_cfg.items():
-            self.db.set_config(k, e.get())
+        self.db.set_config_many({k: e.get() for k, e in self.entries_cfg.items()})
         messagebox.showinfo("OK", "Configurazione Salvata!")
     
     def refresh_norm_list(self):